@@ -0,0 +1,146 @@
+import bisect
+
+from Snowflake_Detection.extract_features import *
+
+
+_BIN_EDGES = TIME_BINS.tolist()
+
+
+class DirectionAccumulator(object):
+    """
+    running state of one direction of a flow
+    :count packets seen
+    :last_ts the captured time of the latest packet
+    :bins inter-arrival histogram, index as returned by np.digitize over TIME_BINS
+    :sizes packet size counts, in order of first appearance
+    """
+    __slots__ = ('count', 'last_ts', 'bins', 'sizes')
+
+    def __init__(self):
+        super(DirectionAccumulator, self).__init__()
+        self.count = 0
+        self.last_ts = 0.0
+        self.bins = [0] * (len(_BIN_EDGES) + 1)
+        self.sizes = {}
+
+    def add(self, timestamp, size):
+        if self.count:
+            self.bins[bisect.bisect_right(_BIN_EDGES, (timestamp - self.last_ts) * 1000)] += 1
+        self.last_ts = timestamp
+        self.count += 1
+        self.sizes[size] = self.sizes.get(size, 0) + 1
+
+    def time_bins(self):
+        """F1 of the packets seen so far, same as time_bins()"""
+        total = self.count - 1
+        if total < 1:
+            return [0] * 29
+        return [0 if self.bins[k] == 0 else round(float(self.bins[k]) / total, 2) for k in range(1, 30)]
+
+    def top5(self):
+        """F2 and F3 of the packets seen so far, same as top5_size() and top5_size_percentage()"""
+        res = sorted(self.sizes.items(), key=lambda x: x[1], reverse=True)[:5]
+        top = [v[0] for v in res]
+        percentage = [round(float(v[1]) / self.count * 100, 2) for v in res]
+
+        if len(top) < 5:
+            top += [PADDING] * (5 - len(top))
+            percentage += [PADDING] * (5 - len(percentage))
+
+        return top, percentage
+
+
+class FlowAccumulator(object):
+    """
+    F1-F6 of a flow updated in O(1) per packet, the feature vector can be read at any prefix length
+    :first_seen the captured time of the first packet
+    :last_seen the captured time of the latest packet
+    """
+    __slots__ = ('up', 'down', 'total', 'first_seen', 'last_seen')
+
+    def __init__(self):
+        super(FlowAccumulator, self).__init__()
+        self.up = DirectionAccumulator()
+        self.down = DirectionAccumulator()
+        self.total = 0
+        self.first_seen = 0.0
+        self.last_seen = 0.0
+
+    def __len__(self):
+        return self.total
+
+    def add(self, timestamp, size, direction):
+        """
+        update the state with one packet
+        :param timestamp float: the captured time
+        :param size int: TCP payload length
+        :param direction int: 1: c2s, -1: s2c
+        """
+        timestamp = float(timestamp)
+        if self.total == 0:
+            self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.total += 1
+
+        if direction == UPSTREAM:
+            self.up.add(timestamp, size)
+        elif direction == DOWNSTREAM:
+            self.down.add(timestamp, size)
+
+    def result(self):
+        return self
+
+    def features(self):
+        """
+        the feature vector of the packets seen so far
+        :return res list: identical to flow_features() over the same prefix
+        """
+        up_top, up_percentage = self.up.top5()
+        down_top, down_percentage = self.down.top5()
+
+        # F1
+        res = self.up.time_bins() + self.down.time_bins()
+        # F2
+        res += up_top + down_top
+        # F3
+        res += up_percentage + down_percentage
+        # F4-F6
+        res += self._counts()
+
+        return res
+
+    def _counts(self):
+        # F4
+        res = [self.up.count, self.down.count]
+        # F5
+        res += [round(self.up.count / self.total * 100, 2), round(self.down.count / self.total * 100, 2)]
+        # F6
+        res.append(-1 if self.up.count == 0 else round(self.down.count / self.up.count * 100, 2))
+
+        return res
+
+    def lazy_features(self):
+        """
+        the feature vector of the packets seen so far, computed one group at a time as the model reads it
+        :return LazyFeatures: every column is identical to features()
+        """
+        def top5(acc):
+            top, percentage = acc.top5()
+            return top + percentage
+
+        return LazyFeatures([self.up.time_bins, self.down.time_bins,
+                             lambda: top5(self.up), lambda: top5(self.down), self._counts])
+
+
+def accumulate(flow):
+    """
+    feed a whole flow into an accumulator
+    :param flow Flow: a flow contain a series of packets
+    :return FlowAccumulator: the state after the last packet
+    """
+    acc = FlowAccumulator()
+    timestamps, sizes, directions = flow_arrays(flow)
+    for ts, size, direction in zip(timestamps.tolist(), sizes.tolist(), directions.tolist()):
+        acc.add(ts, size, direction)
+
+    return acc
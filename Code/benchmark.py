@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import time
+import glob
+import joblib
+import argparse
+import tempfile
+import platform
+import importlib.util
+import numpy as np
+
+from Snowflake_Detection.extract_features import *
+from Snowflake_Detection.pcap_reader import BACKENDS, read_packets
+from Snowflake_Detection.compiled_tree import load_model
+from Snowflake_Detection.detector import Detector
+from Snowflake_Detection.flow_table import extract_flows
+from Snowflake_Detection.dataset import extract_dataset, load_training_set, LABELS, DATASET_SUFFIX
+from Snowflake_Detection.train import train_model_cv
+from Snowflake_Detection.synth_corpus import write_flow, write_corpus, write_capture, parse_size, SNOWFLAKE, BROWSER, \
+    ARCHIVES
+
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Covertness Analysis')
+RESULTS_PATH = 'benchmark_results.json'
+
+FLOW_LENGTH = 30
+
+
+def measure(fn, repeat, units=1):
+    """
+    time repeated calls of fn
+    :param fn callable: the stage, called without arguments
+    :param repeat int: number of calls
+    :param units int: packets or flows handled by one call, for the throughput
+    :return dict: latency percentiles in microseconds and units per second
+    """
+    fn()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1e6
+    total = latencies.sum() / 1e6
+    return {'calls': repeat,
+            'p50_us': round(float(np.percentile(latencies, 50)), 3),
+            'p90_us': round(float(np.percentile(latencies, 90)), 3),
+            'p99_us': round(float(np.percentile(latencies, 99)), 3),
+            'mean_us': round(float(latencies.mean()), 3),
+            'units_per_s': round(units * repeat / total, 1) if total else 0.0}
+
+
+def _load_analysis():
+    """Covertness Analysis/analysis.py, which is not on the import path"""
+    spec = importlib.util.spec_from_file_location('analysis', os.path.join(SAMPLE_DIR, 'analysis.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_parsing(pcaps, flow_length, repeat):
+    """extract_flow and a full read of every file with every backend, throughput in packets/s"""
+    res = {}
+    for backend in BACKENDS:
+        for name, path in pcaps:
+            packets = len(extract_flow(path, flow_length, backend))
+            res['extract_flow[%s] %s' % (backend, name)] = measure(
+                lambda: extract_flow(path, flow_length, backend), repeat, packets)
+
+            packets = sum(1 for _ in read_packets(path, backend))
+            res['read_packets[%s] %s' % (backend, name)] = measure(
+                lambda: sum(1 for _ in read_packets(path, backend)), repeat, packets)
+
+    return res
+
+
+def bench_features(pcaps, flow_length, repeat):
+    """every feature function and flow_features, throughput in flows/s"""
+    res = {}
+    flows = [extract_flow(path, flow_length) for name, path in pcaps]
+    functions = [time_bins, top5_size, top5_size_percentage, direction_sum, direction_percentage]
+
+    for fn in functions:
+        res[fn.__name__] = measure(lambda: [fn(flow, d) for flow in flows for d in (UPSTREAM, DOWNSTREAM)],
+                                   repeat, len(flows))
+    res['direction_ratio'] = measure(lambda: [direction_ratio(flow, BOTH) for flow in flows], repeat, len(flows))
+    res['network_speed'] = measure(lambda: [network_speed(flow) for flow in flows], repeat, len(flows))
+    res['flow_features'] = measure(lambda: [flow_features(*flow_arrays(flow)) for flow in flows],
+                                   repeat, len(flows))
+
+    return res
+
+
+def bench_get_data(pcaps, repeat):
+    """the full per-file path of test_fpr.py, throughput in flows/s"""
+    from Snowflake_Detection.test_fpr import get_data
+
+    return {'test_fpr.get_data': measure(lambda: [get_data(path) for name, path in pcaps], repeat, len(pcaps))}
+
+
+def bench_model(model_path, pcaps, flow_length, repeat, batch_size=4096):
+    """model load and predict, single flows and a batch, throughput in flows/s"""
+    res = {}
+    if not os.path.exists(model_path):
+        print('skip model stages, no', model_path)
+        return res
+
+    res['joblib.load'] = measure(lambda: joblib.load(model_path), repeat)
+    res['load_model compiled'] = measure(lambda: load_model(model_path), repeat)
+
+    rows = [extract_pcap(path, flow_length) for name, path in pcaps]
+    X = np.array(rows * (batch_size // len(rows) + 1), dtype=np.float64)[:batch_size]
+    x = X[:1]
+
+    model = joblib.load(model_path)
+    compiled = load_model(model_path)
+    res['predict sklearn single'] = measure(lambda: model.predict(x), repeat)
+    res['predict sklearn batch'] = measure(lambda: model.predict(X), repeat, len(X))
+    if hasattr(compiled, 'predict_one'):
+        res['predict compiled single'] = measure(lambda: compiled.predict_one(rows[0]), repeat)
+        res['predict compiled batch'] = measure(lambda: compiled.predict(X), repeat, len(X))
+
+    return res
+
+
+def bench_analysis(pcaps, repeat):
+    """the series functions of analysis.py and the single-pass analyzer, throughput in files/s"""
+    analysis = _load_analysis()
+    res = {}
+    for fn in [analysis.packet_size, analysis.packet_time, analysis.network_speed]:
+        res['analysis.' + fn.__name__] = measure(lambda: [fn(path, BOTH) for name, path in pcaps],
+                                                 repeat, len(pcaps))
+    res['analysis.analyze'] = measure(lambda: [analysis.analyze(path) for name, path in pcaps], repeat, len(pcaps))
+
+    return res
+
+
+def bench_corpus(corpus_dir, model_path, flow_length, repeat):
+    """Detector.score_files over a generated per-flow corpus, extraction and prediction, throughput in files/s"""
+    paths = sorted(glob.glob(os.path.join(corpus_dir, '*', '*.pcap')))
+    if not os.path.exists(model_path):
+        print('skip corpus stage, no', model_path)
+        return {}
+
+    detector = Detector(model_path, flow_length, workers=1)
+    return {'Detector.score_files corpus': measure(lambda: detector.score_files(paths), repeat, len(paths))}
+
+
+def bench_training(corpus_dir, flow_length, repeat, jobs=2):
+    """
+    train.train_model_cv on datasets extracted from a generated corpus, with more than one worker process,
+    so the stacked memory-mapped arrays of load_training_set go through joblib, throughput in rows/s
+    """
+    paths = []
+    for archive in ARCHIVES.values():
+        path = os.path.join(corpus_dir, archive + DATASET_SUFFIX)
+        extract_dataset(os.path.join(corpus_dir, archive), path, flow_length, LABELS[archive], workers=1)
+        paths.append(path)
+
+    X, Y, _ = load_training_set(paths, tmp_dir=corpus_dir)
+    model_path = os.path.join(corpus_dir, 'DT.pkl')
+    return {'train.train_model_cv datasets': measure(lambda: train_model_cv(X, Y, 3, jobs, model_path),
+                                                     repeat, len(Y))}
+
+
+def bench_capture(pcap_path, flow_length, repeat):
+    """flow_table.extract_flows over a generated multi-flow capture, throughput in packets/s"""
+    packets = sum(1 for _ in read_packets(pcap_path))
+    return {'extract_flows capture': measure(lambda: sum(1 for _ in extract_flows(pcap_path, flow_length)),
+                                             repeat, packets)}
+
+
+def run(pcaps, model_path, flow_length=FLOW_LENGTH, repeat=50, corpus_dir=None, capture_path=None):
+    """
+    run every stage
+    :param pcaps list: (name, path) of the input pcap files
+    :param corpus_dir string: a corpus written by synth_corpus.write_corpus, None to skip it
+    :param capture_path string: a capture written by synth_corpus.write_capture, None to skip it
+    :return dict: the results, stage name -> measurements
+    """
+    stages = {}
+    stages.update(bench_parsing(pcaps, flow_length, repeat))
+    stages.update(bench_features(pcaps, flow_length, repeat))
+    stages.update(bench_get_data(pcaps, repeat))
+    stages.update(bench_model(model_path, pcaps, flow_length, repeat))
+    stages.update(bench_analysis(pcaps, repeat))
+    if corpus_dir is not None:
+        stages.update(bench_corpus(corpus_dir, model_path, flow_length, max(1, repeat // 10)))
+        stages.update(bench_training(corpus_dir, flow_length, max(1, repeat // 10)))
+    if capture_path is not None:
+        stages.update(bench_capture(capture_path, flow_length, max(1, repeat // 10)))
+
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'flow_length': flow_length,
+            'inputs': [name for name, path in pcaps],
+            'stages': stages}
+
+
+def compare(old, new, tolerance=0.1):
+    """
+    stages whose median latency got worse by more than tolerance
+    :return list: (stage, old p50, new p50)
+    """
+    regressions = []
+    for stage, res in new['stages'].items():
+        before = old['stages'].get(stage)
+        if before is None or not before['p50_us']:
+            continue
+        if res['p50_us'] > before['p50_us'] * (1 + tolerance):
+            regressions.append((stage, before['p50_us'], res['p50_us']))
+
+    return regressions
+
+
+def report(results):
+    print('%-48s %12s %12s %12s %14s' % ('stage', 'p50 us', 'p90 us', 'p99 us', 'units/s'))
+    for stage, res in results['stages'].items():
+        print('%-48s %12.1f %12.1f %12.1f %14.1f' % (stage, res['p50_us'], res['p90_us'], res['p99_us'],
+                                                     res['units_per_s']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='time parsing, feature extraction and prediction')
+    parser.add_argument('pcaps', nargs='*', help='pcap files, the bundled Covertness Analysis samples by default')
+    parser.add_argument('--generate', type=int, nargs='*', default=[],
+                        help='also time generated snowflake and browser single-flow pcaps of these packet counts')
+    parser.add_argument('--corpus', type=int, default=0,
+                        help='also time detection of a generated corpus of this many files per profile')
+    parser.add_argument('--capture', type=parse_size, default=None,
+                        help='also time flow splitting of a generated multi-flow capture of this size, e.g. 100M')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated inputs')
+    parser.add_argument('--model', default='DT.pkl')
+    parser.add_argument('--flow-length', type=int, default=FLOW_LENGTH)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--output', default=RESULTS_PATH)
+    parser.add_argument('--compare', default=None, help='a previous results file, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    paths = args.pcaps or sorted(glob.glob(os.path.join(SAMPLE_DIR, '*.pcap')))
+    pcaps = [(os.path.basename(path), path) for path in paths]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for packets in args.generate:
+            for profile in (SNOWFLAKE, BROWSER):
+                path = os.path.join(tmp, '%s_%d.pcap' % (profile, packets))
+                write_flow(path, profile, packets, args.seed)
+                pcaps.append((os.path.basename(path), path))
+
+        corpus_dir = None
+        if args.corpus:
+            corpus_dir = os.path.join(tmp, 'corpus')
+            write_corpus(corpus_dir, {SNOWFLAKE: args.corpus, BROWSER: args.corpus}, seed=args.seed)
+
+        capture_path = None
+        if args.capture:
+            capture_path = os.path.join(tmp, 'capture.pcap')
+            write_capture(capture_path, args.capture, seed=args.seed)
+
+        results = run(pcaps, args.model, args.flow_length, args.repeat, corpus_dir, capture_path)
+        results['seed'] = args.seed
+
+    report(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('saved', args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for stage, before, after in regressions:
+            print('REGRESSION %s p50 %.1f -> %.1f us' % (stage, before, after))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,349 @@
+import os
+import json
+import argparse
+import numpy as np
+from sklearn.model_selection import train_test_split
+from sklearn.tree import DecisionTreeClassifier as DT
+
+from Snowflake_Detection.extract_features import *
+from Snowflake_Detection.compiled_tree import load_model
+from Snowflake_Detection.detector import archive_rate
+from Snowflake_Detection.train import get_data, get_stat, save_model
+from Snowflake_Detection.metrics import METRICS
+
+
+CASCADE_LENGTHS = (10, 20, 30)
+CASCADE_PATH = 'cascade.json'
+
+# early models keep a few samples per leaf, so the share of the majority class at a leaf means something
+MIN_SAMPLES_LEAF = 5
+
+# a threshold no confidence reaches, the stage never exits early, even at a confidence of exactly 1.0
+NEVER = float('inf')
+
+# candidate thresholds per early stage when tuning
+GRID_SIZE = 32
+
+# rounds of coordinate descent over the early stages when tuning
+TUNING_ROUNDS = 5
+
+
+def model_name(flow_length):
+    """file name of the model of a prefix length, e.g. DT_10.pkl"""
+    return 'DT_%d.pkl' % flow_length
+
+
+def _confidence(model, X):
+    """classes and confidences of a batch, from leaf confidences or from predict_proba of other models"""
+    if hasattr(model, 'predict_confidence'):
+        return model.predict_confidence(X)
+    proba = model.predict_proba(X)
+    return model.classes_.take(np.argmax(proba, axis=1)), proba.max(axis=1)
+
+
+def _confidence_lazy(model, features):
+    """class and confidence of a LazyFeatures, the whole vector is computed for models that cannot walk it lazily"""
+    if hasattr(model, 'predict_lazy_confidence'):
+        return model.predict_lazy_confidence(features)
+    classes, confidence = _confidence(model, np.asarray([features.vector()], dtype=np.float64))
+    return classes[0], float(confidence[0])
+
+
+class Cascade(object):
+    """
+    models of increasing prefix lengths, a flow gets the verdict of the first model confident enough,
+    so most flows are classified after the first few packets instead of after flow_length packets
+    the model of the last prefix length always gives the verdict
+    :lengths the prefix lengths, increasing
+    :thresholds the confidence a verdict needs at every prefix length, the last one is unused
+    :exits number of verdicts given at every prefix length
+    """
+    __slots__ = ('lengths', 'models', 'thresholds', 'exits', '_stage')
+
+    def __init__(self, lengths, models, thresholds):
+        super(Cascade, self).__init__()
+        if list(lengths) != sorted(set(lengths)):
+            raise ValueError('prefix lengths must be increasing: %r' % (lengths,))
+        self.lengths = list(lengths)
+        self.models = list(models)
+        self.thresholds = list(thresholds)
+        self.exits = [0] * len(self.lengths)
+        self._stage = {n: stage for stage, n in enumerate(self.lengths)}
+
+    @classmethod
+    def load(cls, path=CASCADE_PATH):
+        """
+        load a cascade written by save, model paths are relative to the cascade file
+        :param path string: the cascade json file
+        """
+        with open(path) as f:
+            config = json.load(f)
+        root = os.path.dirname(os.path.abspath(path))
+        stages = config['stages']
+        return cls([stage['flow_length'] for stage in stages],
+                   [load_model(os.path.join(root, stage['model'])) for stage in stages],
+                   [NEVER if stage['threshold'] is None else stage['threshold'] for stage in stages])
+
+    def save(self, path, model_paths, report=None):
+        """
+        write the prefix lengths, model paths and thresholds, NEVER is written as null
+        :param model_paths list: the model file of every stage, relative to the cascade file
+        :param report dict: the tuning report, kept for reference
+        """
+        config = {'stages': [{'flow_length': n, 'model': model_path,
+                              'threshold': None if threshold == NEVER else threshold}
+                             for n, model_path, threshold in zip(self.lengths, model_paths, self.thresholds)]}
+        if report is not None:
+            config['tuning'] = report
+        with open(path, 'w') as f:
+            json.dump(config, f, indent=1)
+
+    @property
+    def flow_length(self):
+        """the longest prefix, every flow has a verdict once it reaches it"""
+        return self.lengths[-1]
+
+    def stage_of(self, flow_length):
+        """the stage of a prefix length, None between stages"""
+        return self._stage.get(flow_length)
+
+    def predict_stage(self, stage, features):
+        """
+        verdict of a flow at a stage, None when the model is not confident enough and the flow goes on
+        :param stage int: the index of the prefix length the flow just reached
+        :param features LazyFeatures: the feature vector of the prefix
+        :return int: SNOWFLAKE or NORMAL, None to wait for the next prefix length
+        """
+        model = self.models[stage]
+        if stage == len(self.lengths) - 1:
+            verdict = model.predict_lazy(features) if hasattr(model, 'predict_lazy') else \
+                model.predict(np.asarray([features.vector()], dtype=np.float64))[0]
+        else:
+            verdict, confidence = _confidence_lazy(model, features)
+            if confidence < self.thresholds[stage]:
+                return None
+
+        self.exits[stage] += 1
+        METRICS.count('cascade_exit_%d' % self.lengths[stage])
+        return verdict
+
+    def predict_rows(self, rows):
+        """
+        verdicts of flows whose feature vectors at every prefix length are known, e.g. from extract_rows
+        :param rows list: one list per flow with the vector of every prefix length, in the order of lengths
+        :return tuple: ndarray of verdicts, ndarray of the prefix length each verdict was given at
+        """
+        X = [np.asarray([row[stage] for row in rows], dtype=np.float64) for stage in range(len(self.lengths))]
+        classes, confidences = self.stage_outputs(X)
+        verdicts, exit_stage = cascade_verdicts(classes, confidences, self.thresholds)
+        for stage, n in enumerate(np.bincount(exit_stage, minlength=len(self.lengths)).tolist()):
+            self.exits[stage] += n
+
+        return verdicts, np.asarray(self.lengths)[exit_stage]
+
+    def stage_outputs(self, X):
+        """
+        classes and confidences of every stage
+        :param X list: the feature matrix of every prefix length, row i is the same flow in all of them
+        :return tuple: list of class arrays, list of confidence arrays
+        """
+        outputs = [_confidence(model, x) for model, x in zip(self.models[:-1], X[:-1])]
+        final = self.models[-1].predict(X[-1])
+        classes = [c for c, _ in outputs] + [final]
+        confidences = [p for _, p in outputs] + [np.ones(len(final))]
+
+        return classes, confidences
+
+    def score_files(self, pcap_paths, workers=None, chunk_size=16, backend=DEFAULT_BACKEND):
+        """
+        verdict of every pcap file, all the prefix lengths are extracted in one pass over a file
+        :return list: (pcap_path, verdict, prefix length of the verdict) in the order of pcap_paths
+        """
+        pcap_paths = list(pcap_paths)
+        rows = list(extract_rows(pcap_paths, self.lengths, workers, chunk_size, backend))
+        if not rows:
+            return []
+        verdicts, lengths = self.predict_rows(rows)
+
+        return list(zip(pcap_paths, verdicts.tolist(), lengths.tolist()))
+
+    def exit_report(self):
+        """share of the verdicts given at every prefix length and the mean prefix length of a verdict"""
+        total = sum(self.exits)
+        if not total:
+            return {}
+        return {'exits': {n: round(count / total, 4) for n, count in zip(self.lengths, self.exits)},
+                'mean_packets': round(sum(n * count for n, count in zip(self.lengths, self.exits)) / total, 2)}
+
+
+def cascade_verdicts(classes, confidences, thresholds):
+    """
+    the verdict of every flow, from the first stage whose confidence reaches its threshold
+    :param classes list: the predicted classes of every stage
+    :param confidences list: the confidences of every stage
+    :param thresholds list: the threshold of every stage, the last stage always gives the verdict
+    :return tuple: ndarray of verdicts, ndarray of the stage index of each verdict
+    """
+    last = len(classes) - 1
+    verdicts = np.array(classes[last], copy=True)
+    exit_stage = np.full(len(verdicts), last, dtype=np.int64)
+    undecided = np.ones(len(verdicts), dtype=bool)
+    for stage in range(last):
+        take = undecided & (confidences[stage] >= thresholds[stage])
+        verdicts[take] = classes[stage][take]
+        exit_stage[take] = stage
+        undecided &= ~take
+
+    return verdicts, exit_stage
+
+
+def _candidates(confidence, grid_size):
+    """thresholds worth trying for a stage, the distinct confidences it gives (at most grid_size) and NEVER"""
+    values = np.unique(confidence)
+    if len(values) > grid_size:
+        values = np.unique(np.quantile(confidence, np.linspace(0, 1, grid_size)))
+    return sorted(set(values.tolist()) | {NEVER})
+
+
+def tune_thresholds(classes, confidences, Y, lengths, max_recall_loss=0.005, max_fpr_increase=0.005,
+                    grid_size=GRID_SIZE, rounds=TUNING_ROUNDS):
+    """
+    thresholds giving the shortest mean prefix length at a verdict, within a recall and FPR budget
+    the budget is relative to the recall and FPR of the last stage alone, the numbers train.py reports
+    the search is a coordinate descent from the last stage alone: one early stage at a time takes its best
+    candidate with the other thresholds fixed, until a round changes nothing, so its cost is linear in the stages
+    :param classes, confidences list: the outputs of every stage on held-out flows, see Cascade.stage_outputs
+    :param Y array: the labels of the held-out flows
+    :param lengths list: the prefix length of every stage
+    :param max_recall_loss float: how much lower than the last stage the cascade recall may be
+    :param max_fpr_increase float: how much higher than the last stage the cascade FPR may be
+    :param rounds int: the most rounds of the coordinate descent
+    :return tuple: the thresholds and a report of the baseline and the tuned cascade
+    """
+    Y = np.asarray(Y)
+    lengths = np.asarray(lengths)
+    base_recall, base_fpr, base_accuracy, _ = get_stat(Y, classes[-1])
+
+    def evaluate(thresholds):
+        """the sort key and the stats of some thresholds, None when they are over the budget"""
+        verdicts, exit_stage = cascade_verdicts(classes, confidences, thresholds)
+        recall, fpr, accuracy, _ = get_stat(Y, verdicts)
+        if recall < base_recall - max_recall_loss or fpr > base_fpr + max_fpr_increase:
+            return None
+        return (float(lengths[exit_stage].mean()), -accuracy), recall, fpr, accuracy, exit_stage
+
+    # all NEVER is the last stage alone, it is always within the budget
+    thresholds = [NEVER] * len(lengths)
+    best = evaluate(thresholds)
+    grids = [_candidates(confidence, grid_size) for confidence in confidences[:-1]]
+    for _ in range(rounds):
+        changed = False
+        for stage, grid in enumerate(grids):
+            for candidate in grid:
+                if candidate == thresholds[stage]:
+                    continue
+                trial = list(thresholds)
+                trial[stage] = candidate
+                res = evaluate(trial)
+                if res is not None and res[0] < best[0]:
+                    thresholds, best, changed = trial, res, True
+        if not changed:
+            break
+
+    _, recall, fpr, accuracy, exit_stage = best
+    exits = np.bincount(exit_stage, minlength=len(lengths)) / len(Y)
+    report = {'flows': int(len(Y)),
+              'baseline': {'flow_length': int(lengths[-1]), 'recall': round(base_recall, 4),
+                           'fpr': round(base_fpr, 4), 'accuracy': round(base_accuracy, 4)},
+              'cascade': {'recall': round(recall, 4), 'fpr': round(fpr, 4), 'accuracy': round(accuracy, 4),
+                          'mean_packets': round(float(lengths[exit_stage].mean()), 2),
+                          'exits': {int(n): round(float(share), 4) for n, share in zip(lengths, exits)}}}
+
+    return thresholds, report
+
+
+def load_aligned(lengths):
+    """
+    the training sets of every prefix length, rows must be the same flows in the same order,
+    as written by extract_features.py --flow-length 10 20 30
+    :return tuple: list of feature matrices, the label vector
+    """
+    X = []
+    Y = None
+    for n in lengths:
+        x, y = get_data(n)
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y)
+        if Y is not None and not np.array_equal(y, Y):
+            raise ValueError('the training sets of prefix lengths %r do not hold the same flows' % (lengths,))
+        X.append(x)
+        Y = y
+
+    return X, Y
+
+
+def train_cascade(lengths=CASCADE_LENGTHS, max_recall_loss=0.005, max_fpr_increase=0.005, holdout=0.3,
+                  min_samples_leaf=MIN_SAMPLES_LEAF, cascade_path=CASCADE_PATH, seed=None):
+    """
+    train a model per prefix length on one split of the training sets and tune the thresholds on the other
+    the early models keep min_samples_leaf samples per leaf, the last one is grown fully like train.py does
+    :return tuple: the Cascade and its tuning report
+    """
+    X, Y = load_aligned(lengths)
+    train_index, tune_index = train_test_split(np.arange(len(Y)), test_size=holdout, stratify=Y, random_state=seed)
+
+    models = []
+    model_paths = []
+    root = os.path.dirname(os.path.abspath(cascade_path))
+    for stage, n in enumerate(lengths):
+        last = stage == len(lengths) - 1
+        model = DT(random_state=seed) if last else DT(min_samples_leaf=min_samples_leaf, random_state=seed)
+        model.fit(X[stage][train_index], Y[train_index])
+        save_model(model, os.path.join(root, model_name(n)))
+        models.append(load_model(os.path.join(root, model_name(n))))
+        model_paths.append(model_name(n))
+
+    cascade = Cascade(lengths, models, [NEVER] * len(lengths))
+    classes, confidences = cascade.stage_outputs([x[tune_index] for x in X])
+    cascade.thresholds, report = tune_thresholds(classes, confidences, Y[tune_index], lengths,
+                                                 max_recall_loss, max_fpr_increase)
+    cascade.save(cascade_path, model_paths, report)
+
+    return cascade, report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='early-exit detection over increasing prefix lengths')
+    parser.add_argument('--cascade', default=CASCADE_PATH)
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    train_parser = sub.add_parser('train', help='train a model per prefix length and tune the thresholds')
+    train_parser.add_argument('--flow-length', type=int, nargs='+', default=list(CASCADE_LENGTHS))
+    train_parser.add_argument('--max-recall-loss', type=float, default=0.005,
+                              help='recall the cascade may lose against the longest prefix alone')
+    train_parser.add_argument('--max-fpr-increase', type=float, default=0.005,
+                              help='FPR the cascade may add to the longest prefix alone')
+    train_parser.add_argument('--holdout', type=float, default=0.3, help='share of the flows used for tuning')
+    train_parser.add_argument('--min-samples-leaf', type=int, default=MIN_SAMPLES_LEAF)
+    train_parser.add_argument('--seed', type=int, default=None)
+
+    test_parser = sub.add_parser('test', help='rate of snowflake verdicts of every archive, as test_fpr.py')
+    test_parser.add_argument('pcap_archive', help='a directory whose sub-directories are pcap archives')
+    test_parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.mode == 'train':
+        cascade, report = train_cascade(args.flow_length, args.max_recall_loss, args.max_fpr_increase, args.holdout,
+                                        args.min_samples_leaf, args.cascade, args.seed)
+        print(json.dumps(report, indent=1))
+        print(args.cascade, 'thresholds', cascade.thresholds)
+    else:
+        cascade = Cascade.load(args.cascade)
+        for archive in sorted(os.listdir(args.pcap_archive)):
+            pcap_dir = os.path.join(args.pcap_archive, archive)
+            pcap_paths = [os.path.join(pcap_dir, pcap) for pcap in sorted(os.listdir(pcap_dir))]
+            verdicts = [(path, verdict) for path, verdict, _ in cascade.score_files(pcap_paths, args.workers)]
+            print(archive, 'total: %d' % len(verdicts), 'DT %f' % archive_rate(verdicts))
+        print(cascade.exit_report())
+
+    print('OK.')
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import pickle
+import argparse
+import joblib
+import numpy as np
+from sklearn.model_selection import StratifiedKFold
+from sklearn.tree import DecisionTreeClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.naive_bayes import GaussianNB
+from sklearn.ensemble import RandomForestClassifier
+
+from Snowflake_Detection.extract_features import *
+from Snowflake_Detection.compiled_tree import CompiledTree
+from Snowflake_Detection.train import get_data, get_stat, save_model, SNOWFLAKE, NORMAL
+
+
+FLOW_LENGTH = 30
+
+# name -> factory of an unfitted model, every model is trained on the same folds of the same feature matrix
+MODELS = {
+    'DT': lambda: DecisionTreeClassifier(),
+    'KNN': lambda: KNeighborsClassifier(n_neighbors=5, algorithm='kd_tree'),
+    'NB': lambda: GaussianNB(),
+    'RF': lambda: RandomForestClassifier(n_estimators=100, n_jobs=1),
+}
+
+# rows timed one at a time for the single-flow latency
+SINGLE_ROWS = 200
+
+
+def load_archives(snowflake_dir, normal_dir, flow_length=FLOW_LENGTH, workers=None, cache_path=None):
+    """
+    the feature matrix of two pcap archives, each file is extracted once
+    :return tuple: the matrix of feature vectors, the label vector
+    """
+    X = []
+    Y = []
+    for pcap_dir, label in [(snowflake_dir, SNOWFLAKE), (normal_dir, NORMAL)]:
+        pcap_paths = [os.path.join(pcap_dir, pcap) for pcap in sorted(os.listdir(pcap_dir))]
+        for res in extract_rows(pcap_paths, flow_length, workers, cache_path=cache_path):
+            if res:
+                X.append(res)
+                Y.append(label)
+
+    return np.asarray(X, dtype=np.float64), np.asarray(Y)
+
+
+def _fit_fold(name, X, Y, train_index, test_index):
+    """fit and score one model on one fold, run in a worker process"""
+    model = MODELS[name]()
+    start = time.perf_counter()
+    model.fit(X[train_index], Y[train_index])
+    fit_time = time.perf_counter() - start
+    tpr, fpr, accuracy, precision = get_stat(Y[test_index], model.predict(X[test_index]))
+
+    return name, model, fit_time, accuracy, tpr, fpr
+
+
+def model_size(model):
+    """bytes of the pickled model"""
+    return len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def latency(predict, X, single_rows=SINGLE_ROWS, repeat=3):
+    """
+    inference latency of a fitted model
+    :param predict function: e.g. model.predict
+    :param X array: the rows to predict
+    :return tuple: median seconds of a single-row call, seconds per row of one batch call over X (best of repeat)
+    """
+    rows = X[:single_rows]
+    single = []
+    for i in range(len(rows)):
+        start = time.perf_counter()
+        predict(rows[i:i + 1])
+        single.append(time.perf_counter() - start)
+
+    batch = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        predict(X)
+        batch = min(batch, time.perf_counter() - start)
+
+    return float(np.median(single)), batch / len(X)
+
+
+def compare_models(X, Y, names=tuple(MODELS), n_splits=5, n_jobs=-1, seed=None):
+    """
+    train and score every model on the same stratified folds, all (model, fold) fits run in parallel,
+    latency is then measured in this process, one model at a time, so the timings do not compete for cores
+    :param X array: the matrix of feature vectors
+    :param Y array: the labels
+    :param names list: keys of MODELS
+    :return tuple: list of result dicts in the order of names, the model of the best fold of every name
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y)
+    folds = list(StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed).split(X, Y))
+    fits = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_fit_fold)(name, X, Y, train_index, test_index)
+        for name in names for train_index, test_index in folds)
+
+    results = []
+    best_models = {}
+    for name in names:
+        runs = [fit for fit in fits if fit[0] == name]
+        _, models, fit_time, accuracy, tpr, fpr = zip(*runs)
+        best = int(np.argmax(accuracy))
+        model = best_models[name] = models[best]
+        test_index = folds[best][1]
+
+        res = {'model': name, 'accuracy': float(np.mean(accuracy)), 'tpr': float(np.mean(tpr)),
+               'fpr': float(np.mean(fpr)), 'fit_seconds': float(np.mean(fit_time)), 'size_bytes': model_size(model)}
+        res['single_us'], res['batch_us'] = [t * 1e6 for t in latency(model.predict, X[test_index])]
+        results.append(res)
+
+        if isinstance(model, DecisionTreeClassifier):
+            # the tree as Detector scores it
+            tree = CompiledTree.from_model(model)
+            compiled = dict(res, model=name + '-compiled', size_bytes=model_size(tree))
+            compiled['single_us'] = latency(lambda x: tree.predict_one(x[0]), X[test_index])[0] * 1e6
+            compiled['batch_us'] = latency(tree.predict, X[test_index])[1] * 1e6
+            results.append(compiled)
+
+    return results, best_models
+
+
+def report(results):
+    """the results as a table"""
+    lines = ['%-14s %8s %8s %8s %10s %12s %11s %10s' % ('model', 'accuracy', 'TPR', 'FPR', 'fit (s)', 'size (KB)',
+                                                        'single (us)', 'batch (us)')]
+    for res in results:
+        lines.append('%-14s %8.2f %8.2f %8.2f %10.3f %12.1f %11.1f %10.3f' % (
+            res['model'], res['accuracy'] * 100, res['tpr'] * 100, res['fpr'] * 100, res['fit_seconds'],
+            res['size_bytes'] / 1024, res['single_us'], res['batch_us']))
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='train and compare DT, KNN, NB and RF on one feature matrix')
+    parser.add_argument('--flow-length', type=int, default=FLOW_LENGTH)
+    parser.add_argument('--archives', nargs=2, default=None, metavar=('SNOWFLAKE', 'NORMAL'),
+                        help='extract the features of two pcap archives instead of reading the training csv files')
+    parser.add_argument('--cache', default=None, help='feature cache path for --archives, e.g. ' + CACHE_PATH)
+    parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=-1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--save', action='store_true', help='write the best fold model of every name, e.g. KNN.pkl')
+    parser.add_argument('--json', default=None, help='also write the results to a json file')
+    args = parser.parse_args()
+
+    if args.archives:
+        X, Y = load_archives(args.archives[0], args.archives[1], args.flow_length, cache_path=args.cache)
+    else:
+        X, Y = get_data(args.flow_length)
+    print(len(Y), 'flows')
+
+    results, models = compare_models(X, Y, args.models, args.folds, args.jobs, args.seed)
+    print(report(results))
+
+    if args.save:
+        for name, model in models.items():
+            save_model(model, name + '.pkl')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    print('OK.')
@@ -0,0 +1,247 @@
+import os
+import time
+import joblib
+import argparse
+import numpy as np
+import pandas as pd
+
+
+class CompiledTree(object):
+    """
+    a trained DecisionTreeClassifier flattened into arrays, scored without sklearn or pandas
+    :feature the column tested at every node
+    :threshold go left when the column (as float32, like sklearn) is <= threshold
+    :left, right children of every node, -1 at a leaf
+    :leaf_class the predicted class at every node
+    :confidence Laplace-smoothed share of the predicted class among the training samples at every node, may be None
+    """
+    __slots__ = ('feature', 'threshold', 'left', 'right', 'leaf_class', 'confidence', 'depth',
+                 '_feature', '_threshold', '_children', '_leaf_class', '_walk_feature', '_walk_left', '_walk_right')
+
+    def __init__(self, feature, threshold, left, right, leaf_class, confidence=None):
+        super(CompiledTree, self).__init__()
+        self.feature = np.asarray(feature, dtype=np.int64)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int64)
+        self.right = np.asarray(right, dtype=np.int64)
+        self.leaf_class = np.asarray(leaf_class)
+        self.confidence = None if confidence is None else np.asarray(confidence, dtype=np.float64)
+
+        # plain lists for predict_one, indexing lists is much faster than numpy scalars
+        self._feature = self.feature.tolist()
+        self._threshold = self.threshold.tolist()
+        self._children = list(zip(self.left.tolist(), self.right.tolist()))
+        self._leaf_class = self.leaf_class.tolist()
+
+        # for predict, leaves point back to themselves so every row can take depth steps without bookkeeping
+        leaf = self.left == -1
+        nodes = np.arange(len(self.left))
+        self._walk_feature = np.where(leaf, 0, self.feature)
+        self._walk_left = np.where(leaf, nodes, self.left)
+        self._walk_right = np.where(leaf, nodes, self.right)
+        self.depth = 0
+        level = np.zeros(1, dtype=np.int64)
+        while True:
+            level = level[self.left[level] != -1]
+            if not len(level):
+                break
+            self.depth += 1
+            level = np.concatenate([self.left[level], self.right[level]])
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        flatten a fitted sklearn DecisionTreeClassifier
+        :param model DecisionTreeClassifier: the trained model, e.g. joblib.load('DT.pkl')
+        """
+        tree = model.tree_
+        value = tree.value[:, 0, :] if tree.value.ndim == 3 else tree.value
+        # same tie-break as sklearn: the first class with the highest value
+        leaf_class = model.classes_.take(np.argmax(value, axis=1))
+        # a pure leaf of a handful of samples is less certain than a pure leaf of thousands
+        samples = tree.n_node_samples
+        share = value.max(axis=1) / value.sum(axis=1)
+        confidence = (share * samples + 1) / (samples + value.shape[1])
+
+        return cls(tree.feature, tree.threshold, tree.children_left, tree.children_right, leaf_class, confidence)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        confidence = data['confidence'] if 'confidence' in data.files else None
+        return cls(data['feature'], data['threshold'], data['left'], data['right'], data['leaf_class'], confidence)
+
+    def save(self, path):
+        arrays = {}
+        if self.confidence is not None:
+            arrays['confidence'] = self.confidence
+        np.savez(path, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+                 leaf_class=self.leaf_class, **arrays)
+
+    def __len__(self):
+        return len(self.feature)
+
+    def used_features(self):
+        """the columns tested by at least one node"""
+        return sorted(set(self.feature[self.left != -1].tolist()))
+
+    def predict_one(self, res):
+        """
+        class of a single feature vector
+        :param res list: the feature vector
+        :return: the predicted class
+        """
+        x = np.asarray(res, dtype=np.float32).tolist()
+        feature = self._feature
+        threshold = self._threshold
+        children = self._children
+
+        node = 0
+        left, right = children[0]
+        while left != -1:
+            node = left if x[feature[node]] <= threshold[node] else right
+            left, right = children[node]
+
+        return self._leaf_class[node]
+
+    def predict_lazy(self, features):
+        """
+        class of a lazily computed feature vector, only the columns tested on the path to the leaf are read
+        :param features LazyFeatures: the feature vector, any object indexed by column works
+        :return: the predicted class, the same as predict_one of the whole vector
+        """
+        return self._leaf_class[self._leaf_lazy(features)]
+
+    def predict_lazy_confidence(self, features):
+        """
+        class and confidence of a lazily computed feature vector
+        :return tuple: the predicted class and the confidence of its leaf
+        """
+        node = self._leaf_lazy(features)
+        return self._leaf_class[node], float(self._confidences()[node])
+
+    def _leaf_lazy(self, features):
+        feature = self._feature
+        threshold = self._threshold
+        children = self._children
+
+        node = 0
+        left, right = children[0]
+        while left != -1:
+            # compared as float32, like predict_one
+            node = left if float(np.float32(features[feature[node]])) <= threshold[node] else right
+            left, right = children[node]
+
+        return node
+
+    def predict(self, X):
+        """
+        classes of a batch of feature vectors
+        :param X array: the matrix of feature vectors
+        :return ndarray: the predicted class of every row
+        """
+        return self.leaf_class[self.leaves(X)]
+
+    def predict_confidence(self, X):
+        """
+        classes of a batch of feature vectors and the confidence of their leaves
+        :return tuple: ndarray of the predicted classes, ndarray of the confidences
+        """
+        nodes = self.leaves(X)
+        return self.leaf_class[nodes], self._confidences()[nodes]
+
+    def _confidences(self):
+        if self.confidence is None:
+            raise ValueError('the tree has no leaf confidences, compile it again from the sklearn model')
+        return self.confidence
+
+    def leaves(self, X):
+        """
+        the leaf reached by every row, all rows walk the tree together one level at a time
+        :param X array: the matrix of feature vectors
+        :return ndarray: the node index of every row
+        """
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+
+        rows = np.arange(len(X))
+        node = np.zeros(len(X), dtype=np.int64)
+        for _ in range(self.depth):
+            go_left = X[rows, self._walk_feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self._walk_left[node], self._walk_right[node])
+
+        return node
+
+
+def load_model(path, compile=True):
+    """
+    load a model for scoring
+    :param path string: a joblib model such as DT.pkl, or a compiled tree .npz
+    :param compile bool: flatten a DecisionTreeClassifier into a CompiledTree
+    :return: an object with predict(X)
+    """
+    if path.endswith('.npz'):
+        return CompiledTree.load(path)
+
+    model = joblib.load(path)
+    if compile and hasattr(model, 'tree_') and hasattr(model, 'classes_'):
+        return CompiledTree.from_model(model)
+
+    return model
+
+
+def validate(model, tree, X):
+    """
+    check a compiled tree gives the same predictions as the sklearn model
+    :param X array: the matrix of feature vectors, e.g. the training csv files
+    :return int: number of rows checked, raise AssertionError at the first difference
+    """
+    X = np.asarray(X)
+    expected = model.predict(X)
+
+    batch = tree.predict(X)
+    diff = np.flatnonzero(batch != expected)
+    assert len(diff) == 0, 'batch prediction differs at row %d' % diff[0]
+
+    for i in range(len(X)):
+        assert tree.predict_one(X[i]) == expected[i], 'single prediction differs at row %d' % i
+
+    return len(X)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='compile DT.pkl into flat arrays and check it against sklearn')
+    parser.add_argument('model_path', nargs='?', default='DT.pkl')
+    parser.add_argument('output', nargs='?', default=None)
+    parser.add_argument('--validate', nargs='*', default=['snowflake_train_30.csv', 'normal_train_30.csv'],
+                        help='headerless training csv files to compare predictions on')
+    args = parser.parse_args()
+
+    model = joblib.load(args.model_path)
+    tree = CompiledTree.from_model(model)
+    output = args.output or os.path.splitext(args.model_path)[0] + '.npz'
+    tree.save(output)
+    print(output, len(tree), 'nodes', len(tree.used_features()), 'features used')
+
+    csv_paths = [path for path in args.validate if os.path.exists(path)]
+    if csv_paths:
+        X = pd.concat([pd.read_csv(path, header=None) for path in csv_paths], axis=0).values
+        print('validated', validate(model, tree, X), 'rows')
+
+        for name, predict in [('sklearn', model.predict), ('compiled', tree.predict)]:
+            start = time.perf_counter()
+            predict(X)
+            print(name, 'batch %.3f us/row' % ((time.perf_counter() - start) / len(X) * 1e6))
+
+        start = time.perf_counter()
+        for i in range(min(len(X), 1000)):
+            model.predict(X[i:i + 1])
+        print('sklearn single %.1f us' % ((time.perf_counter() - start) / min(len(X), 1000) * 1e6))
+        start = time.perf_counter()
+        for i in range(min(len(X), 1000)):
+            tree.predict_one(X[i])
+        print('compiled single %.1f us' % ((time.perf_counter() - start) / min(len(X), 1000) * 1e6))
+
+    print('OK.')
@@ -0,0 +1,256 @@
+import os
+import csv
+import json
+import atexit
+import shutil
+import tempfile
+import argparse
+import numpy as np
+
+from Snowflake_Detection.extract_features import *
+
+
+SNOWFLAKE = 1
+NORMAL = 0
+
+LABELS = {'snowflake': SNOWFLAKE, 'normal': NORMAL}
+
+DATASET_SUFFIX = '.dataset'
+
+_X = 'X.npy'
+_Y = 'y.npy'
+_SOURCE = 'source.npy'
+_META = 'meta.json'
+
+# raw files the writer appends to before the npy files are laid out
+_X_RAW = 'X.raw'
+_SOURCE_RAW = 'source.txt'
+
+# rows copied at a time from X.raw into X.npy
+COPY_ROWS = 65536
+
+# backing files of the arrays stacked by load_training_set, removed when the process exits
+_stacked_paths = []
+
+
+def dataset_name(pcap_archive, flow_length):
+    """default dataset name of an archive, e.g. snowflake_train_30.dataset"""
+    return os.path.basename(os.path.normpath(pcap_archive)) + '_train_' + str(flow_length) + DATASET_SUFFIX
+
+
+class DatasetWriter(object):
+    """
+    write feature vectors row by row into a dataset directory of npy files:
+    X.npy float64 (rows, columns), y.npy int8 labels, source.npy the source file of every row,
+    and meta.json with the column names, flow length and feature-set version,
+    meta.json is written last, a directory without it is not a complete dataset
+    """
+    def __init__(self, path, flow_length=None, columns=None):
+        super(DatasetWriter, self).__init__()
+        self.path = path
+        self.flow_length = flow_length
+        self.columns = list(FEATURE_NAMES if columns is None else columns)
+        self.labels = []
+        self.count = 0
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.x_raw = open(os.path.join(path, _X_RAW), 'wb')
+        self.source_raw = open(os.path.join(path, _SOURCE_RAW), 'w', encoding='utf-8')
+
+    def append(self, res, label, source=''):
+        """
+        add a row
+        :param res list: the feature vector
+        :param label int: SNOWFLAKE or NORMAL
+        :param source string: the pcap file of the row
+        """
+        if len(res) != len(self.columns):
+            raise ValueError('expected %d columns, got %d' % (len(self.columns), len(res)))
+        np.asarray(res, dtype=np.float64).tofile(self.x_raw)
+        self.source_raw.write(source.replace('\n', ' ') + '\n')
+        self.labels.append(label)
+        self.count += 1
+
+    def close(self):
+        """lay the rows out as npy files, after this the dataset can be loaded"""
+        self.x_raw.close()
+        self.source_raw.close()
+
+        x_raw = os.path.join(self.path, _X_RAW)
+        shape = (self.count, len(self.columns))
+        X = np.lib.format.open_memmap(os.path.join(self.path, _X), mode='w+', dtype=np.float64, shape=shape)
+        if self.count:
+            # chunk by chunk, the matrix is never read into memory as a whole
+            raw = np.memmap(x_raw, dtype=np.float64, mode='r', shape=shape)
+            for start in range(0, self.count, COPY_ROWS):
+                X[start:start + COPY_ROWS] = raw[start:start + COPY_ROWS]
+            del raw
+        X.flush()
+        del X
+        os.remove(x_raw)
+
+        np.save(os.path.join(self.path, _Y), np.asarray(self.labels, dtype=np.int8))
+
+        source_raw = os.path.join(self.path, _SOURCE_RAW)
+        with open(source_raw, encoding='utf-8') as f:
+            sources = [line.rstrip('\n') for line in f]
+        # fixed-width unicode, so source.npy can be memory-mapped too
+        np.save(os.path.join(self.path, _SOURCE), np.array(sources, dtype=np.str_) if sources else np.zeros(0, 'U1'))
+        os.remove(source_raw)
+
+        with open(os.path.join(self.path, _META), 'w') as f:
+            json.dump({'columns': self.columns, 'rows': self.count, 'flow_length': self.flow_length,
+                       'feature_version': feature_version()}, f)
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        """drop the partial dataset"""
+        self.x_raw.close()
+        self.source_raw.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def is_dataset(path):
+    """whether path is a complete dataset directory"""
+    return os.path.isfile(os.path.join(path, _META))
+
+
+def load_dataset(path, mmap=True):
+    """
+    load a dataset directory
+    :param path string: the dataset directory
+    :param mmap bool: memory-map the arrays instead of reading them
+    :return tuple: X (rows, columns), y, source and the meta dict
+    """
+    if not is_dataset(path):
+        raise ValueError('%s is not a complete dataset, no %s' % (path, _META))
+    mmap_mode = 'r' if mmap else None
+    X = np.load(os.path.join(path, _X), mmap_mode=mmap_mode)
+    y = np.load(os.path.join(path, _Y), mmap_mode=mmap_mode)
+    source = np.load(os.path.join(path, _SOURCE), mmap_mode=mmap_mode)
+    with open(os.path.join(path, _META)) as f:
+        meta = json.load(f)
+
+    return X, y, source, meta
+
+
+def _stack(arrays, tmp_dir=None):
+    """
+    stack memory-mapped arrays into one memory-mapped array, the rows are copied part by part through the page cache
+    the backing file stays on disk until the process exits, joblib workers map the array again by its file name
+    """
+    rows = sum(len(a) for a in arrays)
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=tmp_dir)
+    os.close(fd)
+    _stacked_paths.append(path)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=arrays[0].dtype, shape=(rows,) + arrays[0].shape[1:])
+
+    start = 0
+    for a in arrays:
+        out[start:start + len(a)] = a
+        start += len(a)
+
+    return out
+
+
+@atexit.register
+def _remove_stacked():
+    for path in _stacked_paths:
+        try:
+            os.remove(path)
+        except OSError:
+            # e.g. Windows cannot remove a file that is still mapped
+            pass
+
+
+def load_training_set(paths, mmap=True, tmp_dir=None):
+    """
+    load and stack several datasets, e.g. the snowflake and the normal one
+    :param paths list: dataset directories
+    :param mmap bool: memory-map the arrays, the stacked arrays are then memory-mapped too instead of held in RAM
+    :param tmp_dir string: where the stacked arrays are mapped from, the system temporary directory by default
+    :return tuple: X, y and source of all the rows
+    """
+    parts = [load_dataset(path, mmap) for path in paths]
+    if len(parts) == 1:
+        X, y, source, _ = parts[0]
+        return X, y, source
+
+    stack = (lambda arrays: _stack(arrays, tmp_dir)) if mmap else np.concatenate
+    X = stack([p[0] for p in parts])
+    y = stack([p[1] for p in parts])
+    source = stack([p[2] for p in parts])
+
+    return X, y, source
+
+
+def extract_dataset(pcap_archive, path, flow_length, label, workers=None, chunk_size=16,
+                    backend=DEFAULT_BACKEND, cache_path=None):
+    """
+    extract every pcap file in a directory into a dataset, one row per file in sorted file name order
+    :param pcap_archive string: the directory of pcap files
+    :param path string: the dataset directory
+    :param flow_length int: the first n packets
+    :param label int: SNOWFLAKE or NORMAL
+    :return count int: number of rows written
+    """
+    pcap_paths = [os.path.join(pcap_archive, pcap) for pcap in sorted(os.listdir(pcap_archive))]
+
+    with DatasetWriter(path, flow_length) as writer:
+        rows = extract_rows(pcap_paths, flow_length, workers, chunk_size, backend, cache_path)
+        for pcap_path, res in zip(pcap_paths, rows):
+            if res:
+                writer.append(res, label, pcap_path)
+
+    return writer.count
+
+
+def csv_to_dataset(csv_path, path, label, flow_length=None):
+    """
+    convert a headerless training csv written by extract_features.py into a dataset
+    :return count int: number of rows written
+    """
+    with open(csv_path, newline='') as f, DatasetWriter(path, flow_length) as writer:
+        for res in csv.reader(f):
+            if res:
+                writer.append([float(v) for v in res], label, csv_path)
+
+    return writer.count
+
+
+if __name__ == '__main__':
+
+    FLOW_LENGTH = 30
+
+    parser = argparse.ArgumentParser(description='extract a pcap archive, or convert a training csv, into a dataset')
+    parser.add_argument('source', help='a directory of pcap files, or a csv file with --from-csv')
+    parser.add_argument('path', nargs='?', default=None, help='dataset directory')
+    parser.add_argument('--label', choices=sorted(LABELS), required=True)
+    parser.add_argument('--flow-length', type=int, default=FLOW_LENGTH)
+    parser.add_argument('--from-csv', action='store_true')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=16)
+    parser.add_argument('--backend', default=DEFAULT_BACKEND)
+    parser.add_argument('--cache', default=None, help='feature cache path, e.g. ' + CACHE_PATH)
+    args = parser.parse_args()
+
+    if args.from_csv:
+        path = args.path or os.path.splitext(args.source)[0] + DATASET_SUFFIX
+        count = csv_to_dataset(args.source, path, LABELS[args.label], args.flow_length)
+    else:
+        path = args.path or dataset_name(args.source, args.flow_length)
+        count = extract_dataset(args.source, path, args.flow_length, LABELS[args.label],
+                                workers=args.workers, chunk_size=args.chunk_size,
+                                backend=args.backend, cache_path=args.cache)
+
+    print(path, count, 'OK.')
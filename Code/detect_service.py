@@ -0,0 +1,479 @@
+import os
+import sys
+import json
+import time
+import base64
+import signal
+import socket
+import asyncio
+import argparse
+import collections
+import numpy as np
+
+from Snowflake_Detection.extract_features import *
+from Snowflake_Detection.pcap_reader import read_stream, open_capture_bytes
+from Snowflake_Detection.detector import Detector, SNOWFLAKE, model_path_DT
+from Snowflake_Detection.direction import default_classifier
+from Snowflake_Detection.metrics import METRICS
+
+
+FLOW_LENGTH = 30
+
+# a batch is sent to the model when it has MAX_BATCH rows or BATCH_WINDOW seconds after its first row
+MAX_BATCH = 1024
+BATCH_WINDOW = 0.002
+
+# seconds between two checks of the model file
+RELOAD_INTERVAL = 1.0
+
+# number of recent requests the latency percentiles are computed over
+LATENCY_WINDOW = 10000
+
+
+class ModelSlot(object):
+    """
+    the model of the service, swapped as a whole when the model file changes
+    the detector and the file signature it was loaded from are replaced by one assignment,
+    a batch holding a reference to the old detector finishes with it
+    """
+    __slots__ = ('model_path', 'flow_length', 'loaded', 'failed', 'reloads', 'failed_reloads')
+
+    def __init__(self, model_path=model_path_DT, flow_length=FLOW_LENGTH):
+        super(ModelSlot, self).__init__()
+        self.model_path = model_path
+        self.flow_length = flow_length
+        self.loaded = (Detector(model_path, flow_length), self.signature())
+        # the signature of the last file that could not be loaded, it is not tried again until it changes
+        self.failed = None
+        self.reloads = 0
+        self.failed_reloads = 0
+
+    @property
+    def detector(self):
+        return self.loaded[0]
+
+    def signature(self):
+        """mtime, size and inode of the model file, train.py renames a new model into place so all three change"""
+        st = os.stat(self.model_path)
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def changed(self):
+        try:
+            signature = self.signature()
+            return signature != self.loaded[1] and signature != self.failed
+        except FileNotFoundError:
+            return False
+
+    def reload(self):
+        """
+        load the model file again, the current model stays in place when the file cannot be loaded
+        :return bool: True when the new model is in place
+        """
+        signature = None
+        try:
+            signature = self.signature()
+            detector = Detector(self.model_path, self.flow_length)
+        except Exception as e:
+            self.failed = signature
+            self.failed_reloads += 1
+            print('reload of %s failed: %s' % (self.model_path, e), file=sys.stderr)
+            return False
+
+        self.loaded = (detector, signature)
+        self.reloads += 1
+        return True
+
+
+def packet_features(packets, flow_length=FLOW_LENGTH):
+    """
+    feature vector of the first packets of a flow, the same vector extract_pcap gives for a pcap of these packets
+    :param packets iterable: records (ts, src, dst, sport, dport, proto, length), addresses packed or as strings
+    :return list: F1-F6
+    """
+    classify = default_classifier().direction
+    timestamps = []
+    sizes = []
+    directions = []
+    for pkt in packets:
+        if len(timestamps) >= flow_length:
+            break
+        ts, src, length = pkt[0], pkt[1], pkt[6]
+        if isinstance(src, str):
+            src = socket.inet_pton(socket.AF_INET6 if ':' in src else socket.AF_INET, src)
+        timestamps.append(float(ts))
+        sizes.append(int(length))
+        directions.append(classify(src))
+    if not timestamps:
+        raise ValueError('no TCP or UDP packets')
+
+    return flow_features(np.array(timestamps, dtype=np.float64), np.array(sizes, dtype=np.uint16),
+                         np.array(directions, dtype=np.int8))
+
+
+def pcap_features(data, flow_length=FLOW_LENGTH):
+    """
+    feature vector of a pcap or pcapng file sent as bytes
+    :param data bytes: the file content, possibly gzip, xz or zstd compressed
+    :return list: F1-F6
+    """
+    with open_capture_bytes(data) as f:
+        return packet_features(read_stream(f), flow_length)
+
+
+def request_vectors(request, flow_length=FLOW_LENGTH):
+    """
+    feature vectors of a request, one of
+    {"features": [...]} or {"features": [[...], ...]}: precomputed vectors
+    {"packets": [[ts, src, dst, sport, dport, proto, length], ...]}: the packets of one flow
+    {"pcap": "<base64>"}: a pcap or pcapng file
+    :param request dict: the decoded request
+    :return list: the feature vectors, one verdict is returned for each
+    """
+    if 'features' in request:
+        features = request['features']
+        if not isinstance(features, list):
+            raise ValueError('features must be a list')
+        if features and not isinstance(features[0], list):
+            features = [features]
+        # checked here, so a bad vector fails its own request and never the micro-batch it would join
+        vectors = []
+        for res in features:
+            try:
+                res = np.asarray(res, dtype=np.float64)
+            except (TypeError, ValueError):
+                raise ValueError('a feature vector must hold numbers only')
+            if res.shape != (len(FEATURE_NAMES),):
+                raise ValueError('a feature vector has shape %r, not (%d,)' % (res.shape, len(FEATURE_NAMES)))
+            if not np.isfinite(res).all():
+                raise ValueError('a feature vector holds null, NaN or infinite values')
+            vectors.append(res)
+        return vectors
+    if 'packets' in request:
+        return [packet_features(request['packets'], flow_length)]
+    if 'pcap' in request:
+        return [pcap_features(base64.b64decode(request['pcap']), flow_length)]
+
+    raise ValueError('a request needs features, packets or pcap')
+
+
+class DetectionService(object):
+    """
+    long-running detection over a Unix socket or localhost TCP, one JSON request per line and one JSON reply per line
+    the vectors of concurrent requests are grouped into micro-batches, so the model runs once for many requests
+    a connection may send requests without waiting, replies come back in request order with the id of the request
+    {"op": "stats"} returns queue depth, batch sizes and latency percentiles, {"op": "reload"} reloads the model
+    """
+    def __init__(self, model_path=model_path_DT, flow_length=FLOW_LENGTH, max_batch=MAX_BATCH,
+                 batch_window=BATCH_WINDOW, reload_interval=RELOAD_INTERVAL):
+        super(DetectionService, self).__init__()
+        self.model = ModelSlot(model_path, flow_length)
+        self.flow_length = flow_length
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.reload_interval = reload_interval
+
+        self.queue = None
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_rows = 0
+        self.max_queue_depth = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.started = time.time()
+
+    async def predict(self, vectors):
+        """
+        verdicts of feature vectors, queued for the next micro-batch
+        :param vectors list: the feature vectors
+        :return list: SNOWFLAKE or NORMAL of every vector
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for res in vectors:
+            future = loop.create_future()
+            self.queue.put_nowait((res, future))
+            futures.append(future)
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+        return await asyncio.gather(*futures)
+
+    async def _batcher(self):
+        """collect queued vectors into batches of at most max_batch rows and run the model on them"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+
+            rows, futures = zip(*batch)
+            detector = self.model.detector
+            try:
+                verdicts = detector.predict(rows).tolist()
+            except Exception:
+                # score the rows one by one, only the rows that fail alone get the error
+                verdicts = []
+                for res in rows:
+                    try:
+                        verdicts.append(int(detector.predict([res])[0]))
+                    except Exception as e:
+                        verdicts.append(e)
+
+            self.batches += 1
+            self.batched_rows += len(rows)
+            METRICS.count('service_batches')
+            for future, verdict in zip(futures, verdicts):
+                if future.done():
+                    continue
+                if isinstance(verdict, Exception):
+                    future.set_exception(verdict)
+                else:
+                    future.set_result(int(verdict))
+
+    async def _watch_model(self):
+        """reload the model when its file changes, the load runs in a thread so requests keep being served"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            if self.model.changed():
+                await loop.run_in_executor(None, self.model.reload)
+
+    async def handle(self, request):
+        """
+        reply to one decoded request
+        :return dict: the reply, with the id of the request when it has one
+        """
+        start = time.perf_counter()
+        reply = {}
+        if 'id' in request:
+            reply['id'] = request['id']
+
+        op = request.get('op', 'predict')
+        try:
+            if op == 'stats':
+                reply['stats'] = self.stats()
+                return reply
+            if op == 'reload':
+                loop = asyncio.get_running_loop()
+                reply['reloaded'] = await loop.run_in_executor(None, self.model.reload)
+                return reply
+            if op != 'predict':
+                raise ValueError('unknown op %r' % op)
+
+            if 'features' in request:
+                vectors = request_vectors(request, self.flow_length)
+            else:
+                # parsing packets is not free, keep it off the event loop
+                loop = asyncio.get_running_loop()
+                vectors = await loop.run_in_executor(None, request_vectors, request, self.flow_length)
+            verdicts = await self.predict(vectors)
+        except Exception as e:
+            self.errors += 1
+            reply['error'] = '%s: %s' % (type(e).__name__, e)
+            return reply
+
+        self.requests += 1
+        self.latencies.append(time.perf_counter() - start)
+        reply['verdicts'] = verdicts
+        reply['labels'] = ['snowflake' if v == SNOWFLAKE else 'normal' for v in verdicts]
+        return reply
+
+    async def _serve_connection(self, reader, writer):
+        """one task per request line, a writer task sends the replies in request order"""
+        pending = asyncio.Queue()
+
+        async def write_replies():
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                writer.write(json.dumps(await task).encode() + b'\n')
+                if pending.empty():
+                    await writer.drain()
+
+        replies = asyncio.ensure_future(write_replies())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('a request is a JSON object')
+                except ValueError as e:
+                    self.errors += 1
+                    done = asyncio.get_running_loop().create_future()
+                    done.set_result({'error': 'bad request: %s' % e})
+                    pending.put_nowait(done)
+                    continue
+                pending.put_nowait(asyncio.ensure_future(self.handle(request)))
+        finally:
+            pending.put_nowait(None)
+            try:
+                await replies
+            except ConnectionError:
+                pass
+            writer.close()
+
+    def stats(self):
+        """queue depth, batch sizes, request latency percentiles in milliseconds and model reloads"""
+        res = {'requests': self.requests, 'errors': self.errors, 'queue_depth': self.queue.qsize() if self.queue else 0,
+               'max_queue_depth': self.max_queue_depth, 'batches': self.batches,
+               'mean_batch': round(self.batched_rows / self.batches, 2) if self.batches else 0,
+               'reloads': self.model.reloads, 'failed_reloads': self.model.failed_reloads,
+               'uptime_s': round(time.time() - self.started, 1)}
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            for q in (50, 90, 99):
+                res['latency_p%d_ms' % q] = round(float(np.percentile(latencies, q)), 3)
+            res['latency_max_ms'] = round(float(latencies.max()), 3)
+
+        return res
+
+    async def serve(self, unix_path=None, host='127.0.0.1', port=None):
+        """
+        serve until SIGINT or SIGTERM
+        :param unix_path string: a Unix socket path, used when given
+        :param host, port: the TCP address otherwise
+        """
+        self.queue = asyncio.Queue()
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            server = await asyncio.start_unix_server(self._serve_connection, unix_path, limit=1 << 26)
+        else:
+            server = await asyncio.start_server(self._serve_connection, host, port, limit=1 << 26)
+
+        tasks = [asyncio.ensure_future(self._batcher())]
+        if self.reload_interval:
+            tasks.append(asyncio.ensure_future(self._watch_model()))
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if unix_path and os.path.exists(unix_path):
+                os.remove(unix_path)
+
+
+async def _open(unix_path=None, host='127.0.0.1', port=None):
+    if unix_path:
+        return await asyncio.open_unix_connection(unix_path, limit=1 << 26)
+    return await asyncio.open_connection(host, port, limit=1 << 26)
+
+
+async def query(requests, unix_path=None, host='127.0.0.1', port=None):
+    """
+    send requests over one connection without waiting between them
+    :param requests list: request dicts
+    :return list: the replies, in request order
+    """
+    reader, writer = await _open(unix_path, host, port)
+    writer.write(b''.join(json.dumps(request).encode() + b'\n' for request in requests))
+    await writer.drain()
+    replies = [json.loads(await reader.readline()) for _ in requests]
+    writer.close()
+
+    return replies
+
+
+async def load_test(vectors, requests, concurrency, unix_path=None, host='127.0.0.1', port=None):
+    """
+    send single-vector requests from concurrent connections, to size the service for a request rate
+    :param vectors list: feature vectors, sent round robin
+    :param requests int: total number of requests
+    :param concurrency int: number of connections, each with one request in flight
+    :return dict: requests per second and client side latency percentiles in milliseconds
+    """
+    latencies = []
+
+    async def client(n):
+        reader, writer = await _open(unix_path, host, port)
+        for i in range(n):
+            start = time.perf_counter()
+            writer.write(json.dumps({'id': i, 'features': vectors[i % len(vectors)]}).encode() + b'\n')
+            await writer.drain()
+            await reader.readline()
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    share = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    await asyncio.gather(*[client(n) for n in share if n])
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {'requests': len(latencies), 'seconds': round(elapsed, 3), 'requests_per_s': round(len(latencies) / elapsed, 1),
+            'latency_p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'latency_p99_ms': round(float(np.percentile(latencies, 99)), 3)}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='detection service, JSON lines over a Unix socket or localhost TCP')
+    parser.add_argument('--unix', default=None, help='Unix socket path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    serve_parser = sub.add_parser('serve', help='run the service')
+    serve_parser.add_argument('--model', default=model_path_DT)
+    serve_parser.add_argument('--flow-length', type=int, default=FLOW_LENGTH)
+    serve_parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    serve_parser.add_argument('--batch-window', type=float, default=BATCH_WINDOW,
+                              help='seconds a batch waits for more requests after its first one')
+    serve_parser.add_argument('--reload-interval', type=float, default=RELOAD_INTERVAL,
+                              help='seconds between checks of the model file, 0 to never reload')
+
+    query_parser = sub.add_parser('query', help='verdicts of pcap files')
+    query_parser.add_argument('pcaps', nargs='+')
+
+    stats_parser = sub.add_parser('stats', help='queue depth and latency of a running service')
+
+    load_parser = sub.add_parser('load', help='load test with the rows of a feature csv file')
+    load_parser.add_argument('csv_path')
+    load_parser.add_argument('--requests', type=int, default=10000)
+    load_parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    address = {'unix_path': args.unix, 'host': args.host, 'port': args.port}
+    if args.mode == 'serve':
+        service = DetectionService(args.model, args.flow_length, args.max_batch, args.batch_window,
+                                   args.reload_interval)
+        print('serving', args.unix or '%s:%d' % (args.host, args.port))
+        sys.stdout.flush()
+        asyncio.run(service.serve(**address))
+        print(service.stats())
+    elif args.mode == 'query':
+        requests = []
+        for pcap_path in args.pcaps:
+            with open(pcap_path, 'rb') as f:
+                requests.append({'id': pcap_path, 'pcap': base64.b64encode(f.read()).decode()})
+        for reply in asyncio.run(query(requests, **address)):
+            print(reply['id'], reply.get('error') or reply['labels'][0])
+    elif args.mode == 'stats':
+        print(asyncio.run(query([{'op': 'stats'}], **address))[0]['stats'])
+    else:
+        with open(args.csv_path) as f:
+            vectors = [[float(x) for x in line.split(',')] for line in f if line.strip()]
+        print(asyncio.run(load_test(vectors, args.requests, args.concurrency, **address)))
+        print(asyncio.run(query([{'op': 'stats'}], **address))[0]['stats'])
@@ -0,0 +1,214 @@
+import os
+import functools
+import multiprocessing
+import numpy as np
+
+from Snowflake_Detection.extract_features import *
+from Snowflake_Detection.compiled_tree import load_model
+from Snowflake_Detection.metrics import METRICS
+
+
+SNOWFLAKE = 1
+NORMAL = 0
+
+model_path_DT = 'DT.pkl'
+
+
+class Detector(object):
+    """
+    a trained model loaded once, scoring many flows in large batches
+    a decision tree is compiled into a CompiledTree unless compile is False
+    with lazy and no feature cache, flows are scored one at a time and only the feature groups the tree reads are computed
+    """
+    def __init__(self, model_path=model_path_DT, flow_length=30, batch_size=4096,
+                 workers=1, chunk_size=16, backend=DEFAULT_BACKEND, cache_path=None, compile=True, lazy=False):
+        super(Detector, self).__init__()
+        self.model_path = model_path
+        with METRICS.timer('model_load'):
+            self.model = load_model(model_path, compile)
+        self.flow_length = flow_length
+        self.batch_size = batch_size
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.backend = backend
+        self.cache_path = cache_path
+        self.lazy = lazy
+        # flows scored lazily and the feature columns computed for them
+        self.lazy_flows = 0
+        self.lazy_computed = 0
+
+    def predict(self, X):
+        """
+        verdicts of a batch of feature vectors
+        :param X array: the matrix of feature vectors, one row per flow
+        :return ndarray: SNOWFLAKE or NORMAL of every row
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if len(X) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        with METRICS.timer('predict'):
+            verdicts = self.model.predict(X)
+        METRICS.count('flows_predicted', len(X))
+
+        return verdicts
+
+    def predict_one(self, res):
+        """
+        verdict of a single feature vector, without the batch overhead
+        :param res list: the feature vector
+        :return int: SNOWFLAKE or NORMAL
+        """
+        if hasattr(self.model, 'predict_one'):
+            with METRICS.timer('predict_one'):
+                verdict = self.model.predict_one(res)
+            METRICS.count('flows_predicted')
+            return verdict
+
+        return self.predict([res])[0]
+
+    def predict_lazy(self, features):
+        """
+        verdict of a lazily computed feature vector
+        :param features LazyFeatures: e.g. LazyFeatures.from_arrays or FlowAccumulator.lazy_features
+        :return int: SNOWFLAKE or NORMAL, the same as predict_one of the whole vector
+        """
+        verdict = _predict_lazy(self.model, features)
+        self._count_lazy(features.computed)
+        return verdict
+
+    def _count_lazy(self, computed, flows=1):
+        self.lazy_flows += flows
+        self.lazy_computed += computed
+        METRICS.count('flows_predicted', flows)
+        METRICS.count('feature_columns_computed', computed)
+        METRICS.count('feature_columns_avoided', flows * len(FEATURE_NAMES) - computed)
+
+    def lazy_report(self):
+        """feature columns computed and avoided by lazy scoring, and the feature groups the model can reach"""
+        total = self.lazy_flows * len(FEATURE_NAMES)
+        res = {'flows': self.lazy_flows, 'columns_computed': self.lazy_computed,
+               'columns_avoided': total - self.lazy_computed,
+               'avoided_percentage': round((total - self.lazy_computed) / total * 100, 2) if total else 0.0}
+        if hasattr(self.model, 'used_features'):
+            res['reachable_groups'] = feature_groups(self.model.used_features())
+
+        return res
+
+    def predict_flows(self, flows):
+        """
+        verdicts of a list of flows
+        :param flows list: Flow objects (or lists of PacketMeta)
+        :return ndarray: SNOWFLAKE or NORMAL of every flow
+        """
+        return self.predict([flow_features(*flow_arrays(flow)) for flow in flows])
+
+    def score_files(self, pcap_paths):
+        """
+        verdict of every pcap file, features are extracted in order and predicted batch_size rows at a time
+        :param pcap_paths list: paths of pcap files
+        :return list: (pcap_path, verdict) in the order of pcap_paths
+        """
+        pcap_paths = list(pcap_paths)
+        if self.lazy and self.cache_path is None:
+            return list(zip(pcap_paths, self._score_files_lazy(pcap_paths)))
+
+        verdicts = []
+        batch = []
+        rows = extract_rows(pcap_paths, self.flow_length, self.workers, self.chunk_size, self.backend, self.cache_path)
+        for res in rows:
+            batch.append(res)
+            if len(batch) >= self.batch_size:
+                verdicts.extend(self.predict(batch).tolist())
+                batch = []
+        if batch:
+            verdicts.extend(self.predict(batch).tolist())
+
+        return list(zip(pcap_paths, verdicts))
+
+    def _score_files_lazy(self, pcap_paths):
+        """verdicts of pcap files scored one by one with lazy features, in the order of pcap_paths"""
+        score = functools.partial(_score_lazy, model=self.model, flow_length=self.flow_length, backend=self.backend)
+        if self.workers == 1:
+            results = map(score, pcap_paths)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(self.workers)
+            results = pool.imap(score, pcap_paths, chunksize=self.chunk_size)
+
+        verdicts = []
+        finished = False
+        try:
+            for verdict, computed in results:
+                self._count_lazy(computed)
+                verdicts.append(verdict)
+            finished = True
+        finally:
+            if pool is not None:
+                if finished:
+                    pool.close()
+                else:
+                    # a worker raised, drop the files still queued as extract_rows does
+                    pool.terminate()
+                pool.join()
+
+        return verdicts
+
+    def score_archive(self, pcap_dir):
+        """
+        verdicts of every pcap file in a directory
+        :param pcap_dir string: the directory of pcap files
+        :return tuple: list of (pcap_path, verdict) in sorted file name order, rate of SNOWFLAKE verdicts
+        """
+        pcap_paths = [os.path.join(pcap_dir, pcap) for pcap in sorted(os.listdir(pcap_dir))]
+        verdicts = self.score_files(pcap_paths)
+
+        return verdicts, archive_rate(verdicts)
+
+
+def _predict_lazy(model, features):
+    """class of a LazyFeatures, the whole vector is computed for models that cannot walk it lazily"""
+    if hasattr(model, 'predict_lazy'):
+        return model.predict_lazy(features)
+    return model.predict(np.asarray([features.vector()], dtype=np.float64))[0]
+
+
+def _score_lazy(pcap_path, model, flow_length, backend):
+    """worker side of Detector.score_files with lazy features"""
+    flow = extract_flow(pcap_path, flow_length, backend)
+    features = LazyFeatures.from_arrays(*flow_arrays(flow))
+    return _predict_lazy(model, features), features.computed
+
+
+def archive_rate(verdicts):
+    """
+    rate of SNOWFLAKE verdicts, FPR on normal traffic and recall on Snowflake traffic
+    :param verdicts list: (pcap_path, verdict)
+    :return float: the rate, 0 for an empty archive
+    """
+    if not verdicts:
+        return 0.0
+
+    return float(sum(1 for _, verdict in verdicts if verdict == SNOWFLAKE) / len(verdicts))
+
+
+def score_archives(detector, pcap_archive):
+    """
+    per-archive rates of a directory of archives, the summary printed by test_fpr.py and test_recall.py
+    :param detector Detector: the loaded detector
+    :param pcap_archive string: a directory whose sub-directories are pcap archives
+    :return list: (archive, number of pcaps, rate) in sorted archive name order
+    """
+    # DT for DT.pkl, KNN for KNN.pkl of compare_models.py --save
+    name = os.path.splitext(os.path.basename(detector.model_path))[0]
+    res = []
+    for archive in sorted(os.listdir(pcap_archive)):
+        print(archive, end=' ')
+        verdicts, rate = detector.score_archive(os.path.join(pcap_archive, archive))
+        print("total: %d" % len(verdicts))
+        print("%s %f" % (name, rate))
+        res.append((archive, len(verdicts), rate))
+
+    return res
@@ -0,0 +1,153 @@
+import os
+import zlib
+import ipaddress
+import numpy as np
+
+
+UPSTREAM = 1
+DOWNSTREAM = -1
+
+# private IPv4 ranges (RFC 1918), IPv6 unique local and link-local addresses
+DEFAULT_SUBNETS = ('10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', 'fc00::/7', 'fe80::/10')
+
+# comma separated client subnets replacing the defaults, e.g. SNOWDT_CLIENT_SUBNETS=10.0.0.0/8,100.64.0.0/10
+ENV_VAR = 'SNOWDT_CLIENT_SUBNETS'
+
+# addresses remembered by is_local, a capture only has a handful of them
+_CACHE_SIZE = 65536
+
+_MASK64 = (1 << 64) - 1
+
+
+class DirectionClassifier(object):
+    """
+    label packets by their source address against a set of client subnets, compiled once into integer prefixes
+    a packet from a client subnet is UPSTREAM, any other packet is DOWNSTREAM
+    :subnets the client subnets, normalized CIDR strings
+    """
+    __slots__ = ('subnets', '_v4', '_v6', '_cache')
+
+    def __init__(self, subnets=DEFAULT_SUBNETS):
+        super(DirectionClassifier, self).__init__()
+        networks = [ipaddress.ip_network(subnet, strict=False) for subnet in subnets]
+        self.subnets = tuple(str(network) for network in networks)
+
+        # prefix length -> set of network prefixes, one set lookup per distinct prefix length
+        v4 = {}
+        v6 = {}
+        for network in networks:
+            prefixes = v4 if network.version == 4 else v6
+            bits = network.max_prefixlen - network.prefixlen
+            prefixes.setdefault(bits, set()).add(int(network.network_address) >> bits)
+        self._v4 = sorted(v4.items())
+        self._v6 = sorted(v6.items())
+        self._cache = {}
+
+    @classmethod
+    def from_env(cls):
+        """the subnets of SNOWDT_CLIENT_SUBNETS, the defaults when it is not set"""
+        subnets = os.environ.get(ENV_VAR)
+        if not subnets:
+            return cls()
+        return cls([subnet.strip() for subnet in subnets.split(',') if subnet.strip()])
+
+    def is_default(self):
+        return self.subnets == DirectionClassifier().subnets
+
+    def fingerprint(self):
+        """a stable integer of the subnets, to tell feature vectors of different subnets apart"""
+        return zlib.crc32(','.join(self.subnets).encode())
+
+    def is_local(self, ip):
+        """
+        is the address in a client subnet
+        :param ip bytes: packed address, 4 bytes for IPv4 or 16 bytes for IPv6
+        :return bool
+        """
+        local = self._cache.get(ip)
+        if local is None:
+            value = int.from_bytes(ip, 'big')
+            prefixes = self._v4 if len(ip) == 4 else self._v6
+            local = any((value >> bits) in networks for bits, networks in prefixes)
+            if len(self._cache) >= _CACHE_SIZE:
+                self._cache.clear()
+            self._cache[ip] = local
+
+        return local
+
+    def direction(self, ip):
+        """UPSTREAM for a packet sent from a client subnet, DOWNSTREAM otherwise"""
+        return UPSTREAM if self.is_local(ip) else DOWNSTREAM
+
+    def is_local_v4(self, addresses):
+        """
+        vectorized is_local of IPv4 addresses
+        :param addresses array: addresses as unsigned integers
+        :return ndarray: bool of every address
+        """
+        addresses = np.asarray(addresses, dtype=np.uint32)
+        local = np.zeros(addresses.shape, dtype=bool)
+        for bits, networks in self._v4:
+            shifted = addresses >> np.uint32(bits) if bits < 32 else np.zeros_like(addresses)
+            local |= np.isin(shifted, np.fromiter(networks, dtype=np.uint32))
+
+        return local
+
+    def is_local_v6(self, high, low):
+        """
+        vectorized is_local of IPv6 addresses split into their upper and lower 64 bits
+        :param high, low array: unsigned 64-bit halves of every address
+        :return ndarray: bool of every address
+        """
+        high = np.asarray(high, dtype=np.uint64)
+        low = np.asarray(low, dtype=np.uint64)
+        local = np.zeros(high.shape, dtype=bool)
+        for bits, networks in self._v6:
+            networks = list(networks)
+            if bits >= 64:
+                # only the upper half is compared
+                shift = bits - 64
+                shifted = high >> np.uint64(shift) if shift < 64 else np.zeros_like(high)
+                local |= np.isin(shifted, np.array(networks, dtype=np.uint64))
+            else:
+                upper = np.array([n >> (64 - bits) for n in networks], dtype=np.uint64)
+                lower = np.array([n & (_MASK64 >> bits) for n in networks], dtype=np.uint64)
+                shifted = low >> np.uint64(bits)
+                for u, l in zip(upper, lower):
+                    local |= (high == u) & (shifted == l)
+
+        return local
+
+    def is_local_many(self, addresses):
+        """
+        vectorized is_local of a batch of packed addresses, IPv4 and IPv6 may be mixed
+        :param addresses list: packed addresses, e.g. the sources of the records of pcap_reader.read_packets
+        :return ndarray: bool of every address
+        """
+        local = np.zeros(len(addresses), dtype=bool)
+        v4 = [i for i, ip in enumerate(addresses) if len(ip) == 4]
+        if v4:
+            packed = np.frombuffer(b''.join(addresses[i] for i in v4), dtype='>u4')
+            local[v4] = self.is_local_v4(packed)
+        if len(v4) < len(addresses):
+            v6 = [i for i, ip in enumerate(addresses) if len(ip) == 16]
+            if v6:
+                halves = np.frombuffer(b''.join(addresses[i] for i in v6), dtype='>u8').reshape(-1, 2)
+                local[v6] = self.is_local_v6(halves[:, 0], halves[:, 1])
+
+        return local
+
+    def directions(self, addresses):
+        """vectorized direction of a batch of packed source addresses, an int8 array of UPSTREAM / DOWNSTREAM"""
+        return np.where(self.is_local_many(addresses), UPSTREAM, DOWNSTREAM).astype(np.int8)
+
+
+_default = None
+
+
+def default_classifier():
+    """the classifier of this process, built once from SNOWDT_CLIENT_SUBNETS or the default subnets"""
+    global _default
+    if _default is None:
+        _default = DirectionClassifier.from_env()
+    return _default
@@ -4,9 +4,20 @@ import socket
 import csv
 import time
 import math
+import array
+import bisect
+import argparse
+import functools
+import operator
+import multiprocessing
 import numpy as np
 from collections import Counter
 
+from Snowflake_Detection.pcap_reader import read_packets, DEFAULT_BACKEND
+from Snowflake_Detection.feature_cache import FeatureCache, file_digest, CACHE_PATH
+from Snowflake_Detection.metrics import METRICS, measured
+from Snowflake_Detection.direction import default_classifier
+
 
 UPSTREAM = 1
 BOTH = 0
@@ -14,6 +25,16 @@ DOWNSTREAM = -1
 
 PADDING = -1
 
+# bump whenever a feature definition changes, cached vectors of other versions are ignored
+# 2: directions from the client subnets of direction.py instead of string prefixes
+FEATURE_VERSION = 2
+
+# column names of the vector returned by flow_features
+FEATURE_NAMES = (['up_bin_%d' % k for k in range(1, 30)] + ['down_bin_%d' % k for k in range(1, 30)] +
+                 ['up_top%d_size' % k for k in range(1, 6)] + ['down_top%d_size' % k for k in range(1, 6)] +
+                 ['up_top%d_percentage' % k for k in range(1, 6)] + ['down_top%d_percentage' % k for k in range(1, 6)] +
+                 ['up_sum', 'down_sum', 'up_percentage', 'down_percentage', 'direction_ratio'])
+
 
 class PacketMeta(object):
     """
@@ -29,90 +50,117 @@ class PacketMeta(object):
         self.direction = 0
 
 
+class Flow(object):
+    """
+    the structure of a flow, stored as typed columns instead of one PacketMeta per packet
+    :timestamp float64 array, the captured time
+    :size uint16 array, TCP payload length
+    :direction int8 array, 1: c2s, -1: s2c
+    """
+    __slots__ = ('timestamp', 'size', 'direction')
+
+    def __init__(self, timestamp=(), size=(), direction=()):
+        super(Flow, self).__init__()
+        self.timestamp = np.asarray(timestamp, dtype=np.float64)
+        self.size = np.asarray(size, dtype=np.uint16)
+        self.direction = np.asarray(direction, dtype=np.int8)
+
+    @classmethod
+    def from_packets(cls, packets):
+        """build a flow from a list of PacketMeta"""
+        return cls([p.timestamp for p in packets], [p.size for p in packets], [p.direction for p in packets])
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Flow(self.timestamp[index], self.size[index], self.direction[index])
+        pkt = PacketMeta()
+        pkt.timestamp = float(self.timestamp[index])
+        pkt.size = int(self.size[index])
+        pkt.direction = int(self.direction[index])
+        return pkt
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 def LocalIP(ip):
-    """label local IP, especially of client"""
-    if ip[0:3] == "10." or ip[0:4] == "172." or ip[0:4] == "192.":
-        return True
-    else:
-        return False
+    """label local IP, especially of client, ip is an address string, see direction.py for the client subnets"""
+    return default_classifier().is_local(socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip))
+
 
+def feature_version():
+    """
+    FEATURE_VERSION, mixed with the client subnets when they are not the defaults,
+    so cached vectors labeled with other subnets are never returned
+    """
+    classifier = default_classifier()
+    if classifier.is_default():
+        return FEATURE_VERSION
+    return FEATURE_VERSION + (classifier.fingerprint() << 8)
 
-def extract_flow(pcap_path, packet_sum):
+
+def extract_flow(pcap_path, packet_sum, backend=DEFAULT_BACKEND):
     """
     extract every packet's information to form a flow
     :param pcap_path string: a given path of pacp file
     :param packet_sum int: the first n packets
-    :return flow list: packet information list of a flow
+    :param backend string: pcap reader backend, 'fast' or 'dpkt'
+    :return flow Flow: packet information columns of a flow
     """
-    flow = []
+    timestamps = array.array('d')
+    sizes = array.array('H')
+    directions = array.array('b')
     packet_count = 0
 
-    f = open(pcap_path, 'rb')
-    pcap = dpkt.pcap.Reader(f)
-    for ts, buf in pcap:
-        time = ts
-
-        eth = dpkt.ethernet.Ethernet(buf)
-        ip = eth.data
-        tcp = ip.data
-
-        if hasattr(ip, 'src') and hasattr(ip, 'dst'):
-            try:
-                sip = socket.inet_ntop(socket.AF_INET, ip.src)
-                dip = socket.inet_ntop(socket.AF_INET, ip.dst)
-            except Exception as e:
-                sip = socket.inet_ntop(socket.AF_INET6, ip.src)
-                dip = socket.inet_ntop(socket.AF_INET6, ip.dst)
-
-        sport = tcp.sport
-        dport = tcp.dport
+    # the time spent labeling directions is split from the time spent reading packets
+    timed = METRICS.enabled
+    start = label_time = 0.0
+    if timed:
+        start = time.perf_counter()
 
+    classify = default_classifier().direction
+    packets = read_packets(pcap_path, backend)
+    for ts, src, dst, sport, dport, proto, length in packets:
         packet_count += 1
         if packet_count > packet_sum:
             break
 
-        direction = UPSTREAM if (LocalIP(sip)) else DOWNSTREAM
-        length = len(tcp.data)
+        if timed:
+            label_start = time.perf_counter()
+        direction = classify(src)
+        if timed:
+            label_time += time.perf_counter() - label_start
 
-        pkt = PacketMeta()
-        pkt.timestamp = time
-        pkt.size = length
-        pkt.direction = direction
+        timestamps.append(ts)
+        sizes.append(length)
+        directions.append(direction)
 
-        flow.append(pkt)
+    packets.close()
 
-    f.close()
+    if timed:
+        METRICS.add_time('read', time.perf_counter() - start - label_time)
+        METRICS.add_time('direction', label_time)
+        METRICS.count('files')
+        METRICS.count('packets', len(timestamps))
 
-    return flow
+    return Flow(np.frombuffer(timestamps, dtype=np.float64),
+                np.frombuffer(sizes, dtype=np.uint16),
+                np.frombuffer(directions, dtype=np.int8))
 
 
 def time_bins(flow, direction):
     """
     percentage of intervals between packets in a given direction that falls in to a given bin
-    :param flow list: a flow contain a series of packets
+    :param flow Flow: a flow contain a series of packets
     :param direction int: a given direction
     :return res list: percentage of every bin
     """
-    _tmp = []
-    for p in flow:
-        if p.direction == direction:
-            _tmp.append(p.timestamp)
-        else:
-            continue
-
-    data = [(y - x) * 1000 for x, y in zip(_tmp, _tmp[1:])]
-    bins = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000])
-    if not data:
-        return [0] * 29
-    digitized = np.digitize(data, bins)
-    tmp = Counter(digitized)
-    total = len(data)
-    res = []
-    for k in range(1, 30):
-        if k not in tmp:
-            res.append(0)
-        else:
-            res.append(round(float(tmp[k]) / total, 2))
+    timestamps, sizes, directions = flow_arrays(flow)
+    res = _time_bins_vec(timestamps[directions == direction])
 
     return res
 
@@ -120,22 +168,12 @@ def time_bins(flow, direction):
 def top5_size(flow, direction):
     """
     packet size distribution in a given direction
-    :param flow list: a flow contain a series of packets
+    :param flow Flow: a flow contain a series of packets
     :param direction int: a given direction
     :return res list: the top 5 most seen packet size
     """
-    _size = []
-    for p in flow:
-        if p.direction == direction:
-            _size.append(p.size)
-        else:
-            continue
-    r = Counter(_size)
-    res = sorted(r.items(), key=lambda x:x[1], reverse=True)[:5]
-    res = [v[0] for v in res]
-
-    if len(res) < 5:
-        res += [PADDING] * (5 - len(res))
+    timestamps, sizes, directions = flow_arrays(flow)
+    res, _ = _top5_vec(sizes[directions == direction])
 
     return res
 
@@ -143,24 +181,12 @@ def top5_size(flow, direction):
 def top5_size_percentage(flow, direction):
     """
     packet size distribution in a given direction
-    :param flow list: a flow contain a series of packets
+    :param flow Flow: a flow contain a series of packets
     :param direction int: a given direction
     :return res list: the top 5 most seen packet size's percentage
     """
-    _size = []
-    for p in flow:
-        if p.direction == direction:
-            _size.append(p.size)
-        else:
-            continue
-    r = Counter(_size)
-    total = sum(r.values())
-    res = sorted(r.items(), key=lambda x:x[1], reverse=True)[:5]
-    res = [(v[0], round(float(v[1]) / total * 100, 2)) for v in res]
-    res = [v[1] for v in res]
-
-    if len(res) < 5:
-        res += [PADDING] * (5 - len(res))
+    timestamps, sizes, directions = flow_arrays(flow)
+    _, res = _top5_vec(sizes[directions == direction])
 
     return res
 
@@ -168,15 +194,12 @@ def top5_size_percentage(flow, direction):
 def direction_sum(flow, direction):
     """
     total number of packets in a given direction
-    :param flow list: a flow contain a series of packets
+    :param flow Flow: a flow contain a series of packets
     :param direction int: a given direction
     :return res int: total number of packets
     """
-    count = 0
-    for p in flow:
-        if p.direction == direction:
-            count += 1
-    res = count
+    timestamps, sizes, directions = flow_arrays(flow)
+    res = int(np.count_nonzero(directions == direction))
 
     return res
 
@@ -185,15 +208,13 @@ def direction_percentage(flow, direction):
     """
     percentage of packets in a given direction
     packet size distribution in a given direction
-    :param flow list: a flow contain a series of packets
+    :param flow Flow: a flow contain a series of packets
     :param direction int: a given direction
     :return res float: percentage of packets in a given direction
     """
-    count = 0
-    sum = len(flow)
-    for p in flow:
-        if p.direction == direction:
-            count += 1
+    timestamps, sizes, directions = flow_arrays(flow)
+    count = int(np.count_nonzero(directions == direction))
+    sum = len(directions)
     res = round(count / sum * 100, 2)
 
     return res
@@ -202,17 +223,13 @@ def direction_percentage(flow, direction):
 def direction_ratio(flow, direction):
     """
     direction ratio
-    :param flow list: a flow contain a series of packets
+    :param flow Flow: a flow contain a series of packets
     :param direction int: a given direction
     :return res float: down/up
     """
-    up_count = 0
-    down_count = 0
-    for p in flow:
-        if p.direction == UPSTREAM:
-            up_count += 1
-        if p.direction == DOWNSTREAM:
-            down_count += 1
+    timestamps, sizes, directions = flow_arrays(flow)
+    up_count = int(np.count_nonzero(directions == UPSTREAM))
+    down_count = int(np.count_nonzero(directions == DOWNSTREAM))
     if up_count == 0:
         res = -1
     else:
@@ -221,47 +238,450 @@ def direction_ratio(flow, direction):
     return res
 
 
+TIME_BINS = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000])
+_TIME_BINS = TIME_BINS.tolist()
+
+# flows of at most this many packets are computed with plain Python, numpy's per-call overhead dominates below it
+SHORT_FLOW = 64
+
+_second = operator.itemgetter(1)
+
+
+def flow_arrays(flow):
+    """
+    get the column arrays of a flow
+    :param flow Flow: a flow, or a list of PacketMeta
+    :return tuple: timestamp, size and direction arrays
+    """
+    if isinstance(flow, Flow):
+        return flow.timestamp, flow.size, flow.direction
+
+    timestamps = np.array([p.timestamp for p in flow], dtype=np.float64)
+    sizes = np.array([p.size for p in flow], dtype=np.int64)
+    directions = np.array([p.direction for p in flow], dtype=np.int64)
+
+    return timestamps, sizes, directions
+
+
+def _time_bins_vec(timestamps):
+    """F1 over the timestamps of one direction"""
+    if len(timestamps) < 2:
+        return [0] * 29
+    data = np.diff(timestamps) * 1000
+    tmp = np.bincount(np.digitize(data, TIME_BINS), minlength=30)
+    total = len(data)
+    return [0 if tmp[k] == 0 else round(float(tmp[k]) / total, 2) for k in range(1, 30)]
+
+
+def _top5_vec(sizes):
+    """F2 and F3 over the sizes of one direction"""
+    if len(sizes) == 0:
+        return [PADDING] * 5, [PADDING] * 5
+    values, first, counts = np.unique(sizes, return_index=True, return_counts=True)
+    # most seen first, ties keep the order of first appearance (as Counter does)
+    order = np.lexsort((first, -counts))[:5]
+    total = len(sizes)
+    top = values[order].tolist()
+    percentage = [round(float(c) / total * 100, 2) for c in counts[order].tolist()]
+
+    if len(top) < 5:
+        top += [PADDING] * (5 - len(top))
+        percentage += [PADDING] * (5 - len(percentage))
+
+    return top, percentage
+
+
+def _time_bins_py(timestamps):
+    """F1 over the timestamps of one direction, same result as _time_bins_vec"""
+    if len(timestamps) < 2:
+        return [0] * 29
+    tmp = [0] * 30
+    for x, y in zip(timestamps, timestamps[1:]):
+        # the bin np.digitize gives
+        tmp[bisect.bisect_right(_TIME_BINS, (y - x) * 1000)] += 1
+    total = len(timestamps) - 1
+    return [round(c / total, 2) if c else 0 for c in tmp[1:]]
+
+
+def _top5_py(sizes):
+    """F2 and F3 over the sizes of one direction, same result as _top5_vec"""
+    if not sizes:
+        return [PADDING] * 5, [PADDING] * 5
+    # a stable sort, ties keep the order of first appearance
+    common = sorted(Counter(sizes).items(), key=_second, reverse=True)[:5]
+    total = len(sizes)
+    top = [v for v, c in common]
+    percentage = [round(c / total * 100, 2) for v, c in common]
+
+    if len(top) < 5:
+        top += [PADDING] * (5 - len(top))
+        percentage += [PADDING] * (5 - len(percentage))
+
+    return top, percentage
+
+
+def _flow_features_py(timestamps, sizes, directions):
+    """flow_features of a short flow, one loop over python lists"""
+    times = [[], []]
+    lengths = [[], []]
+    for t, n, d in zip(timestamps, sizes, directions):
+        if d == UPSTREAM:
+            times[0].append(t)
+            lengths[0].append(n)
+        elif d == DOWNSTREAM:
+            times[1].append(t)
+            lengths[1].append(n)
+
+    f1 = []
+    f2 = []
+    f3 = []
+    for i in range(2):
+        f1 += _time_bins_py(times[i])
+        top, percentage = _top5_py(lengths[i])
+        f2 += top
+        f3 += percentage
+
+    # F4-F6
+    return f1 + f2 + f3 + _counts_vec(len(times[0]), len(times[1]), len(directions))
+
+
+def flow_features(timestamps, sizes, directions):
+    """
+    compute F1-F6 in both directions with one pass over the flow arrays,
+    the result is identical to calling every feature function one by one
+    flows of at most SHORT_FLOW packets are computed with plain Python, longer ones with numpy
+    :param ndarray timestamps: the captured time of every packet
+    :param ndarray sizes: TCP payload length of every packet
+    :param ndarray directions: direction of every packet
+    :return res list: the feature vector of a flow
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    sizes = np.asarray(sizes)
+    directions = np.asarray(directions)
+    if len(directions) <= SHORT_FLOW:
+        return _flow_features_py(timestamps.tolist(), sizes.tolist(), directions.tolist())
+
+    masks = [directions == UPSTREAM, directions == DOWNSTREAM]
+    counts = [int(np.count_nonzero(m)) for m in masks]
+    total = len(directions)
+
+    f1 = []
+    f2 = []
+    f3 = []
+    for m in masks:
+        f1 += _time_bins_vec(timestamps[m])
+        top, percentage = _top5_vec(sizes[m])
+        f2 += top
+        f3 += percentage
+
+    # F4-F6
+    return f1 + f2 + f3 + _counts_vec(counts[0], counts[1], total)
+
+
+def _counts_vec(up_count, down_count, total):
+    """F4, F5 and F6 from the packet counts"""
+    # F4
+    f4 = [up_count, down_count]
+    # F5
+    f5 = [round(c / total * 100, 2) for c in f4]
+    # F6
+    f6 = [-1] if up_count == 0 else [round(down_count / up_count * 100, 2)]
+
+    return f4 + f5 + f6
+
+
+# the columns of the feature vector computed together, one call per group
+FEATURE_GROUPS = (('up_time_bins', tuple(range(0, 29))),
+                  ('down_time_bins', tuple(range(29, 58))),
+                  ('up_top5', tuple(range(58, 63)) + tuple(range(68, 73))),
+                  ('down_top5', tuple(range(63, 68)) + tuple(range(73, 78))),
+                  ('counts', tuple(range(78, 83))))
+
+_GROUP_OF = [0] * len(FEATURE_NAMES)
+for _group, (_, _columns) in enumerate(FEATURE_GROUPS):
+    for _column in _columns:
+        _GROUP_OF[_column] = _group
+
+
+def feature_groups(columns):
+    """names of the groups holding the given columns, e.g. the columns a decision tree tests"""
+    groups = set(_GROUP_OF[column] for column in columns)
+    return [FEATURE_GROUPS[group][0] for group in sorted(groups)]
+
+
+class LazyFeatures(object):
+    """
+    a feature vector whose groups of columns are computed the first time one of their columns is read,
+    a decision tree reads only the columns tested on the path to its leaf
+    :computed number of columns computed so far
+    """
+    __slots__ = ('_compute', '_values', 'computed')
+
+    def __init__(self, compute):
+        """
+        :param compute list: one function per FEATURE_GROUPS entry, returning the values of the group columns in order
+        """
+        super(LazyFeatures, self).__init__()
+        self._compute = compute
+        self._values = [None] * len(FEATURE_NAMES)
+        self.computed = 0
+
+    @classmethod
+    def from_arrays(cls, timestamps, sizes, directions):
+        """lazy flow_features of the flow arrays, every column read is identical to flow_features"""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        sizes = np.asarray(sizes)
+        directions = np.asarray(directions)
+        up = directions == UPSTREAM
+        down = directions == DOWNSTREAM
+
+        def top5(mask):
+            top, percentage = _top5_vec(sizes[mask])
+            return top + percentage
+
+        return cls([lambda: _time_bins_vec(timestamps[up]),
+                    lambda: _time_bins_vec(timestamps[down]),
+                    lambda: top5(up),
+                    lambda: top5(down),
+                    lambda: _counts_vec(int(np.count_nonzero(up)), int(np.count_nonzero(down)), len(directions))])
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, column):
+        value = self._values[column]
+        if value is None:
+            self._fill(_GROUP_OF[column])
+            value = self._values[column]
+        return value
+
+    def _fill(self, group):
+        columns = FEATURE_GROUPS[group][1]
+        for column, value in zip(columns, self._compute[group]()):
+            self._values[column] = value
+        self.computed += len(columns)
+
+    def avoided(self):
+        """number of columns not computed so far"""
+        return len(self._values) - self.computed
+
+    def vector(self):
+        """the whole feature vector, computing the groups not read yet"""
+        for group, (_, columns) in enumerate(FEATURE_GROUPS):
+            if self._values[columns[0]] is None:
+                self._fill(group)
+        return list(self._values)
+
+
 def network_speed(flow):
     """
     calculating network speed at the last packet in every direction
-    :param flow list: a flow contain a series of packets
+    :param flow Flow: a flow contain a series of packets
     :return list: speed at up, down and both
     """
-    both_total_size = 0
-    up_total_size = 0
-    down_total_size = 0
+    timestamps, sizes, directions = flow_arrays(flow)
 
-    both_time = 0
-    up_time = 0
-    down_time = 0
+    res = []
+    for mask in [np.ones(len(directions), dtype=bool), directions == UPSTREAM, directions == DOWNSTREAM]:
+        total_size = int(sizes[mask].sum())
+        last_time = float(timestamps[mask][-1]) if mask.any() else 0
+        if last_time == 0:
+            res.append(-1)
+        else:
+            res.append(total_size / last_time)
 
-    for p in flow:
-        both_time = p.timestamp
-        both_total_size += p.size
+    return res
 
-        if p.direction == UPSTREAM:
-            up_time = p.timestamp
-            up_total_size += p.size
-        elif p.direction == DOWNSTREAM:
-            down_time = p.timestamp
-            down_total_size += p.size
 
-    if both_time == 0:
-        both_speed = -1
-    else:
-        both_speed = both_total_size / both_time
+def extract_pcap(pcap_path, flow_length, backend=DEFAULT_BACKEND):
+    """
+    feature vector of the first packets in a pcap file
+    :param pcap_path string: a given path of pacp file
+    :param flow_length int: the first n packets
+    :param backend string: pcap reader backend, 'fast' or 'dpkt'
+    :return res list: F1-F6 of the flow
+    """
+    flow = extract_flow(pcap_path, flow_length, backend)
+    # F1-F6
+    with METRICS.timer('features'):
+        res = flow_features(*flow_arrays(flow))
+    METRICS.count('flows')
+    # F7
+    # tmp = network_speed(flow)
+    # res += tmp
+
+    return res
+
+
+def extract_pcap_multi(pcap_path, flow_lengths, backend=DEFAULT_BACKEND):
+    """
+    feature vectors of several prefix lengths of a pcap file, the file is read once
+    :param pcap_path string: a given path of pacp file
+    :param flow_lengths list: the prefix lengths, e.g. [10, 20, 30, 50, 100]
+    :param backend string: pcap reader backend, 'fast' or 'dpkt'
+    :return list: F1-F6 of every prefix, in the order of flow_lengths
+    """
+    flow = extract_flow(pcap_path, max(flow_lengths), backend)
 
-    if up_time == 0:
-        up_speed = -1
+    with METRICS.timer('features'):
+        rows = [flow_features(*flow_arrays(flow[:n])) for n in flow_lengths]
+    METRICS.count('flows', len(flow_lengths))
+
+    return rows
+
+
+def open_cache(cache_path=CACHE_PATH):
+    """open the feature cache of the current feature-set version"""
+    return FeatureCache(cache_path, feature_version())
+
+
+def extract_pcap_cached(pcap_path, flow_length, cache, backend=DEFAULT_BACKEND):
+    """
+    feature vector of a pcap file, looked up in the cache by its file_digest first
+    :param pcap_path string: a given path of pacp file
+    :param flow_length int: the first n packets
+    :param cache FeatureCache: the feature cache, None to always extract
+    :param backend string: pcap reader backend, 'fast' or 'dpkt'
+    :return res list: F1-F6 of the flow
+    """
+    if cache is None:
+        return extract_pcap(pcap_path, flow_length, backend)
+
+    with METRICS.timer('cache_lookup'):
+        digest = file_digest(pcap_path)
+        res = cache.get(digest, flow_length)
+    if res is None:
+        METRICS.count('cache_misses')
+        res = extract_pcap(pcap_path, flow_length, backend)
+        cache.put(digest, flow_length, res)
     else:
-        up_speed = up_total_size / up_time
+        METRICS.count('cache_hits')
+
+    return res
+
+
+_worker_caches = {}
+
+
+def _lookup_or_extract(pcap_path, flow_lengths, backend, cache_path):
+    """worker side of extract_rows, the cache is only read here and written by the parent"""
+    cache = _worker_caches.get(cache_path)
+    if cache is None:
+        cache = _worker_caches[cache_path] = open_cache(cache_path)
+
+    with METRICS.timer('cache_lookup'):
+        digest = file_digest(pcap_path)
+        rows = [cache.get(digest, n, touch=False) for n in flow_lengths]
+    hits = [res is not None for res in rows]
+    if not all(hits):
+        rows = extract_pcap_multi(pcap_path, flow_lengths, backend)
 
-    if down_time == 0:
-        down_speed = -1
+    return digest, rows, hits
+
+
+def extract_rows(pcap_paths, flow_length, workers=None, chunk_size=16, backend=DEFAULT_BACKEND, cache_path=None):
+    """
+    feature vectors of many pcap files, in the order of pcap_paths
+    :param pcap_paths list: paths of pcap files
+    :param flow_length int: the first n packets, or a list of prefix lengths extracted in one pass
+    :param workers int: number of worker processes, None for all cores, 1 to run in this process
+    :param chunk_size int: number of files handed to a worker at a time
+    :param backend string: pcap reader backend, 'fast' or 'dpkt'
+    :param cache_path string: the feature cache, None to disable it
+    :return generator: F1-F6 of every pcap file, a list with one vector per prefix length if flow_length is a list
+    """
+    multi = isinstance(flow_length, (list, tuple))
+    flow_lengths = tuple(flow_length) if multi else (flow_length,)
+
+    if cache_path is None:
+        extract = functools.partial(extract_pcap_multi, flow_lengths=flow_lengths, backend=backend)
+        cache = None
+    else:
+        extract = functools.partial(_lookup_or_extract, flow_lengths=flow_lengths, backend=backend,
+                                    cache_path=cache_path)
+        cache = open_cache(cache_path)
+
+    # workers record their metrics per file and send them back with the rows
+    merge = METRICS.enabled and workers != 1
+    if merge:
+        extract = functools.partial(measured, fn=extract)
+
+    if workers == 1:
+        results = map(extract, pcap_paths)
+        pool = None
     else:
-        down_speed = down_total_size / down_time
+        pool = multiprocessing.Pool(workers)
+        # imap keeps the input order and hands rows over as soon as they are ready
+        results = pool.imap(extract, pcap_paths, chunksize=chunk_size)
+
+    finished = False
+    try:
+        for rows in results:
+            if merge:
+                rows, snapshot = rows
+                METRICS.merge(snapshot)
+            if cache is not None:
+                digest, rows, hits = rows
+                for n, res, hit in zip(flow_lengths, rows, hits):
+                    if hit:
+                        cache.hits += 1
+                        METRICS.count('cache_hits')
+                        cache.touch(digest, n)
+                    else:
+                        cache.misses += 1
+                        METRICS.count('cache_misses')
+                        cache.put(digest, n, res)
+            yield rows if multi else rows[0]
+        finished = True
+    finally:
+        if pool is not None:
+            if finished:
+                pool.close()
+            else:
+                # a worker raised or the caller stopped early, drop the files still queued
+                pool.terminate()
+            pool.join()
+        if cache is not None:
+            cache.close()
+
+
+def extract_archive(pcap_archive, csv_path, flow_length, workers=None, chunk_size=16, backend=DEFAULT_BACKEND,
+                    cache_path=None):
+    """
+    extract every pcap file in a directory into a csv file, one row per file in sorted file name order
+    :param pcap_archive string: the directory of pcap files
+    :param csv_path string: the output csv file, a list of files if flow_length is a list
+    :param flow_length int: the first n packets, or a list of prefix lengths extracted in one pass
+    :param workers int: number of worker processes, None for all cores, 1 to run in this process
+    :param chunk_size int: number of files handed to a worker at a time
+    :param backend string: pcap reader backend, 'fast' or 'dpkt'
+    :param cache_path string: the feature cache, None to disable it
+    :return count int: number of rows written to every csv file
+    """
+    pcap_paths = [os.path.join(pcap_archive, pcap) for pcap in sorted(os.listdir(pcap_archive))]
+    multi = isinstance(flow_length, (list, tuple))
+    csv_paths = list(csv_path) if multi else [csv_path]
+    count = 0
+
+    files = [open(path, 'w', newline='') for path in csv_paths]
+    try:
+        writers = [csv.writer(f) for f in files]
+        for rows in extract_rows(pcap_paths, flow_length, workers, chunk_size, backend, cache_path):
+            if not multi:
+                rows = [rows]
+            for f_csv, res in zip(writers, rows):
+                f_csv.writerow(res)
+            count += 1
+    finally:
+        for f in files:
+            f.close()
 
-    return [both_speed, up_speed, down_speed]
+    return count
+
+
+def csv_name(pcap_archive, flow_length):
+    """default training csv name of an archive, e.g. snowflake_train_30.csv"""
+    return os.path.basename(os.path.normpath(pcap_archive)) + '_train_' + str(flow_length) + '.csv'
 
 
 if __name__ == '__main__':
@@ -271,52 +691,34 @@ if __name__ == '__main__':
     # pcap_archive = 'normal'
     # csv_path = 'normal_train_' + str(FLOW_LENGTH) + '.csv'
 
-    pcap_archive = 'snowflake'
-    csv_path = 'snowflake_train_' + str(FLOW_LENGTH) + '.csv'
-
-    f = open(csv_path, 'w', newline='')
-
-    for pcap in os.listdir(pcap_archive):
-        pcap_path = os.path.join(pcap_archive, pcap)
-
-        # print(pcap_path)
-        flow = extract_flow(pcap_path, FLOW_LENGTH)
-        res = []
-
-        # F1
-        for direction in [UPSTREAM, DOWNSTREAM]:
-            tmp = time_bins(flow, direction)
-            res += tmp
-        # F2
-        for direction in [UPSTREAM, DOWNSTREAM]:
-            tmp = top5_size(flow, direction)
-            res += tmp
-        # F3
-        for direction in [UPSTREAM, DOWNSTREAM]:
-            tmp = top5_size_percentage(flow, direction)
-            res += tmp
-        # F4
-        for direction in [UPSTREAM, DOWNSTREAM]:
-            tmp = direction_sum(flow, direction)
-            res.append(tmp)
-        # F5
-        for direction in [UPSTREAM, DOWNSTREAM]:
-            tmp = direction_percentage(flow, direction)
-            res.append(tmp)
-        # F6
-        tmp = direction_ratio(flow, BOTH)
-        res.append(tmp)
-        # F7
-        # tmp = network_speed(flow)
-        # res += tmp
-
-        print(res)
-
-        # write res not none
-        if res:
-            f_csv = csv.writer(f)
-            f_csv.writerow(res)
-
-    f.close()
-
-    print('OK.')
+    parser = argparse.ArgumentParser(description='extract flow features of every pcap file in a directory')
+    parser.add_argument('pcap_archive', nargs='?', default='snowflake')
+    parser.add_argument('csv_path', nargs='?', default=None, help='output csv, only with a single flow length')
+    parser.add_argument('--flow-length', type=int, nargs='+', default=[FLOW_LENGTH],
+                        help='one or more prefix lengths, e.g. 10 20 30 50 100, one csv per length')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=16)
+    parser.add_argument('--backend', default=DEFAULT_BACKEND)
+    parser.add_argument('--cache', default=None, help='feature cache path, e.g. ' + CACHE_PATH)
+    parser.add_argument('--metrics', default=None,
+                        help='write stage timers and counters, Prometheus text for .prom files, JSON otherwise')
+    args = parser.parse_args()
+    if args.metrics:
+        METRICS.enable()
+
+    if len(args.flow_length) == 1:
+        flow_length = args.flow_length[0]
+        csv_path = args.csv_path or csv_name(args.pcap_archive, flow_length)
+    else:
+        if args.csv_path is not None:
+            parser.error('csv_path only works with a single --flow-length')
+        flow_length = args.flow_length
+        csv_path = [csv_name(args.pcap_archive, n) for n in flow_length]
+
+    count = extract_archive(args.pcap_archive, csv_path, flow_length,
+                            workers=args.workers, chunk_size=args.chunk_size, backend=args.backend,
+                            cache_path=args.cache)
+    if args.metrics:
+        METRICS.write(args.metrics)
+
+    print(count, 'OK.')
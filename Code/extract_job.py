@@ -0,0 +1,351 @@
+import io
+import os
+import csv
+import json
+import time
+import socket
+import argparse
+import functools
+import traceback
+import multiprocessing
+
+from Snowflake_Detection.extract_features import *
+
+
+# layout of a job directory
+_MANIFEST = 'manifest.json'
+_SHARDS = 'shards'
+_CLAIMS = 'claims'
+_OUTPUT = 'output'
+_QUARANTINE = 'quarantine'
+
+SHARD_SIZE = 256
+
+# a claim whose heartbeat is older than this is taken over by the next runner
+STALE_AFTER = 600.0
+
+
+def _shard_name(shard):
+    return '%06d' % shard
+
+
+def _write_atomic(path, text):
+    """write a file under a temporary name and rename it, readers never see a partial file"""
+    tmp = '%s.tmp.%s.%d' % (path, socket.gethostname(), os.getpid())
+    with open(tmp, 'w', newline='') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class ExtractJob(object):
+    """
+    a resumable extraction of a pcap archive, the state lives in a job directory on a filesystem shared by the runners:
+    manifest.json the archive, flow lengths and backend, shards/N.txt the pcap files of every shard,
+    claims/N.claim the runner working on a shard, output/N_<flow length>.csv the rows of a finished shard
+    and quarantine/N.jsonl the files of the shard that failed, with their error
+    a shard is finished once all its output files exist, they are renamed into place so a crash leaves no partial shard
+    """
+    def __init__(self, job_dir):
+        super(ExtractJob, self).__init__()
+        self.job_dir = job_dir
+        with open(os.path.join(job_dir, _MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['feature_version'] != feature_version():
+            raise ValueError('job %s was created with feature version %d, this tree extracts version %d, '
+                             'rows of both would be mixed' % (job_dir, self.manifest['feature_version'],
+                                                               feature_version()))
+        self.flow_lengths = self.manifest['flow_lengths']
+        self.shards = self.manifest['shards']
+        self.runner = '%s:%d' % (socket.gethostname(), os.getpid())
+
+    @classmethod
+    def create(cls, job_dir, pcap_archive, flow_length, shard_size=SHARD_SIZE, backend=DEFAULT_BACKEND):
+        """
+        split an archive into shards and write the manifest, an existing job is left as it is
+        :param pcap_archive string: the directory of pcap files
+        :param flow_length int: the first n packets, or a list of prefix lengths extracted in one pass
+        :param shard_size int: number of pcap files per shard
+        :return ExtractJob: the job
+        """
+        if os.path.exists(os.path.join(job_dir, _MANIFEST)):
+            return cls(job_dir)
+
+        for sub in (_SHARDS, _CLAIMS, _OUTPUT, _QUARANTINE):
+            os.makedirs(os.path.join(job_dir, sub), exist_ok=True)
+
+        pcap_paths = [os.path.join(pcap_archive, pcap) for pcap in sorted(os.listdir(pcap_archive))]
+        shards = 0
+        for start in range(0, len(pcap_paths), shard_size):
+            _write_atomic(os.path.join(job_dir, _SHARDS, _shard_name(shards) + '.txt'),
+                          ''.join(path + '\n' for path in pcap_paths[start:start + shard_size]))
+            shards += 1
+
+        flow_lengths = list(flow_length) if isinstance(flow_length, (list, tuple)) else [flow_length]
+        # the manifest is written last, a job without one is recreated from scratch
+        _write_atomic(os.path.join(job_dir, _MANIFEST), json.dumps({
+            'archive': os.path.abspath(pcap_archive), 'flow_lengths': flow_lengths, 'backend': backend,
+            'shard_size': shard_size, 'shards': shards, 'files': len(pcap_paths),
+            'feature_version': feature_version(), 'created': time.time()}, indent=1))
+
+        return cls(job_dir)
+
+    def _path(self, sub, shard, suffix):
+        return os.path.join(self.job_dir, sub, _shard_name(shard) + suffix)
+
+    def output_paths(self, shard):
+        return [self._path(_OUTPUT, shard, '_%d.csv' % n) for n in self.flow_lengths]
+
+    def is_done(self, shard):
+        return all(os.path.exists(path) for path in self.output_paths(shard))
+
+    def shard_files(self, shard):
+        with open(self._path(_SHARDS, shard, '.txt')) as f:
+            return [line.rstrip('\n') for line in f if line.strip()]
+
+    def claim(self, shard, stale_after=STALE_AFTER):
+        """
+        take a shard, only one runner can hold the claim of a shard
+        a claim is taken over when its heartbeat is older than stale_after or its process died on this host
+        :return bool: True when this runner now holds the shard
+        """
+        path = self._path(_CLAIMS, shard, '.claim')
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            observed = _read_claim(path)
+            if observed is None:
+                # released since the open
+                return self.claim(shard, stale_after)
+            if not self._is_stale(observed, stale_after):
+                return False
+            # the rename succeeds for a single runner, the others lose the race and move on
+            stale = '%s.stale.%s' % (path, self.runner.replace(':', '.'))
+            try:
+                os.rename(path, stale)
+            except FileNotFoundError:
+                return False
+            if _read_claim(stale) != observed:
+                # another runner took the shard over since the check, this is its fresh claim:
+                # put it back, unless yet another claim was created meanwhile, and leave the shard
+                try:
+                    os.link(stale, path)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            return self.claim(shard, stale_after)
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.runner)
+        return True
+
+    def _is_stale(self, observed, stale_after):
+        """
+        :param observed tuple: owner and mtime of a claim, as returned by _read_claim
+        """
+        owner, mtime = observed
+        age = time.time() - mtime
+        host, _, pid = owner.partition(':')
+        if host == socket.gethostname() and pid.isdigit() and int(pid) != os.getpid():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        return age > stale_after
+
+    def owns(self, shard):
+        observed = _read_claim(self._path(_CLAIMS, shard, '.claim'))
+        return observed is not None and observed[0] == self.runner
+
+    def heartbeat(self, shard):
+        if not self.owns(shard):
+            return
+        try:
+            os.utime(self._path(_CLAIMS, shard, '.claim'))
+        except FileNotFoundError:
+            pass
+
+    def release(self, shard):
+        """drop the claim of a shard, a claim taken over by another runner is left alone"""
+        if not self.owns(shard):
+            return
+        try:
+            os.remove(self._path(_CLAIMS, shard, '.claim'))
+        except FileNotFoundError:
+            pass
+
+    def finish(self, shard, results):
+        """
+        checkpoint a shard, the quarantine list is written first and the csv files are renamed into place last
+        :param results list: (pcap_path, rows, error) of every file of the shard, in shard order
+        """
+        quarantined = [json.dumps({'path': path, 'error': error}) + '\n' for path, rows, error in results if error]
+        _write_atomic(self._path(_QUARANTINE, shard, '.jsonl'), ''.join(quarantined))
+
+        for i, path in enumerate(self.output_paths(shard)):
+            lines = []
+            for pcap_path, rows, error in results:
+                # failed files, e.g. without any TCP/UDP packet, are in the quarantine list instead
+                if error is None:
+                    out = io.StringIO()
+                    csv.writer(out).writerow(rows[i])
+                    lines.append(out.getvalue())
+            _write_atomic(path, ''.join(lines))
+
+    def run(self, workers=None, chunk_size=16, stale_after=STALE_AFTER, max_shards=None):
+        """
+        claim and extract unfinished shards until none is left, any number of runners can work on a job at once
+        :param workers int: number of worker processes, None for all cores, 1 to run in this process
+        :param max_shards int: stop after this many shards, None for no limit
+        :return int: number of shards finished by this runner
+        """
+        extract = functools.partial(_extract_safe, flow_lengths=tuple(self.flow_lengths),
+                                    backend=self.manifest['backend'])
+        pool = None if workers == 1 else multiprocessing.Pool(workers)
+        finished = 0
+        try:
+            for shard in range(self.shards):
+                if max_shards is not None and finished >= max_shards:
+                    break
+                if self.is_done(shard) or not self.claim(shard, stale_after):
+                    continue
+                try:
+                    # another runner may have finished it between the check and the claim
+                    if self.is_done(shard):
+                        continue
+                    pcap_paths = self.shard_files(shard)
+                    results = pool.imap(extract, pcap_paths, chunksize=chunk_size) if pool else map(extract, pcap_paths)
+                    collected = []
+                    for i, res in enumerate(results, 1):
+                        collected.append(res)
+                        if i % chunk_size == 0:
+                            self.heartbeat(shard)
+                    self.finish(shard, collected)
+                    finished += 1
+                finally:
+                    self.release(shard)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return finished
+
+    def status(self):
+        """number of shards finished, claimed and pending, and number of quarantined files"""
+        done = claimed = quarantined = 0
+        for shard in range(self.shards):
+            if self.is_done(shard):
+                done += 1
+                with open(self._path(_QUARANTINE, shard, '.jsonl')) as f:
+                    quarantined += sum(1 for line in f if line.strip())
+            elif os.path.exists(self._path(_CLAIMS, shard, '.claim')):
+                claimed += 1
+
+        return {'shards': self.shards, 'done': done, 'claimed': claimed, 'pending': self.shards - done - claimed,
+                'files': self.manifest['files'], 'quarantined': quarantined}
+
+    def quarantined(self):
+        """(pcap_path, error) of every failed file of the finished shards"""
+        res = []
+        for shard in range(self.shards):
+            path = self._path(_QUARANTINE, shard, '.jsonl')
+            if os.path.exists(path) and self.is_done(shard):
+                with open(path) as f:
+                    res.extend((entry['path'], entry['error']) for entry in map(json.loads, f) if entry)
+        return res
+
+    def merge(self, csv_paths=None):
+        """
+        concatenate the shard outputs in shard order, the same csv extract_archive writes without the quarantined files
+        :param csv_paths list: one output file per flow length, csv_name of the archive by default
+        :return int: number of rows written to every csv file
+        """
+        if self.status()['done'] != self.shards:
+            raise RuntimeError('job %s is not finished: %r' % (self.job_dir, self.status()))
+        if csv_paths is None:
+            csv_paths = [csv_name(self.manifest['archive'], n) for n in self.flow_lengths]
+
+        counts = []
+        for i, csv_path in enumerate(csv_paths):
+            count = 0
+            with open(csv_path, 'w', newline='') as out:
+                for shard in range(self.shards):
+                    with open(self.output_paths(shard)[i], newline='') as f:
+                        for line in f:
+                            out.write(line)
+                            count += 1
+            counts.append(count)
+
+        return counts[0] if counts else 0
+
+
+def _read_claim(path):
+    """owner and mtime of a claim file, None when it does not exist"""
+    try:
+        with open(path) as f:
+            owner = f.read().strip()
+        return owner, os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+
+def _extract_safe(pcap_path, flow_lengths, backend):
+    """worker side of ExtractJob.run, an error is returned instead of raised so one bad file cannot stop a shard"""
+    try:
+        return pcap_path, extract_pcap_multi(pcap_path, flow_lengths, backend), None
+    except Exception as e:
+        return pcap_path, None, traceback.format_exception_only(type(e), e)[-1].strip()
+
+
+if __name__ == '__main__':
+
+    FLOW_LENGTH = 30
+
+    parser = argparse.ArgumentParser(description='resumable sharded extraction of a pcap archive')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    init_parser = sub.add_parser('init', help='split an archive into shards')
+    init_parser.add_argument('job_dir')
+    init_parser.add_argument('pcap_archive')
+    init_parser.add_argument('--flow-length', type=int, nargs='+', default=[FLOW_LENGTH])
+    init_parser.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    init_parser.add_argument('--backend', default=DEFAULT_BACKEND)
+
+    run_parser = sub.add_parser('run', help='extract unfinished shards, start one runner per process or host')
+    run_parser.add_argument('job_dir')
+    run_parser.add_argument('--workers', type=int, default=None)
+    run_parser.add_argument('--chunk-size', type=int, default=16)
+    run_parser.add_argument('--stale-after', type=float, default=STALE_AFTER,
+                            help='seconds without heartbeat after which a claimed shard is taken over')
+    run_parser.add_argument('--max-shards', type=int, default=None)
+
+    status_parser = sub.add_parser('status', help='progress and quarantined files')
+    status_parser.add_argument('job_dir')
+
+    merge_parser = sub.add_parser('merge', help='write the csv files of a finished job')
+    merge_parser.add_argument('job_dir')
+    merge_parser.add_argument('csv_path', nargs='*', help='one per flow length, the archive csv names by default')
+    args = parser.parse_args()
+
+    if args.mode == 'init':
+        flow_length = args.flow_length if len(args.flow_length) > 1 else args.flow_length[0]
+        job = ExtractJob.create(args.job_dir, args.pcap_archive, flow_length, args.shard_size, args.backend)
+        print(job.job_dir, job.shards, 'shards')
+    elif args.mode == 'run':
+        job = ExtractJob(args.job_dir)
+        print(job.run(args.workers, args.chunk_size, args.stale_after, args.max_shards), 'shards finished')
+        print(job.status())
+    elif args.mode == 'status':
+        job = ExtractJob(args.job_dir)
+        print(job.status())
+        for path, error in job.quarantined():
+            print('quarantined', path, error)
+    else:
+        job = ExtractJob(args.job_dir)
+        print(job.merge(args.csv_path or None), 'rows')
+
+    print('OK.')
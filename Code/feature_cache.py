@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+
+
+CACHE_PATH = 'feature_cache.sqlite'
+MAX_BYTES = 256 * 1024 * 1024
+
+# rough per-row overhead of the sqlite storage, counted against max_bytes
+_ROW_OVERHEAD = 96
+
+
+# bytes of a pcap hashed into its cache key, about the first 30 full-size packets extraction reads
+PREFIX_BYTES = 64 * 1024
+
+
+def file_digest(path, prefix_bytes=PREFIX_BYTES):
+    """
+    cache key of a pcap file, the size, mtime and inode of the file and a hash of its first bytes
+    hashing the whole file costs far more than extracting the first packets again on large captures
+    :param path string: the file's path
+    :param prefix_bytes int: number of bytes hashed from the start of the file
+    :return string: hex sha256 of the file identity and prefix
+    """
+    st = os.stat(path)
+    h = hashlib.sha256(b'%d:%d:%d:' % (st.st_size, st.st_mtime_ns, st.st_ino))
+    with open(path, 'rb') as f:
+        h.update(f.read(prefix_bytes))
+
+    return h.hexdigest()
+
+
+class FeatureCache(object):
+    """
+    persistent cache of feature vectors keyed by file_digest of the pcap, flow length and feature-set version
+    rows of other versions are never returned, the least recently used rows are evicted above max_bytes
+    """
+    def __init__(self, path, version, max_bytes=MAX_BYTES):
+        super(FeatureCache, self).__init__()
+        self.path = path
+        self.version = version
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS features ('
+                          'digest TEXT, flow_length INTEGER, version INTEGER, row TEXT, '
+                          'size INTEGER, last_used REAL, PRIMARY KEY (digest, flow_length, version))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS features_last_used ON features (last_used)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+
+    def get(self, digest, flow_length, touch=True):
+        """
+        cached feature vector of a pcap
+        :param digest string: file_digest of the pcap
+        :param flow_length int: the first n packets
+        :param touch bool: mark the row as recently used
+        :return list: the feature vector, None on a miss
+        """
+        row = self.conn.execute('SELECT row FROM features WHERE digest=? AND flow_length=? AND version=?',
+                                (digest, flow_length, self.version)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if touch:
+            self.touch(digest, flow_length)
+        return json.loads(row[0])
+
+    def touch(self, digest, flow_length):
+        """mark a row as recently used"""
+        with self.conn:
+            self.conn.execute('UPDATE features SET last_used=? WHERE digest=? AND flow_length=? AND version=?',
+                              (time.time(), digest, flow_length, self.version))
+
+    def put(self, digest, flow_length, res):
+        """
+        store the feature vector of a pcap
+        :param digest string: file_digest of the pcap
+        :param flow_length int: the first n packets
+        :param res list: the feature vector
+        """
+        # json keeps ints as ints and round-trips floats exactly, so cached rows write the same csv
+        row = json.dumps(res)
+        size = len(row) + len(digest) + _ROW_OVERHEAD
+        with self.conn:
+            old = self.conn.execute('SELECT size FROM features WHERE digest=? AND flow_length=? AND version=?',
+                                    (digest, flow_length, self.version)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.conn.execute('INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?)',
+                              (digest, flow_length, self.version, row, size, time.time()))
+        self.total_bytes += size
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self, batch=256):
+        """drop the least recently used rows until the cache fits in max_bytes"""
+        with self.conn:
+            while self.total_bytes > self.max_bytes:
+                rows = self.conn.execute('SELECT rowid, size FROM features ORDER BY last_used LIMIT ?',
+                                         (batch,)).fetchall()
+                if not rows:
+                    self.total_bytes = 0
+                    break
+                drop = []
+                for rowid, size in rows:
+                    drop.append((rowid,))
+                    self.total_bytes -= size
+                    if self.total_bytes <= self.max_bytes:
+                        break
+                self.conn.executemany('DELETE FROM features WHERE rowid=?', drop)
+
+    def invalidate(self):
+        """
+        drop the rows of every other feature-set version, call it after changing the feature definitions
+        :return int: number of rows dropped
+        """
+        with self.conn:
+            count = self.conn.execute('DELETE FROM features WHERE version!=?', (self.version,)).rowcount
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+
+        return count
+
+    def clear(self):
+        """drop every row"""
+        with self.conn:
+            self.conn.execute('DELETE FROM features')
+        self.total_bytes = 0
+
+    def stats(self):
+        """number of rows per version and hit/miss counters of this session"""
+        versions = dict(self.conn.execute('SELECT version, COUNT(*) FROM features GROUP BY version').fetchall())
+        return {'rows': versions, 'bytes': self.total_bytes, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='inspect or invalidate a feature cache')
+    parser.add_argument('cache_path', nargs='?', default=CACHE_PATH)
+    parser.add_argument('--keep-version', type=int, default=None, help='drop the rows of every other version')
+    parser.add_argument('--clear', action='store_true', help='drop every row')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cache_path):
+        sys.exit('no cache at %s' % args.cache_path)
+
+    cache = FeatureCache(args.cache_path, args.keep_version)
+    if args.clear:
+        cache.clear()
+    elif args.keep_version is not None:
+        print('dropped', cache.invalidate())
+    print(cache.stats())
+    cache.close()
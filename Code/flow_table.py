@@ -0,0 +1,203 @@
+import os
+import sys
+import csv
+import socket
+import array
+import numpy as np
+from collections import OrderedDict
+
+from Snowflake_Detection.extract_features import *
+from Snowflake_Detection.pcap_reader import read_packets, DEFAULT_BACKEND
+from Snowflake_Detection.direction import default_classifier
+
+
+IDLE_TIMEOUT = 60.0
+
+
+class FlowState(object):
+    """
+    the state of an unfinished flow
+    :last_seen the captured time of the latest packet
+    """
+    __slots__ = ('timestamp', 'size', 'direction', 'last_seen')
+
+    def __init__(self):
+        super(FlowState, self).__init__()
+        self.timestamp = array.array('d')
+        self.size = array.array('H')
+        self.direction = array.array('b')
+        self.last_seen = 0.0
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def add(self, timestamp, size, direction):
+        self.timestamp.append(timestamp)
+        self.size.append(size)
+        self.direction.append(direction)
+        self.last_seen = timestamp
+
+    def result(self):
+        return self.to_flow()
+
+    def to_flow(self):
+        return Flow(np.frombuffer(self.timestamp, dtype=np.float64),
+                    np.frombuffer(self.size, dtype=np.uint16),
+                    np.frombuffer(self.direction, dtype=np.int8))
+
+
+def flow_key(sip, dip, sport, dport, proto):
+    """
+    the bidirectional 5-tuple, both directions of a connection share the same key
+    :return tuple: (proto, (ip, port), (ip, port))
+    """
+    a = (sip, sport)
+    b = (dip, dport)
+    if a <= b:
+        return proto, a, b
+    return proto, b, a
+
+
+def flow_name(key):
+    """readable name of a flow key, IPv6 addresses in brackets, e.g. [2001:db8::1]:443"""
+    proto, a, b = key
+    names = [socket.inet_ntop(socket.AF_INET, ip) if len(ip) == 4 else '[%s]' % socket.inet_ntop(socket.AF_INET6, ip)
+             for ip, _ in (a, b)]
+    return '%s:%d-%s:%d-%d' % (names[0], a[1], names[1], b[1], proto)
+
+
+class FlowTable(object):
+    """
+    streaming flow table keyed by the bidirectional 5-tuple
+    a flow is finished when it reaches flow_length packets or it is idle for idle_timeout seconds,
+    finished flows are handed back to the caller and their state is dropped
+    the per-flow state is a FlowState by default, any class with add(), result(), last_seen and len() works,
+    e.g. accumulators.FlowAccumulator
+    """
+    def __init__(self, flow_length=30, idle_timeout=IDLE_TIMEOUT, state=None):
+        super(FlowTable, self).__init__()
+        self.flow_length = flow_length
+        self.idle_timeout = idle_timeout
+        self.state = FlowState if state is None else state
+        # unfinished flows, the least recently seen first
+        self.active = OrderedDict()
+        # flows that already reached flow_length, later packets are ignored until they go idle
+        self.done = OrderedDict()
+        self.now = 0.0
+
+    def __len__(self):
+        return len(self.active)
+
+    def add(self, key, timestamp, size, direction):
+        """
+        add a packet to its flow
+        :return list: (key, Flow) of the flows finished by this packet, (key, state.result()) for other states
+        """
+        # nanosecond captures give Decimal timestamps, the idle arithmetic is done in float seconds
+        timestamp = float(timestamp)
+        if timestamp > self.now:
+            self.now = timestamp
+        finished = self.expire()
+
+        if key in self.done:
+            self.done[key] = timestamp
+            self.done.move_to_end(key)
+            return finished
+
+        state = self.active.get(key)
+        if state is None:
+            state = self.state()
+            self.active[key] = state
+        else:
+            self.active.move_to_end(key)
+
+        state.add(timestamp, size, direction)
+
+        if len(state) >= self.flow_length:
+            del self.active[key]
+            self.done[key] = timestamp
+            finished.append((key, state.result()))
+
+        return finished
+
+    def finish(self, key):
+        """
+        finish a flow before it reaches flow_length, e.g. once it has a verdict, later packets are ignored
+        :return: the state of the flow, None if it is not active
+        """
+        state = self.active.pop(key, None)
+        if state is not None:
+            self.done[key] = state.last_seen
+        return state
+
+    def expire(self):
+        """
+        finish the flows idle for longer than idle_timeout
+        :return list: (key, Flow) of the idle flows
+        """
+        deadline = self.now - self.idle_timeout
+        finished = []
+
+        while self.active:
+            key, state = next(iter(self.active.items()))
+            if state.last_seen >= deadline:
+                break
+            del self.active[key]
+            finished.append((key, state.result()))
+
+        while self.done:
+            key, last_seen = next(iter(self.done.items()))
+            if last_seen >= deadline:
+                break
+            del self.done[key]
+
+        return finished
+
+    def flush(self):
+        """
+        finish all the unfinished flows, e.g. at the end of a capture
+        :return list: (key, Flow) of the remaining flows
+        """
+        finished = [(key, state.result()) for key, state in self.active.items()]
+        self.active.clear()
+        self.done.clear()
+
+        return finished
+
+
+def extract_flows(pcap_path, flow_length, idle_timeout=IDLE_TIMEOUT, backend=DEFAULT_BACKEND):
+    """
+    split a capture into flows by the bidirectional 5-tuple
+    :param pcap_path string: a given path of pacp file
+    :param flow_length int: the first n packets of every flow
+    :param idle_timeout float: seconds without packets after which a flow is finished
+    :param backend string: pcap reader backend, 'fast' or 'dpkt'
+    :return generator: (key, Flow) in the order the flows are finished
+    """
+    table = FlowTable(flow_length, idle_timeout)
+    classify = default_classifier().direction
+
+    for ts, src, dst, sport, dport, proto, length in read_packets(pcap_path, backend):
+        direction = classify(src)
+        key = flow_key(src, dst, sport, dport, proto)
+        for flow in table.add(key, ts, length, direction):
+            yield flow
+
+    for flow in table.flush():
+        yield flow
+
+
+if __name__ == '__main__':
+
+    FLOW_LENGTH = 30
+
+    pcap_path = sys.argv[1]
+    csv_path = os.path.splitext(os.path.basename(pcap_path))[0] + '_flows_' + str(FLOW_LENGTH) + '.csv'
+
+    with open(csv_path, 'w', newline='') as f:
+        f_csv = csv.writer(f)
+        for key, flow in extract_flows(pcap_path, FLOW_LENGTH):
+            res = flow_features(*flow_arrays(flow))
+            f_csv.writerow([flow_name(key)] + res)
+
+    print('OK.')
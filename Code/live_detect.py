@@ -0,0 +1,169 @@
+import sys
+import time
+import argparse
+import numpy as np
+
+from Snowflake_Detection.extract_features import *
+from Snowflake_Detection.flow_table import FlowTable, flow_key, flow_name, IDLE_TIMEOUT
+from Snowflake_Detection.pcap_reader import read_stream, open_capture
+from Snowflake_Detection.detector import Detector, SNOWFLAKE, model_path_DT
+from Snowflake_Detection.accumulators import FlowAccumulator
+from Snowflake_Detection.direction import default_classifier
+from Snowflake_Detection.cascade import Cascade
+
+
+FLOW_LENGTH = 30
+
+
+class Verdict(object):
+    """
+    the verdict of a flow
+    :key bidirectional 5-tuple of the flow
+    :verdict SNOWFLAKE or NORMAL
+    :flow_time capture time from the first to the last packet of the flow
+    :latency wall-clock time from reading the last packet to the verdict
+    :packets number of packets of the flow at the verdict
+    """
+    __slots__ = ('key', 'verdict', 'flow_time', 'latency', 'packets')
+
+    def __init__(self, key, verdict, flow_time, latency, packets):
+        super(Verdict, self).__init__()
+        self.key = key
+        self.verdict = verdict
+        self.flow_time = flow_time
+        self.latency = latency
+        self.packets = packets
+
+
+class LiveDetector(object):
+    """
+    streaming detection engine, keeps per-flow state and classifies a flow the moment it reaches flow_length packets
+    the state of a flow is a FlowAccumulator, so no packet list is kept and the features are ready at the last packet
+    with a cascade.Cascade, a flow is classified at the first prefix length whose model is confident enough
+    and detector may be None
+    """
+    def __init__(self, detector, flow_length=FLOW_LENGTH, idle_timeout=IDLE_TIMEOUT, cascade=None):
+        super(LiveDetector, self).__init__()
+        self.detector = detector
+        self.cascade = cascade
+        if cascade is not None:
+            flow_length = cascade.flow_length
+        self.flow_length = flow_length
+        self.table = FlowTable(flow_length, idle_timeout, FlowAccumulator)
+        self.classify = default_classifier().direction
+        self.packets = 0
+        self.short_flows = 0
+        self.verdict_packets = 0
+        self.latencies = []
+
+    def add(self, ts, src, dst, sport, dport, proto, length):
+        """
+        feed one packet
+        :return list: Verdict of the flows that reached flow_length with this packet
+        """
+        arrival = time.perf_counter()
+        self.packets += 1
+
+        direction = self.classify(src)
+        key = flow_key(src, dst, sport, dport, proto)
+
+        verdicts = []
+        for done_key, acc in self.table.add(key, ts, length, direction):
+            if len(acc) < self.flow_length:
+                # went idle before reaching flow_length, no verdict
+                self.short_flows += 1
+                continue
+            if self.cascade is not None:
+                verdict = self.cascade.predict_stage(len(self.cascade.lengths) - 1, acc.lazy_features())
+            elif self.detector.lazy:
+                verdict = self.detector.predict_lazy(acc.lazy_features())
+            else:
+                verdict = self.detector.predict_one(acc.features())
+            verdicts.append(self._verdict(done_key, verdict, acc, arrival))
+
+        if self.cascade is not None:
+            # an early prefix length, the flow is finished when its model is confident enough
+            acc = self.table.active.get(key)
+            stage = None if acc is None else self.cascade.stage_of(len(acc))
+            if stage is not None and len(acc) < self.flow_length:
+                verdict = self.cascade.predict_stage(stage, acc.lazy_features())
+                if verdict is not None:
+                    self.table.finish(key)
+                    verdicts.append(self._verdict(key, verdict, acc, arrival))
+
+        return verdicts
+
+    def _verdict(self, key, verdict, acc, arrival):
+        latency = time.perf_counter() - arrival
+        self.latencies.append(latency)
+        self.verdict_packets += len(acc)
+        return Verdict(key, verdict, acc.last_seen - acc.first_seen, latency, len(acc))
+
+    def run(self, packets, replay=False):
+        """
+        classify a stream of packets
+        :param packets iterable: records of pcap_reader.read_stream / read_packets
+        :param replay bool: sleep between packets to follow the capture timestamps
+        :return generator: Verdict in the order they are issued
+        """
+        start_wall = None
+        start_ts = None
+        for pkt in packets:
+            if replay:
+                ts = float(pkt[0])
+                if start_wall is None:
+                    start_wall = time.perf_counter()
+                    start_ts = ts
+                delay = (ts - start_ts) - (time.perf_counter() - start_wall)
+                if delay > 0:
+                    time.sleep(delay)
+
+            for verdict in self.add(*pkt):
+                yield verdict
+
+        self.short_flows += len(self.table.flush())
+
+    def stats(self):
+        """packets and flows seen, verdict latency percentiles in milliseconds"""
+        res = {'packets': self.packets, 'verdicts': len(self.latencies), 'short_flows': self.short_flows}
+        if self.latencies:
+            res['mean_packets'] = round(self.verdict_packets / len(self.latencies), 2)
+            latencies = np.array(self.latencies) * 1000
+            for q in (50, 90, 99):
+                res['latency_p%d_ms' % q] = round(float(np.percentile(latencies, q)), 3)
+            res['latency_max_ms'] = round(float(latencies.max()), 3)
+
+        return res
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='classify flows of a live pcap stream')
+    parser.add_argument('source', nargs='?', default='-',
+                        help='pcap or pcapng file, possibly compressed, or - to read a pcap stream from stdin')
+    parser.add_argument('--model', default=model_path_DT)
+    parser.add_argument('--flow-length', type=int, default=FLOW_LENGTH)
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT)
+    parser.add_argument('--replay', action='store_true', help='follow the capture timestamps')
+    parser.add_argument('--lazy', action='store_true', help='compute only the features the tree reads')
+    parser.add_argument('--cascade', default=None,
+                        help='a cascade.json of cascade.py, classify flows at the first confident prefix length')
+    args = parser.parse_args()
+
+    # the cascade brings its own models, the single model is only loaded without one
+    cascade = Cascade.load(args.cascade) if args.cascade else None
+    detector = None if cascade is not None else Detector(args.model, args.flow_length, lazy=args.lazy)
+    engine = LiveDetector(detector, args.flow_length, args.idle_timeout, cascade)
+
+    f = sys.stdin.buffer if args.source == '-' else open_capture(args.source)
+    for v in engine.run(read_stream(f), args.replay):
+        print(flow_name(v.key), 'snowflake' if v.verdict == SNOWFLAKE else 'normal',
+              '%.3fs' % v.flow_time, '%.3fms' % (v.latency * 1000), '%d packets' % v.packets)
+        sys.stdout.flush()
+    f.close()
+
+    print(engine.stats())
+    if detector is not None and args.lazy:
+        print(detector.lazy_report())
+    if cascade is not None:
+        print(cascade.exit_report())
@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+
+
+# set to record from the start, e.g. SNOWDT_METRICS=1 python test_fpr.py
+ENV_VAR = 'SNOWDT_METRICS'
+
+PROMETHEUS_PREFIX = 'snowdt'
+
+
+class _Timer(object):
+    """context manager adding the time spent in its block to a stage"""
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        super(_Timer, self).__init__()
+        self.metrics = metrics
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer(object):
+    """the timer handed out while recording is off"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics(object):
+    """
+    stage timers and counters of a run, recording is off unless enabled
+    callers on a hot path check the enabled attribute once and skip all the bookkeeping when it is False
+    :counters name -> count, e.g. packets, flows, cache_hits
+    :timers stage -> [calls, total seconds, max seconds]
+    """
+    __slots__ = ('enabled', 'counters', 'timers')
+
+    def __init__(self, enabled=False):
+        super(Metrics, self).__init__()
+        self.enabled = enabled
+        self.counters = {}
+        self.timers = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.counters = {}
+        self.timers = {}
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds, calls=1):
+        if not self.enabled:
+            return
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [calls, seconds, seconds]
+        else:
+            timer[0] += calls
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+    def timer(self, name):
+        """
+        time a block, with METRICS.timer('predict'): ...
+        :param name string: the stage
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def snapshot(self):
+        """
+        the recorded values as plain data, e.g. to send them from a worker process
+        :return dict: counters and timers
+        """
+        return {'counters': dict(self.counters),
+                'timers': {name: list(timer) for name, timer in self.timers.items()}}
+
+    def merge(self, snapshot):
+        """add the values of a snapshot, e.g. recorded by a worker process"""
+        for name, n in snapshot['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        for name, (calls, total, longest) in snapshot['timers'].items():
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [calls, total, longest]
+            else:
+                timer[0] += calls
+                timer[1] += total
+                timer[2] = max(timer[2], longest)
+
+    def to_json(self):
+        timers = {name: {'calls': calls, 'seconds': round(total, 6), 'max_seconds': round(longest, 6)}
+                  for name, (calls, total, longest) in sorted(self.timers.items())}
+        return json.dumps({'counters': dict(sorted(self.counters.items())), 'timers': timers}, indent=1)
+
+    def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+        """the values in the Prometheus text exposition format"""
+        lines = []
+        for name, n in sorted(self.counters.items()):
+            metric = '%s_%s_total' % (prefix, name)
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %d' % (metric, n))
+
+        if self.timers:
+            for suffix, kind, column in [('stage_calls_total', 'counter', 0), ('stage_seconds_total', 'counter', 1),
+                                         ('stage_seconds_max', 'gauge', 2)]:
+                metric = '%s_%s' % (prefix, suffix)
+                lines.append('# TYPE %s %s' % (metric, kind))
+                for name, timer in sorted(self.timers.items()):
+                    lines.append('%s{stage="%s"} %s' % (metric, name, repr(timer[column])))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        write the values to a file, Prometheus text for .prom files, JSON otherwise, - for stdout
+        :param path string: the output file
+        """
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json() + '\n'
+        if path == '-':
+            sys.stdout.write(text)
+            return
+        with open(path, 'w') as f:
+            f.write(text)
+
+
+# the metrics of this process
+METRICS = Metrics(bool(os.environ.get(ENV_VAR)))
+
+
+def measured(arg, fn):
+    """
+    worker side of a pool map with metrics, records the call of fn alone
+    :return tuple: the result of fn(arg) and the snapshot of its metrics
+    """
+    METRICS.enable()
+    METRICS.reset()
+    res = fn(arg)
+
+    return res, METRICS.snapshot()
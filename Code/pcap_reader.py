@@ -0,0 +1,514 @@
+import os
+import io
+import sys
+import gzip
+import lzma
+import mmap
+import dpkt
+import struct
+import itertools
+from decimal import Decimal
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from Snowflake_Detection.metrics import METRICS
+
+
+# backends of read_packets, dpkt is the reference implementation
+DPKT = 'dpkt'
+FAST = 'fast'
+BACKENDS = (DPKT, FAST)
+DEFAULT_BACKEND = FAST
+
+TCP = 6
+UDP = 17
+
+_MAGIC_MICRO = 0xa1b2c3d4
+_MAGIC_NANO = 0xa1b23c4d
+
+# compressed captures are recognized by their first bytes, not by the file name
+_GZIP_MAGIC = b'\x1f\x8b'
+_XZ_MAGIC = b'\xfd7zXZ\x00'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# pcapng blocks: section header, interface description, packet (obsolete), simple packet, enhanced packet
+_PCAPNG_SHB = b'\x0a\x0d\x0d\x0a'
+_PCAPNG_IDB = 1
+_PCAPNG_PB = 2
+_PCAPNG_SPB = 3
+_PCAPNG_EPB = 6
+_PCAPNG_OPT_TSRESOL = 9
+_PCAPNG_OPT_TSOFFSET = 14
+
+_LINKTYPE_ETHERNET = 1
+_LINKTYPE_RAW = 101
+
+_ETH_TYPE_IP = 0x0800
+_ETH_TYPE_IP6 = 0x86dd
+_ETH_TYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+# IPv6 extension headers: hop-by-hop, routing, destination options, fragment, AH, ESP
+_IP6_EXT_OPTS = (0, 43, 60)
+_IP6_EXT_FRAGMENT = 44
+_IP6_EXT_AH = 51
+_IP6_EXT_ESP = 50
+
+# returned by the parsers for a truncated or invalid header, None is a packet that is skipped on purpose
+_MALFORMED = False
+
+_U16 = struct.Struct('!H')
+_PORTS = struct.Struct('!HH')
+
+
+def read_packets(pcap_path, backend=DEFAULT_BACKEND):
+    """
+    read the headers of every TCP/UDP packet in a pcap or pcapng file, other packets are skipped
+    gzip, xz and zstd (with the zstandard package) files are decompressed on the fly, only as far as they are read,
+    so closing the generator after the first packets reads only the first blocks of the file
+    :param pcap_path string: a given path of pacp file
+    :param backend string: 'fast' reads fixed header offsets, 'dpkt' decodes every packet with dpkt
+    :return generator: (timestamp, sip, dip, sport, dport, proto, length),
+                       sip/dip are packed address bytes, length is the transport payload length
+    """
+    if backend == FAST:
+        return _read_fast(pcap_path)
+    elif backend == DPKT:
+        return _read_dpkt(pcap_path)
+    else:
+        raise ValueError('unknown pcap reader backend: %s' % backend)
+
+
+def open_capture(pcap_path):
+    """
+    open a capture for sequential reading, compressed files are decompressed as they are read
+    :param pcap_path string: a pcap or pcapng file, possibly gzip, xz or zstd compressed
+    :return file: a binary file object with read() and peek()
+    """
+    with open(pcap_path, 'rb') as f:
+        magic = f.read(6)
+
+    if magic.startswith(_GZIP_MAGIC):
+        return gzip.open(pcap_path, 'rb')
+    if magic.startswith(_XZ_MAGIC):
+        return lzma.open(pcap_path, 'rb')
+    if magic.startswith(_ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError('%s is zstd compressed, install the zstandard package to read it' % pcap_path)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(pcap_path, 'rb'), closefd=True))
+    return open(pcap_path, 'rb')
+
+
+def open_capture_bytes(data):
+    """
+    open_capture of a capture held in memory, e.g. a file uploaded to detect_service.py
+    :param data bytes: a pcap or pcapng file, possibly gzip, xz or zstd compressed
+    :return file: a binary file object
+    """
+    f = io.BytesIO(data)
+    if data.startswith(_GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    if data.startswith(_XZ_MAGIC):
+        return lzma.LZMAFile(f, 'rb')
+    if data.startswith(_ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError('the capture is zstd compressed, install the zstandard package to read it')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+    return f
+
+
+def _is_classic_pcap(magic):
+    """an uncompressed classic pcap file, the only format the fast backend memory-maps"""
+    if len(magic) < 4:
+        return False
+    return (struct.unpack('<I', magic[:4])[0] in (_MAGIC_MICRO, _MAGIC_NANO) or
+            struct.unpack('>I', magic[:4])[0] in (_MAGIC_MICRO, _MAGIC_NANO))
+
+
+def _read_dpkt(pcap_path):
+    skipped = malformed = 0
+    with open_capture(pcap_path) as f:
+        pcap = dpkt.pcapng.Reader(f) if f.peek(4)[:4] == _PCAPNG_SHB else dpkt.pcap.Reader(f)
+        linktype = pcap.datalink()
+        raw = linktype == _LINKTYPE_RAW
+        supported = linktype in (_LINKTYPE_ETHERNET, _LINKTYPE_RAW)
+        try:
+            for ts, buf in pcap:
+                if not supported:
+                    # an unsupported link layer, every frame is skipped as by the fast reader
+                    skipped += 1
+                    continue
+                try:
+                    if raw:
+                        ip = dpkt.ip.IP(buf) if buf[:1] and buf[0] >> 4 == 4 else dpkt.ip6.IP6(buf)
+                    else:
+                        ip = dpkt.ethernet.Ethernet(buf).data
+                except dpkt.dpkt.UnpackError:
+                    # malformed or truncated frame
+                    malformed += 1
+                    continue
+                if not isinstance(ip, (dpkt.ip.IP, dpkt.ip6.IP6)):
+                    skipped += 1
+                    continue
+
+                l4 = ip.data
+                if isinstance(l4, dpkt.tcp.TCP):
+                    proto = TCP
+                elif isinstance(l4, dpkt.udp.UDP):
+                    proto = UDP
+                else:
+                    skipped += 1
+                    continue
+
+                yield ts, bytes(ip.src), bytes(ip.dst), l4.sport, l4.dport, proto, len(l4.data)
+        finally:
+            _count_dropped(skipped, malformed)
+
+
+def _read_fast(pcap_path):
+    with open(pcap_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        classic = _is_classic_pcap(f.read(4))
+        if classic:
+            if size < 24:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for pkt in _iter_records(mm, size):
+                    yield pkt
+            finally:
+                mm.close()
+            return
+
+    # pcapng and compressed files are read as a stream
+    with open_capture(pcap_path) as f:
+        for pkt in read_stream(f):
+            yield pkt
+
+
+def read_stream(f):
+    """
+    read the headers of every TCP/UDP packet from a pcap or pcapng stream, e.g. a pipe from tcpdump -w -
+    :param f file: a binary file object, read sequentially
+    :return generator: the same records as read_packets
+    """
+    magic = f.read(4)
+    if magic == _PCAPNG_SHB:
+        for pkt in _iter_pcapng(f):
+            yield pkt
+        return
+
+    header = magic + f.read(20)
+    if len(header) < 24:
+        return
+    endian, divisor, parse = _global_header(header)
+
+    record = struct.Struct(endian + 'IIII')
+    skipped = malformed = 0
+    try:
+        while True:
+            hdr = f.read(16)
+            if len(hdr) < 16:
+                break
+            sec, frac, caplen, _ = record.unpack(hdr)
+            buf = f.read(caplen)
+            if len(buf) < caplen:
+                malformed += 1
+                break
+
+            pkt = parse(buf, 0, caplen)
+            if pkt:
+                yield (sec + frac / divisor,) + pkt
+            elif pkt is None:
+                skipped += 1
+            else:
+                malformed += 1
+    finally:
+        _count_dropped(skipped, malformed)
+
+
+def _global_header(buf):
+    """
+    byte order, timestamp divisor and link layer parser of a pcap global header,
+    frames of an unsupported link layer are skipped, as on pcapng interfaces
+    """
+    magic, = struct.unpack_from('<I', buf, 0)
+    if magic in (_MAGIC_MICRO, _MAGIC_NANO):
+        endian = '<'
+    else:
+        endian = '>'
+        magic, = struct.unpack_from('>I', buf, 0)
+        if magic not in (_MAGIC_MICRO, _MAGIC_NANO):
+            raise ValueError('invalid tcpdump header')
+    # same timestamp arithmetic as dpkt.pcap.Reader
+    divisor = Decimal('1E9') if magic == _MAGIC_NANO else 1E6
+    linktype, = struct.unpack_from(endian + 'I', buf, 20)
+
+    return endian, divisor, _link_parser(linktype)
+
+
+def _link_parser(linktype):
+    """the parser of the frames of a link type, _skip_frame for unsupported ones"""
+    if linktype == _LINKTYPE_ETHERNET:
+        return _parse_ethernet
+    elif linktype == _LINKTYPE_RAW:
+        return _parse_ip
+    return _skip_frame
+
+
+def _skip_frame(buf, p, end):
+    """a frame of an unsupported link layer, counted as skipped"""
+    return None
+
+
+def _iter_records(buf, size):
+    """walk the records of a classic pcap held in buf, payload bytes are never copied"""
+    endian, divisor, parse = _global_header(buf)
+
+    record = struct.Struct(endian + 'IIII')
+    off = 24
+    skipped = malformed = 0
+    try:
+        while off + 16 <= size:
+            sec, frac, caplen, _ = record.unpack_from(buf, off)
+            off += 16
+            end = off + caplen
+            if end > size:
+                # truncated last record
+                malformed += 1
+                break
+
+            pkt = parse(buf, off, end)
+            off = end
+            if pkt:
+                yield (sec + frac / divisor,) + pkt
+            elif pkt is None:
+                skipped += 1
+            else:
+                malformed += 1
+    finally:
+        _count_dropped(skipped, malformed)
+
+
+def _pcapng_interface(body, endian):
+    """link layer parser, timestamp divisor and offset of an interface description block"""
+    linktype, = struct.unpack_from(endian + 'H', body, 0)
+    divisor = 1E6
+    offset = 0
+
+    p = 8
+    while p + 4 <= len(body):
+        code, length = struct.unpack_from(endian + 'HH', body, p)
+        p += 4
+        if code == 0:
+            break
+        value = body[p:p + length]
+        if code == _PCAPNG_OPT_TSRESOL and length >= 1:
+            # MSB 0: a negative power of 10, MSB 1: a negative power of 2, same arithmetic as dpkt
+            base = 2 if value[0] & 0x80 else 10
+            divisor = float(base ** (value[0] & 0x7f))
+        elif code == _PCAPNG_OPT_TSOFFSET and length >= 8:
+            offset, = struct.unpack_from(endian + 'q', value, 0)
+        p += (length + 3) & ~3
+
+    return _link_parser(linktype), divisor, offset
+
+
+def _iter_pcapng(f):
+    """
+    walk the blocks of a pcapng stream whose section header block type was already read,
+    enhanced and obsolete packet blocks are parsed, simple packet blocks have no timestamp and are skipped
+    """
+    endian = '<'
+    interfaces = []
+    skipped = malformed = 0
+    head = _PCAPNG_SHB + f.read(4)
+    try:
+        while len(head) == 8:
+            if head[:4] == _PCAPNG_SHB:
+                bom = f.read(4)
+                if bom == b'\x4d\x3c\x2b\x1a':
+                    endian = '<'
+                elif bom == b'\x1a\x2b\x3c\x4d':
+                    endian = '>'
+                else:
+                    malformed += 1
+                    break
+                block_type = 0x0a0d0d0a
+                length, = struct.unpack(endian + 'I', head[4:8])
+                body = bom + f.read(length - 12) if length >= 12 else b''
+                # a new section, interface numbers start over
+                interfaces = []
+            else:
+                block_type, length = struct.unpack(endian + 'II', head)
+                body = f.read(length - 8) if length >= 12 else b''
+
+            if length < 12 or len(body) < length - 8:
+                malformed += 1
+                break
+            # drop the trailing copy of the block length
+            end = length - 12
+
+            if block_type == _PCAPNG_IDB:
+                interfaces.append(_pcapng_interface(body[:end], endian))
+            elif block_type in (_PCAPNG_EPB, _PCAPNG_PB):
+                if block_type == _PCAPNG_EPB:
+                    iface, high, low, caplen, _ = struct.unpack_from(endian + 'IIIII', body, 0)
+                else:
+                    iface, _, high, low, caplen, _ = struct.unpack_from(endian + 'HHIIII', body, 0)
+                if iface >= len(interfaces) or 20 + caplen > end:
+                    malformed += 1
+                else:
+                    parse, divisor, offset = interfaces[iface]
+                    pkt = parse(body, 20, 20 + caplen)
+                    if pkt:
+                        yield (offset + ((high << 32) | low) / divisor,) + pkt
+                    elif pkt is None:
+                        skipped += 1
+                    else:
+                        malformed += 1
+            elif block_type == _PCAPNG_SPB:
+                skipped += 1
+
+            head = f.read(8)
+    finally:
+        _count_dropped(skipped, malformed)
+
+
+def _count_dropped(skipped, malformed):
+    """record the frames a reader did not yield, non TCP/UDP ones and malformed ones"""
+    if METRICS.enabled:
+        METRICS.count('packets_skipped', skipped)
+        METRICS.count('packets_malformed', malformed)
+
+
+def _parse_ethernet(buf, p, end):
+    if end - p < 14:
+        return _MALFORMED
+    eth_type, = _U16.unpack_from(buf, p + 12)
+    p += 14
+
+    # up to two VLAN tags (QinQ)
+    for _ in range(2):
+        if eth_type not in _ETH_TYPE_VLAN:
+            break
+        if end - p < 4:
+            return _MALFORMED
+        eth_type, = _U16.unpack_from(buf, p + 2)
+        p += 4
+
+    if eth_type == _ETH_TYPE_IP:
+        return _parse_ip4(buf, p, end)
+    elif eth_type == _ETH_TYPE_IP6:
+        return _parse_ip6(buf, p, end)
+    return None
+
+
+def _parse_ip(buf, p, end):
+    if end - p < 1:
+        return _MALFORMED
+    version = buf[p] >> 4
+    if version == 4:
+        return _parse_ip4(buf, p, end)
+    elif version == 6:
+        return _parse_ip6(buf, p, end)
+    return None
+
+
+def _parse_ip4(buf, p, end):
+    if end - p < 20:
+        return _MALFORMED
+    hl = (buf[p] & 0xf) << 2
+    if hl < 20:
+        return _MALFORMED
+    total, = _U16.unpack_from(buf, p + 2)
+    frag, = _U16.unpack_from(buf, p + 6)
+    if frag & 0x1fff:
+        # not the first fragment, no transport header
+        return None
+    proto = buf[p + 9]
+
+    # trailing Ethernet padding is not part of the payload, length 0 is likely TSO
+    if total:
+        end = min(end, p + total)
+    return _parse_l4(buf, p + hl, end, proto, buf[p + 12:p + 16], buf[p + 16:p + 20])
+
+
+def _parse_ip6(buf, p, end):
+    if end - p < 40:
+        return _MALFORMED
+    plen, = _U16.unpack_from(buf, p + 4)
+    nxt = buf[p + 6]
+    src = buf[p + 8:p + 24]
+    dst = buf[p + 24:p + 40]
+    p += 40
+    if plen:
+        end = min(end, p + plen)
+
+    while True:
+        if nxt in _IP6_EXT_OPTS:
+            if end - p < 2:
+                return _MALFORMED
+            length = (buf[p + 1] + 1) * 8
+        elif nxt == _IP6_EXT_FRAGMENT:
+            if end - p < 8:
+                return _MALFORMED
+            frag, = _U16.unpack_from(buf, p + 2)
+            if frag >> 3:
+                return None
+            length = 8
+        elif nxt == _IP6_EXT_AH:
+            if end - p < 12:
+                return _MALFORMED
+            length = (buf[p + 1] + 2) * 4
+        elif nxt == _IP6_EXT_ESP:
+            return None
+        else:
+            break
+        nxt = buf[p]
+        p += length
+
+    return _parse_l4(buf, p, end, nxt, src, dst)
+
+
+def _parse_l4(buf, p, end, proto, src, dst):
+    if proto == TCP:
+        if end - p < 20:
+            return _MALFORMED
+        sport, dport = _PORTS.unpack_from(buf, p)
+        off = (buf[p + 12] >> 4) << 2
+        if off < 20:
+            return _MALFORMED
+    elif proto == UDP:
+        if end - p < 8:
+            return _MALFORMED
+        sport, dport = _PORTS.unpack_from(buf, p)
+        off = 8
+    else:
+        return None
+
+    return src, dst, sport, dport, proto, max(0, end - p - off)
+
+
+def compare_backends(pcap_path):
+    """
+    check the fast backend against dpkt on a pcap file
+    :param pcap_path string: a given path of pacp file
+    :return int: the number of packets read, raise AssertionError at the first difference
+    """
+    count = 0
+    pairs = itertools.zip_longest(read_packets(pcap_path, DPKT), read_packets(pcap_path, FAST))
+    for count, (expected, actual) in enumerate(pairs, 1):
+        assert expected == actual, '%s packet %d: %r != %r' % (pcap_path, count, expected, actual)
+
+    return count
+
+
+if __name__ == '__main__':
+
+    for pcap_path in sys.argv[1:]:
+        print(pcap_path, compare_backends(pcap_path))
+
+    print('OK.')
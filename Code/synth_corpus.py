@@ -0,0 +1,342 @@
+import os
+import re
+import csv
+import heapq
+import socket
+import struct
+import argparse
+import functools
+import multiprocessing
+import numpy as np
+
+from Snowflake_Detection.extract_features import *
+from Snowflake_Detection.pcap_reader import read_packets
+from Snowflake_Detection.direction import default_classifier
+
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Covertness Analysis')
+
+SNOWFLAKE = 'snowflake'
+BROWSER = 'browser'
+
+# the bundled samples every profile is derived from
+PROFILE_SAMPLES = {SNOWFLAKE: ['10.0a7-Snowflake.pcap'],
+                   BROWSER: ['Chrome-file.pcap', 'audio.pcap', 'image.pcap', 'video.pcap', 'webpage.pcap']}
+
+# archive directory of every profile in a per-flow corpus, the layout test_fpr.py and test_recall.py read
+ARCHIVES = {SNOWFLAKE: 'snowflake', BROWSER: 'normal'}
+
+MAX_PAYLOAD = 1460
+
+_PCAP_HEADER = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+_RECORD = struct.Struct('<IIII')
+_ETHERNET = b'\x00\x0c\x29\x00\x00\x01' + b'\x00\x50\x56\x00\x00\x02' + b'\x08\x00'
+_IP = struct.Struct('!BBHHHBBH4s4s')
+_TCP = struct.Struct('!HHIIBBHHH')
+_ZEROS = bytes(65535)
+
+
+class Profile(object):
+    """
+    packet direction, payload size and inter-arrival gap sequences of sample flows
+    :sequences (directions, sizes, gaps) of every sample file
+    :pool all the (direction, size) pairs of the samples, for the random substitutions
+    """
+    __slots__ = ('name', 'sequences', 'pool_directions', 'pool_sizes')
+
+    def __init__(self, name, sequences):
+        super(Profile, self).__init__()
+        self.name = name
+        self.sequences = sequences
+        self.pool_directions = np.concatenate([s[0] for s in sequences])
+        self.pool_sizes = np.concatenate([s[1] for s in sequences])
+
+    @classmethod
+    def from_pcaps(cls, name, pcap_paths):
+        """
+        derive a profile from pcap files, one sample flow per file
+        :param pcap_paths list: paths of the sample pcap files
+        """
+        sequences = []
+        classify = default_classifier().direction
+        for pcap_path in pcap_paths:
+            directions, sizes, timestamps = [], [], []
+            for ts, src, dst, sport, dport, proto, length in read_packets(pcap_path):
+                directions.append(classify(src))
+                sizes.append(min(length, MAX_PAYLOAD))
+                timestamps.append(float(ts))
+            if not directions:
+                continue
+            gaps = np.diff(np.array(timestamps), prepend=timestamps[0])
+            sequences.append((np.array(directions, dtype=np.int8), np.array(sizes, dtype=np.int64),
+                              np.maximum(gaps, 0.0)))
+
+        if not sequences:
+            raise ValueError('no TCP/UDP packets in the samples of profile %s' % name)
+
+        return cls(name, sequences)
+
+    def flow(self, packets, rng, mix=0.1, jitter=0.3):
+        """
+        a new flow following one of the samples
+        the sample is repeated when it is shorter than packets, mix of the packets get a (direction, size) drawn
+        from the whole profile and every gap is scaled by a log-normal factor
+        :param packets int: number of packets
+        :param rng Generator: numpy random generator
+        :return tuple: directions, payload sizes and gaps (seconds) of every packet
+        """
+        directions, sizes, gaps = self.sequences[rng.integers(len(self.sequences))]
+        index = np.arange(packets) % len(directions)
+        directions = directions[index]
+        sizes = sizes[index]
+        gaps = gaps[index] * rng.lognormal(0.0, jitter, packets)
+
+        swap = np.flatnonzero(rng.random(packets) < mix)
+        pick = rng.integers(len(self.pool_sizes), size=len(swap))
+        directions[swap] = self.pool_directions[pick]
+        sizes[swap] = self.pool_sizes[pick]
+        gaps[0] = 0.0
+
+        return directions, sizes, gaps
+
+
+_profiles = {}
+
+
+def load_profiles(sample_dir=SAMPLE_DIR):
+    """the snowflake and browser profiles, derived once per process"""
+    if sample_dir not in _profiles:
+        _profiles[sample_dir] = {name: Profile.from_pcaps(name, [os.path.join(sample_dir, f) for f in files])
+                                 for name, files in PROFILE_SAMPLES.items()}
+
+    return _profiles[sample_dir]
+
+
+def flow_endpoints(index):
+    """
+    distinct 5-tuple of the index-th generated flow, a private client and a public server on port 443
+    :return tuple: client ip, server ip (both 4 bytes), client port, server port
+    """
+    client = bytes((192, 168, (index // 250) % 256, index % 250 + 2))
+    server = bytes((93, (index // 65536) % 256, (index // 256) % 256, index % 256))
+    client_port = 32768 + (index // 64000) % 28000
+
+    return client, server, client_port, 443
+
+
+class PcapWriter(object):
+    """
+    minimal pcap writer of Ethernet/IPv4/TCP packets with zero payloads,
+    headers are packed with struct so multi-GB captures are written at disk speed
+    """
+    def __init__(self, f):
+        super(PcapWriter, self).__init__()
+        self.f = f
+        self.bytes = len(_PCAP_HEADER)
+        self.packets = 0
+        f.write(_PCAP_HEADER)
+
+    def write(self, ts, src, dst, sport, dport, payload):
+        """
+        write one packet
+        :param ts float: captured time
+        :param payload int: TCP payload length
+        """
+        ip_len = 20 + 20 + payload
+        frame = (_ETHERNET +
+                 _IP.pack(0x45, 0, ip_len, self.packets & 0xffff, 0x4000, 64, 6, 0, src, dst) +
+                 _TCP.pack(sport, dport, 0, 0, 5 << 4, 0x18, 65535, 0, 0))
+        usec = int(round(ts * 1e6))
+        sec, usec = divmod(usec, 1000000)
+        length = len(frame) + payload
+
+        self.f.write(_RECORD.pack(sec, usec, length, length))
+        self.f.write(frame)
+        self.f.write(_ZEROS[:payload])
+        self.bytes += _RECORD.size + length
+        self.packets += 1
+
+
+def write_flow(pcap_path, profile, packets, seed=0, index=0, start=1.6e9):
+    """
+    write a single-flow pcap file
+    :param profile string: SNOWFLAKE or BROWSER
+    :param packets int: number of packets
+    :param seed: seed of the random generator, an int or a sequence of ints
+    :param index int: the flow number, picks the 5-tuple
+    :return int: bytes written
+    """
+    rng = np.random.default_rng(seed)
+    directions, sizes, gaps = load_profiles()[profile].flow(packets, rng)
+    client, server, client_port, server_port = flow_endpoints(index)
+    timestamps = (start + np.cumsum(gaps)).tolist()
+
+    with open(pcap_path, 'wb') as f:
+        writer = PcapWriter(f)
+        for ts, direction, size in zip(timestamps, directions.tolist(), sizes.tolist()):
+            if direction == UPSTREAM:
+                writer.write(ts, client, server, client_port, server_port, size)
+            else:
+                writer.write(ts, server, client, server_port, client_port, size)
+
+    return writer.bytes
+
+
+def _write_corpus_file(job, out_dir, packets, seed):
+    profile, index = job
+    rng = np.random.default_rng([seed, list(PROFILE_SAMPLES).index(profile), index])
+    n = int(rng.integers(packets[0], packets[1] + 1))
+    pcap_path = os.path.join(out_dir, ARCHIVES[profile], '%s_%06d.pcap' % (profile, index))
+
+    return write_flow(pcap_path, profile, n, rng, index)
+
+
+def write_corpus(out_dir, counts, packets=(40, 400), seed=0, workers=None, chunk_size=64):
+    """
+    write a corpus of single-flow pcap files, out_dir/snowflake/*.pcap and out_dir/normal/*.pcap,
+    every file depends only on seed, its profile and its number, not on the number of workers
+    :param counts dict: number of files of every profile, e.g. {SNOWFLAKE: 1000, BROWSER: 1000}
+    :param packets tuple: the smallest and largest number of packets of a flow
+    :param workers int: number of worker processes, None for all cores, 1 to run in this process
+    :return tuple: number of files and bytes written
+    """
+    jobs = []
+    for profile, count in counts.items():
+        os.makedirs(os.path.join(out_dir, ARCHIVES[profile]), exist_ok=True)
+        jobs.extend((profile, i) for i in range(count))
+
+    write = functools.partial(_write_corpus_file, out_dir=out_dir, packets=packets, seed=seed)
+    if workers == 1:
+        sizes = list(map(write, jobs))
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            sizes = pool.map(write, jobs, chunksize=chunk_size)
+
+    return len(jobs), sum(sizes)
+
+
+def write_capture(pcap_path, size, snowflake_share=0.5, packets=(40, 400), concurrency=64, seed=0,
+                  labels_path=None):
+    """
+    write one multi-flow capture of about size bytes, concurrency flows are interleaved at any time
+    and a new flow starts whenever one ends, so the capture has no gap and any size can be reached
+    :param size int: stop once this many bytes are written
+    :param snowflake_share float: the fraction of flows following the snowflake profile
+    :param packets tuple: the smallest and largest number of packets of a flow
+    :param labels_path string: csv of client, server, packets and profile of every flow, None to skip it,
+        packets is the number written, a flow cut off by size is labelled with its written prefix
+    :return tuple: number of flows, packets and bytes written
+    """
+    rng = np.random.default_rng(seed)
+    profiles = load_profiles()
+
+    labels = None
+    if labels_path is not None:
+        labels_file = open(labels_path, 'w', newline='')
+        labels = csv.writer(labels_file)
+        labels.writerow(['client', 'client_port', 'server', 'server_port', 'proto', 'packets', 'profile'])
+
+    flows = 0
+    written_flows = 0
+    heap = []
+    # flow number -> label row with the packets written so far, a row is written once its flow ends
+    open_flows = {}
+
+    def end_flow(number):
+        nonlocal written_flows
+        row = open_flows.pop(number)
+        if row[5]:
+            written_flows += 1
+            if labels is not None:
+                labels.writerow(row)
+
+    def start_flow(now):
+        nonlocal flows
+        profile = SNOWFLAKE if rng.random() < snowflake_share else BROWSER
+        n = int(rng.integers(packets[0], packets[1] + 1))
+        directions, sizes, gaps = profiles[profile].flow(n, rng)
+        timestamps = (now + rng.exponential(0.05) + np.cumsum(gaps)).tolist()
+        endpoints = flow_endpoints(flows)
+        open_flows[flows] = [socket.inet_ntop(socket.AF_INET, endpoints[0]), endpoints[2],
+                             socket.inet_ntop(socket.AF_INET, endpoints[1]), endpoints[3], 6, 0, profile]
+        packets_iter = zip(timestamps, directions.tolist(), sizes.tolist())
+        # every heap entry holds the next packet of its flow, the earliest packet is written first
+        heapq.heappush(heap, (next(packets_iter), flows, endpoints, packets_iter))
+        flows += 1
+
+    try:
+        with open(pcap_path, 'wb') as f:
+            writer = PcapWriter(f)
+            for _ in range(concurrency):
+                start_flow(1.6e9)
+
+            while heap and writer.bytes < size:
+                (ts, direction, payload), number, endpoints, packets_iter = heap[0]
+                client, server, client_port, server_port = endpoints
+                if direction == UPSTREAM:
+                    writer.write(ts, client, server, client_port, server_port, payload)
+                else:
+                    writer.write(ts, server, client, server_port, client_port, payload)
+                open_flows[number][5] += 1
+
+                pending = next(packets_iter, None)
+                if pending is None:
+                    heapq.heappop(heap)
+                    end_flow(number)
+                    start_flow(ts)
+                else:
+                    heapq.heapreplace(heap, (pending, number, endpoints, packets_iter))
+
+            # flows still open when the size is reached, flows without any written packet are not labelled
+            for number in sorted(open_flows):
+                end_flow(number)
+    finally:
+        if labels is not None:
+            labels_file.close()
+
+    return written_flows, writer.packets, writer.bytes
+
+
+def parse_size(text):
+    """bytes of a size such as 500M or 2G"""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMG]?)B?', text.strip().upper())
+    if match is None:
+        raise argparse.ArgumentTypeError('invalid size: %s' % text)
+    return int(float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' '))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='write synthetic pcap files with snowflake-like and browser-like '
+                                                 'profiles derived from the Covertness Analysis samples')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    flows_parser = sub.add_parser('flows', help='many single-flow pcap files')
+    flows_parser.add_argument('out_dir')
+    flows_parser.add_argument('--snowflake', type=int, default=1000, help='number of snowflake files')
+    flows_parser.add_argument('--browser', type=int, default=1000, help='number of browser files')
+    flows_parser.add_argument('--workers', type=int, default=None)
+
+    capture_parser = sub.add_parser('capture', help='one multi-flow capture')
+    capture_parser.add_argument('pcap_path')
+    capture_parser.add_argument('--size', type=parse_size, default=parse_size('1G'), help='e.g. 500M or 4G')
+    capture_parser.add_argument('--snowflake-share', type=float, default=0.5)
+    capture_parser.add_argument('--concurrency', type=int, default=64)
+    capture_parser.add_argument('--labels', default=None, help='csv of the flows, <pcap_path>.labels.csv by default')
+
+    for p in (flows_parser, capture_parser):
+        p.add_argument('--packets', type=int, nargs=2, default=[40, 400], metavar=('MIN', 'MAX'))
+        p.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.mode == 'flows':
+        files, size = write_corpus(args.out_dir, {SNOWFLAKE: args.snowflake, BROWSER: args.browser},
+                                   tuple(args.packets), args.seed, args.workers)
+        print(args.out_dir, files, 'files', size, 'bytes')
+    else:
+        labels_path = args.labels or args.pcap_path + '.labels.csv'
+        flows, packets, size = write_capture(args.pcap_path, args.size, args.snowflake_share, tuple(args.packets),
+                                             args.concurrency, args.seed, labels_path)
+        print(args.pcap_path, flows, 'flows', packets, 'packets', size, 'bytes')
+
+    print('OK.')
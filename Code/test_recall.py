@@ -2,6 +2,7 @@ import pandas as pd
 import numpy as np
 import os
 import joblib
+import argparse
 from sklearn.metrics import *
 # from sklearn.externals import joblib
 from sklearn.model_selection import train_test_split
@@ -9,6 +10,8 @@ from sklearn.model_selection import cross_val_score
 from sklearn.tree import DecisionTreeClassifier as DT
 
 from Snowflake_Detection.extract_features import *
+from Snowflake_Detection.detector import Detector, score_archives
+from Snowflake_Detection.metrics import METRICS
 
 np.set_printoptions(threshold=np.inf)
 
@@ -17,38 +20,11 @@ NORMAL = 0
 
 model_path_DT = 'DT.pkl'
 
-def get_data(pcap_path):
+def get_data(pcap_path, cache=None):
     FLOW_LENGTH = 30
 
-    flow = extract_flow(pcap_path, FLOW_LENGTH)
-    res = []
-
-    # F1
-    for direction in [UPSTREAM, DOWNSTREAM]:
-        tmp = time_bins(flow, direction)
-        res += tmp
-    # F2
-    for direction in [UPSTREAM, DOWNSTREAM]:
-        tmp = top5_size(flow, direction)
-        res += tmp
-    # F3
-    for direction in [UPSTREAM, DOWNSTREAM]:
-        tmp = top5_size_percentage(flow, direction)
-        res += tmp
-    # F4
-    for direction in [UPSTREAM, DOWNSTREAM]:
-        tmp = direction_sum(flow, direction)
-        res.append(tmp)
-    # F5
-    for direction in [UPSTREAM, DOWNSTREAM]:
-        tmp = direction_percentage(flow, direction)
-        res.append(tmp)
-    # F6
-    tmp = direction_ratio(flow, BOTH)
-    res.append(tmp)
-    # # F7
-    # tmp = network_speed(flow)
-    # res += tmp
+    # F1-F6, from the feature cache when the pcap was seen before
+    res = extract_pcap_cached(pcap_path, FLOW_LENGTH, cache)
 
     data_n = pd.DataFrame([res])
     label_n = pd.Series([[NORMAL]])
@@ -59,17 +35,19 @@ def get_data(pcap_path):
     return X, Y
 
 
-def test_model(X, Y):
+def test_model(X, Y, detector=None):
     """
     load and test machine learning algorithm
     :param DataFrame X: the matrix of the entire data
     :param Series Y: the vector of the entire labels
+    :param Detector detector: the loaded model, loaded from model_path_DT if None
     """
 
     predict_dict = {'DT': -1}
 
-    model = joblib.load(model_path_DT)
-    predict_dict['DT'] = model.predict(X)[0]
+    if detector is None:
+        detector = Detector(model_path_DT)
+    predict_dict['DT'] = detector.predict(X)[0]
 
     return predict_dict
 
@@ -106,34 +84,29 @@ def get_stat(ytest, ypred):
 
 if __name__ == '__main__':
 
-    pcap_archive = 'version'
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pcap_archive', nargs='?', default='version')
+    parser.add_argument('--metrics', default=None,
+                        help='write stage timers and counters, Prometheus text for .prom files, JSON otherwise')
+    parser.add_argument('--model', default=model_path_DT,
+                        help='DT.pkl, or a model written by compare_models.py --save, e.g. KNN.pkl')
+    parser.add_argument('--cache', default=None, help='feature cache path, e.g. ' + CACHE_PATH)
+    parser.add_argument('--lazy', action='store_true',
+                        help='compute only the features the tree reads, without the feature cache')
+    args = parser.parse_args()
+    if args.metrics:
+        METRICS.enable()
 
-    DT_recall = []
+    pcap_archive = args.pcap_archive
 
-    sub_archive = os.listdir(pcap_archive)
-    for archive in sub_archive:
-        print(archive, end=' ')
-        pcap_dir = os.listdir(os.path.join(pcap_archive, archive))
-
-        DT_number = 0
-        pcap_number = len(pcap_dir)
-        print("total: %d" % pcap_number)
-
-        for pcap in pcap_dir:
-            pcap_path = os.path.join(pcap_archive, archive, pcap)
-
-            # print(pcap_path)
-            X, Y = get_data(pcap_path)
-            predict_result = test_model(X, Y)
-            # print(predict_result)
-            DT_number += predict_result['DT']
-
-        DT_recall.append(float(DT_number / pcap_number))
-
-        print("DT %f" % float(DT_number / pcap_number))
+    detector = Detector(args.model, workers=None, cache_path=None if args.lazy else args.cache, lazy=args.lazy)
+    DT_recall = [rate for archive, pcap_number, rate in score_archives(detector, pcap_archive)]
 
     print('----------------------------------')
     for i in range(len(DT_recall)):
         print(round(DT_recall[i]*100, 2))
 
-
+    if args.lazy:
+        print(detector.lazy_report())
+    if args.metrics:
+        METRICS.write(args.metrics)
@@ -2,12 +2,16 @@ import pandas as pd
 import numpy as np
 import os
 import joblib
+import argparse
 from sklearn.metrics import *
 # from sklearn.externals import joblib
 from sklearn.model_selection import train_test_split
 from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import StratifiedKFold
 from sklearn.tree import DecisionTreeClassifier as DT
 
+from Snowflake_Detection.dataset import load_training_set, is_dataset, DATASET_SUFFIX
+
 np.set_printoptions(threshold=np.inf)
 
 SNOWFLAKE = 1
@@ -20,18 +24,43 @@ normal_data = 'normal_train_' + str(FLOW_LENGTH) + '.csv'
 snowflake_data = 'snowflake_train_' + str(FLOW_LENGTH) + '.csv'
 
 
-def get_data():
-    data_m = pd.read_csv(snowflake_data, header=None, nrows=1032)
-    label_m = pd.Series([SNOWFLAKE for i in range(1032)])
+def get_data(flow_length=FLOW_LENGTH):
+    """
+    load the training set of a prefix length, the binary datasets written by dataset.py if they are complete,
+    the csv files written by extract_features.py --flow-length otherwise
+    :param int flow_length: the first n packets
+    """
+    snowflake_dataset = 'snowflake_train_' + str(flow_length) + DATASET_SUFFIX
+    normal_dataset = 'normal_train_' + str(flow_length) + DATASET_SUFFIX
+    if is_dataset(snowflake_dataset) and is_dataset(normal_dataset):
+        X, Y, _ = load_training_set([snowflake_dataset, normal_dataset])
+        return X, Y
+
+    snowflake_data = 'snowflake_train_' + str(flow_length) + '.csv'
+    normal_data = 'normal_train_' + str(flow_length) + '.csv'
 
-    data_n = pd.read_csv(normal_data, header=None, nrows=3798)
-    label_n = pd.Series([NORMAL for i in range(3798)])
+    data_m = pd.read_csv(snowflake_data, header=None)
+    label_m = pd.Series(np.full(len(data_m), SNOWFLAKE))
+
+    data_n = pd.read_csv(normal_data, header=None)
+    label_n = pd.Series(np.full(len(data_n), NORMAL))
 
     X = pd.concat([data_m, data_n], axis=0, join='outer')
     Y = pd.concat([label_m, label_n], axis=0, join='outer')
 
     return X, Y
 
+
+def save_model(model, model_path=model_path_DT):
+    """
+    dump a model under a temporary name and rename it, a running detect_service.py never loads a partial file
+    :param str model_path: where the model is saved
+    """
+    tmp = '%s.tmp.%d' % (model_path, os.getpid())
+    joblib.dump(model, tmp)
+    os.replace(tmp, model_path)
+
+
 def train_model(X, Y):
     """
     train machine learning algorithm
@@ -39,9 +68,9 @@ def train_model(X, Y):
     :param Series Y: the vector of the entire labels
     :param str model_name: the classification model (DT, NB or KNN)
     """
-    model = DT()
     model_path = model_path_DT
 
+    best_model = None
     min_score = 0
     accuracy_list = []
     tpr_list = []
@@ -50,20 +79,25 @@ def train_model(X, Y):
         X_train, X_test, Y_train, Y_test = train_test_split(X, Y, test_size=0.3)
         # print(np.shape(X_train))
         # print(np.shape(X_test))
+        model = DT()
         model.fit(X_train, Y_train)
 
         score = model.score(X_test, Y_test)
         accuracy_list.append(score)
 
-        result = get_stat(list(Y_test), model.predict(X_test).tolist())
+        result = get_stat(Y_test, model.predict(X_test))
         tpr_list.append(result[0])
         fpr_list.append(result[1])
 
         if score > min_score:
             min_score = score
-            joblib.dump(model, model_path)
+            best_model = model
             print(score)
 
+    # written once, for the best split
+    if best_model is not None:
+        save_model(best_model, model_path)
+
     avg_accuracy = sum(accuracy_list) / len(accuracy_list)
     avg_tpr = sum(tpr_list) / len(tpr_list)
     avg_fpr = sum(fpr_list) / len(fpr_list)
@@ -80,7 +114,7 @@ def test_model(X, Y, model_name):
     model_path = model_path_DT
 
     model = joblib.load(model_path)
-    result = get_stat(list(Y), model.predict(X).tolist())
+    result = get_stat(Y, model.predict(X))
 
     return result
 
@@ -92,26 +126,24 @@ def get_stat(ytest, ypred):
     :param list ypred: the array for the predicted labels of the
     test instances
     """
-    tp = 0
-    tn = 0
-    fp = 0
-    fn = 0
+    ytest = np.asarray(ytest)
+    ypred = np.asarray(ypred)
     label = SNOWFLAKE
-    for i in range(len(ypred)):
-        # print(ypred[i], ytest[i])
-        if ypred[i] == label and ytest[i] == label:
-            tp += 1
-        elif ypred[i] == label and ytest[i] != label:
-            fp += 1
-        elif ypred[i] != label and ytest[i] == label:
-            fn += 1
-        elif ypred[i] != label and ytest[i] != label:
-            tn += 1
-    tpr = float(tp / list(ytest).count(SNOWFLAKE))
-    fpr = float(fp / list(ytest).count(NORMAL))
-    # fnr = float(fn / list(ytest).count(SNOWFLAKE))
-    # tnr = float(tn / list(ytest).count(NORMAL))
-    accuracy = float((tp + tn) / (list(ytest).count(SNOWFLAKE) + list(ytest).count(NORMAL)))
+
+    predicted = ypred == label
+    positive = ytest == label
+    tp = int(np.count_nonzero(predicted & positive))
+    fp = int(np.count_nonzero(predicted & ~positive))
+    # fn = int(np.count_nonzero(~predicted & positive))
+    tn = int(np.count_nonzero(~predicted & ~positive))
+
+    snowflake_count = int(np.count_nonzero(positive))
+    normal_count = int(np.count_nonzero(ytest == NORMAL))
+    tpr = float(tp / snowflake_count)
+    fpr = float(fp / normal_count)
+    # fnr = float(fn / snowflake_count)
+    # tnr = float(tn / normal_count)
+    accuracy = float((tp + tn) / (snowflake_count + normal_count))
     if tp + fp == 0:
         precision = 0.0
     else:
@@ -120,11 +152,52 @@ def get_stat(ytest, ypred):
     return [tpr, fpr, accuracy, precision]
 
 
-if __name__ == '__main__':
+def _fit_fold(X, Y, train_index, test_index):
+    """fit and score one fold, run in a worker process"""
+    model = DT()
+    model.fit(X[train_index], Y[train_index])
+    tpr, fpr, accuracy, precision = get_stat(Y[test_index], model.predict(X[test_index]))
 
-    X, Y = get_data()
+    return model, accuracy, tpr, fpr
 
-    avg_accuracy, avg_tpr, avg_fpr = train_model(X, Y)
-    print('DT', round(avg_accuracy*100, 2), round(avg_tpr*100, 2), round(avg_fpr*100, 2))
 
+def train_model_cv(X, Y, n_splits=10, n_jobs=-1, model_path=model_path_DT):
+    """
+    train with stratified k-fold rounds fitted in parallel, only the best fold's model is written
+    :param array X: the matrix of the entire data
+    :param array Y: the vector of the entire labels
+    :param int n_splits: number of folds
+    :param int n_jobs: number of worker processes, -1 for all cores
+    :param str model_path: where the selected model is saved
+    """
+    X = np.asarray(X)
+    Y = np.asarray(Y)
+
+    folds = StratifiedKFold(n_splits=n_splits, shuffle=True).split(X, Y)
+    results = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_fit_fold)(X, Y, train_index, test_index) for train_index, test_index in folds)
+
+    models, accuracy, tpr, fpr = zip(*results)
+    best = int(np.argmax(accuracy))
+    save_model(models[best], model_path)
+    print(accuracy[best])
+
+    return float(np.mean(accuracy)), float(np.mean(tpr)), float(np.mean(fpr))
 
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='train the decision tree')
+    parser.add_argument('--flow-length', type=int, default=FLOW_LENGTH)
+    parser.add_argument('--cv', action='store_true', help='parallel stratified k-fold instead of 10 random splits')
+    parser.add_argument('--folds', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=-1)
+    args = parser.parse_args()
+
+    X, Y = get_data(args.flow_length)
+
+    if args.cv:
+        avg_accuracy, avg_tpr, avg_fpr = train_model_cv(X, Y, args.folds, args.jobs)
+    else:
+        avg_accuracy, avg_tpr, avg_fpr = train_model(X, Y)
+    print('DT', round(avg_accuracy*100, 2), round(avg_tpr*100, 2), round(avg_fpr*100, 2))
@@ -1,163 +1,177 @@
 import os
 import sys
 import time
-import dpkt
 import socket
 import numpy as np
 import math
+import argparse
+import functools
+import multiprocessing
 from collections import Counter
 
+from Snowflake_Detection.pcap_reader import read_packets, DEFAULT_BACKEND
+from Snowflake_Detection.direction import default_classifier
+
 UPSTREAM = 1
 BOTH = 0
 DOWNSTREAM = -1
 
+PACKET_SUM = 40
+
 def LocalIP(ip):
-    if ip[0:3] == "10." or ip[0:4] == "172." or ip[0:4] == "192.":
-        return True
-    else:
-        return False
+    return default_classifier().is_local(socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip))
 
 
-def packet_size(pcap_path, direction):
+def packet_size(pcap_path, direction, backend=DEFAULT_BACKEND):
     """
     print TCP payload length in directions of up (U), down (D) and both (b), respectively.
     :param str pcap_path: the pcap file's path
     :param str directon: the direction label
+    :param str backend: pcap reader backend, 'fast' or 'dpkt'
     :return list packet size statistic
     :return list entropy sequence
     """
-    packet_count = 0
-    PACKET_SUM = 40
-
-    size_sequence = []
-
-    f = open(pcap_path, 'rb')
-    pcap = dpkt.pcap.Reader(f)
-    for ts, buf in pcap:
-        time = ts
-
-        eth = dpkt.ethernet.Ethernet(buf)
-        ip = eth.data
-        tcp = ip.data
-
-        if hasattr(ip, 'src') and hasattr(ip, 'dst'):
-            try:
-                sip = socket.inet_ntop(socket.AF_INET, ip.src)
-                dip = socket.inet_ntop(socket.AF_INET, ip.dst)
-            except Exception as e:
-                sip = socket.inet_ntop(socket.AF_INET6, ip.src)
-                dip = socket.inet_ntop(socket.AF_INET6, ip.dst)
-
-        p_direction = UPSTREAM if (LocalIP(sip)) else DOWNSTREAM
-        length = len(tcp.data)
-
-        if p_direction == UPSTREAM:
-            size_sequence.append(length)
-            # print(length)
-        elif p_direction == DOWNSTREAM:
-            size_sequence.append(-1 * length)
-            # print(-1 * length)
-
-        packet_count += 1
-        if packet_count >= PACKET_SUM:
-            break
+    return analyze(pcap_path, PACKET_SUM, backend).size.tolist()
 
-    return size_sequence
 
-
-def packet_time(pcap_path, direction):
+def packet_time(pcap_path, direction, backend=DEFAULT_BACKEND):
     """
-    print TCP payload length in directions of up (U), down (D) and both (b), respectively.
+    captured time of every TCP/UDP packet relative to the first one, the same packets as analyze
     :param str pcap_path: the pcap file's path
     :param str directon: the direction label
+    :param str backend: pcap reader backend, 'fast' or 'dpkt'
     :return list packet captured time sequence
     """
-    packet_count = 0
-    PACKET_SUM = 40
-    start_time = 0.0
+    return analyze(pcap_path, PACKET_SUM, backend).time.tolist()
 
-    time_sequence = []
 
-    f = open(pcap_path, 'rb')
-    pcap = dpkt.pcap.Reader(f)
-    for ts, buf in pcap:
-        time = ts
+def network_speed(pcap_path, direction, backend=DEFAULT_BACKEND):
+    """
+    calculating network speed fluctuation at every packet
+    :param str pcap_path: the pcap file's path
+    :param str directon: the direction label
+    :param str backend: pcap reader backend, 'fast' or 'dpkt'
+    :return list speed sequence
+    """
+    return analyze(pcap_path, PACKET_SUM, backend).speed.tolist()
 
-        if start_time == 0:
-            start_time = time
 
-        time_sequence.append(time - start_time)
+class Series(object):
+    """
+    the comparison series of a pcap file, one value per TCP/UDP packet
+    :size signed payload length, positive upstream and negative downstream
+    :time captured time relative to the first packet
+    :speed cumulative payload (KB) over the elapsed time, 0 at the first packet
+    """
+    __slots__ = ('pcap_path', 'size', 'time', 'speed')
 
-        packet_count += 1
-        if packet_count >= PACKET_SUM:
-            break
+    def __init__(self, pcap_path, size, time, speed):
+        super(Series, self).__init__()
+        self.pcap_path = pcap_path
+        self.size = size
+        self.time = time
+        self.speed = speed
 
-    return time_sequence
+    def __len__(self):
+        return len(self.size)
 
 
-def network_speed(pcap_path, direction):
+def analyze(pcap_path, packet_sum=PACKET_SUM, backend=DEFAULT_BACKEND):
     """
-    calculating network speed fluctuation at every packet
+    read the first packets of a pcap file once and build the size, time and speed series together
     :param str pcap_path: the pcap file's path
-    :param str directon: the direction label
-    :return list speed sequence
+    :param int packet_sum: the first n packets
+    :param str backend: pcap reader backend, 'fast' or 'dpkt'
+    :return Series: the series as numpy arrays
     """
-    packet_count = 0
-    PACKET_SUM = 40
-    start_time = 0.0
-    total_size = 0
-    speed_sequence = []
-
-    f = open(pcap_path, 'rb')
-    pcap = dpkt.pcap.Reader(f)
-    for ts, buf in pcap:
-        time = ts
-
-        if start_time == 0:
-            start_time = time
-
-        eth = dpkt.ethernet.Ethernet(buf)
-        ip = eth.data
-        tcp = ip.data
-
-        if hasattr(ip, 'src') and hasattr(ip, 'dst'):
-            try:
-                sip = socket.inet_ntop(socket.AF_INET, ip.src)
-                dip = socket.inet_ntop(socket.AF_INET, ip.dst)
-            except Exception as e:
-                sip = socket.inet_ntop(socket.AF_INET6, ip.src)
-                dip = socket.inet_ntop(socket.AF_INET6, ip.dst)
-
-        p_direction = UPSTREAM if (LocalIP(sip)) else DOWNSTREAM
-        length = len(tcp.data)
-
-        total_size += length
-
-        # speed_sequence.append(round(total_size / 1024, 2))
-
-        consumed_time = time - start_time
-        if consumed_time == 0:
-            speed_sequence.append(0.0)
-        else:
-            speed_sequence.append(total_size / 1024 / consumed_time)
-
-        packet_count += 1
-        if packet_count >= PACKET_SUM:
+    timestamps = []
+    sizes = []
+    sources = []
+
+    packets = read_packets(pcap_path, backend)
+    for ts, src, dst, sport, dport, proto, length in packets:
+        timestamps.append(float(ts))
+        sizes.append(length)
+        sources.append(src)
+        if len(sizes) >= packet_sum:
             break
+    packets.close()
+
+    timestamps = np.array(timestamps, dtype=np.float64)
+    sizes = np.array(sizes, dtype=np.int64)
+
+    # directions of all the packets at once
+    size = np.where(default_classifier().is_local_many(sources), sizes, -sizes)
+    time = timestamps - timestamps[0] if len(timestamps) else timestamps
+    # same arithmetic as the per-packet loop: total / 1024 / elapsed
+    elapsed = np.where(time == 0, 1.0, time)
+    speed = np.where(time == 0, 0.0, np.cumsum(sizes) / 1024 / elapsed)
 
-    return speed_sequence
+    return Series(pcap_path, size, time, speed)
+
+
+def analyze_many(pcap_paths, packet_sum=PACKET_SUM, workers=None, chunk_size=16, backend=DEFAULT_BACKEND):
+    """
+    series of many pcap files, read in parallel
+    :param list pcap_paths: the pcap files' paths
+    :param int workers: number of worker processes, None for all cores, 1 to run in this process
+    :param int chunk_size: number of files handed to a worker at a time
+    :return generator: Series in the order of pcap_paths
+    """
+    analyze_one = functools.partial(analyze, packet_sum=packet_sum, backend=backend)
+
+    if workers == 1:
+        for series in map(analyze_one, pcap_paths):
+            yield series
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        # imap keeps the input order
+        for series in pool.imap(analyze_one, pcap_paths, chunksize=chunk_size):
+            yield series
+
+
+def save_series(path, series, packet_sum=PACKET_SUM):
+    """
+    stack the series of many pcap files into an npz file of (files, packet_sum) matrices,
+    shorter series are padded with NaN (0 for size) and length holds the real number of packets
+    :param str path: the npz file
+    :param iterable series: Series, e.g. from analyze_many
+    :return int: number of files
+    """
+    series = list(series)
+    size = np.zeros((len(series), packet_sum), dtype=np.int64)
+    time = np.full((len(series), packet_sum), np.nan)
+    speed = np.full((len(series), packet_sum), np.nan)
+    length = np.zeros(len(series), dtype=np.int64)
+    for i, s in enumerate(series):
+        n = min(len(s), packet_sum)
+        size[i, :n] = s.size[:n]
+        time[i, :n] = s.time[:n]
+        speed[i, :n] = s.speed[:n]
+        length[i] = n
+
+    np.savez(path, pcap_path=np.array([s.pcap_path for s in series], dtype=np.str_),
+             size=size, time=time, speed=speed, length=length)
+
+    return len(series)
 
 
 if __name__ == '__main__':
 
-    # size- and direction-related comparison
-    pcap_path_1 = '10.0a7-Snowflake.pcap'
-    pcap_path_2 = 'Chrome-file.pcap'
-    size_sequence_1 = packet_size(pcap_path_1, BOTH)
-    size_sequence_2 = packet_size(pcap_path_2, BOTH)
-    for i in range(40):
-        print(i, size_sequence_1[i], size_sequence_2[i])
+    parser = argparse.ArgumentParser(description='size, time and speed series of pcap files')
+    parser.add_argument('pcaps', nargs='*', help='pcap files, the bundled comparison by default')
+    parser.add_argument('--packets', type=int, default=PACKET_SUM)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--backend', default=DEFAULT_BACKEND)
+    parser.add_argument('--output', default='series.npz', help='npz file of the series of the given pcaps')
+    args = parser.parse_args()
 
+    if args.pcaps:
+        count = save_series(args.output, analyze_many(args.pcaps, args.packets, args.workers, backend=args.backend),
+                            args.packets)
+        print(args.output, count, 'OK.')
+        sys.exit(0)
 
     pcap_path_1 = '10.0a7-Snowflake.pcap'
     pcap_path_2 = 'webpage.pcap'
@@ -165,26 +179,20 @@ if __name__ == '__main__':
     pcap_path_4 = 'audio.pcap'
     pcap_path_5 = 'image.pcap'
     pcap_path_6 = 'Chrome-file.pcap'
+    pcap_paths = [pcap_path_1, pcap_path_2, pcap_path_3, pcap_path_4, pcap_path_5, pcap_path_6]
 
-    # time-related comparison
-    time_sequence_1 = packet_time(pcap_path_1, BOTH)
-    time_sequence_2 = packet_time(pcap_path_2, BOTH)
-    time_sequence_3 = packet_time(pcap_path_3, BOTH)
-    time_sequence_4 = packet_time(pcap_path_4, BOTH)
-    time_sequence_5 = packet_time(pcap_path_5, BOTH)
-    time_sequence_6 = packet_time(pcap_path_6, BOTH)
-    for i in range(40):
-        print(i, time_sequence_1[i], time_sequence_2[i], time_sequence_3[i], time_sequence_4[i], time_sequence_5[i], time_sequence_6[i])
-
-    # speed-related comparsion
-    speed_sequence_1 = network_speed(pcap_path_1, BOTH)
-    speed_sequence_2 = network_speed(pcap_path_2, BOTH)
-    speed_sequence_3 = network_speed(pcap_path_3, BOTH)
-    speed_sequence_4 = network_speed(pcap_path_4, BOTH)
-    speed_sequence_5 = network_speed(pcap_path_5, BOTH)
-    speed_sequence_6 = network_speed(pcap_path_6, BOTH)
-    for i in range(40):
-        print(i, speed_sequence_1[i], speed_sequence_2[i], speed_sequence_3[i], speed_sequence_4[i], speed_sequence_5[i], speed_sequence_6[i])
+    # every capture is read once
+    series = list(analyze_many(pcap_paths, args.packets, workers=1, backend=args.backend))
 
+    # size- and direction-related comparison
+    for i in range(min(len(series[0]), len(series[5]))):
+        print(i, series[0].size[i], series[5].size[i])
 
+    # time-related comparison, up to the shortest series
+    shortest = min(len(s) for s in series)
+    for i in range(shortest):
+        print(i, *[s.time[i] for s in series])
 
+    # speed-related comparsion
+    for i in range(shortest):
+        print(i, *[s.speed[i] for s in series])
@@ -0,0 +1,301 @@
+import os
+import sys
+import argparse
+import itertools
+import functools
+import multiprocessing
+import numpy as np
+
+from analysis import analyze, PACKET_SUM
+from Snowflake_Detection.pcap_reader import DEFAULT_BACKEND
+
+
+# fixed bin edges, every sketch of a series has the same bins so sketches merge by adding counts
+# bytes, one bin per payload length up to 1600 in both directions and a few wide bins for TSO-sized packets
+_SIZE_TAIL = np.array([2048, 4096, 8192, 16384, 32768, 65536])
+SIZE_EDGES = np.concatenate([-_SIZE_TAIL[::-1], np.arange(-1600, 1602), _SIZE_TAIL]).astype(np.float64)
+# seconds, 10 bins per decade from 1us to 1000s
+GAP_EDGES = np.concatenate([[0.0], np.logspace(-6, 3, 91)])
+# KB/s, 10 bins per decade from 0.001 to 10^7
+SPEED_EDGES = np.concatenate([[0.0], np.logspace(-3, 7, 101)])
+
+SERIES = ('size', 'gap', 'speed')
+EDGES = {'size': SIZE_EDGES, 'gap': GAP_EDGES, 'speed': SPEED_EDGES}
+
+
+class IndexedHistogram(object):
+    """
+    a histogram of every packet index, fixed bins so two sketches merge exactly and memory does not grow with files
+    bin 0 holds values below edges[0], bin len(edges) values from edges[-1] up, bin i values in [edges[i-1], edges[i])
+    :counts (packet_sum, len(edges) + 1) number of values in every bin
+    :low, high the exact smallest and largest value of every index
+    """
+    __slots__ = ('edges', 'counts', 'low', 'high')
+
+    def __init__(self, edges, packet_sum=PACKET_SUM):
+        super(IndexedHistogram, self).__init__()
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros((packet_sum, len(self.edges) + 1), dtype=np.int64)
+        self.low = np.full(packet_sum, np.inf)
+        self.high = np.full(packet_sum, -np.inf)
+
+    @property
+    def packet_sum(self):
+        return len(self.counts)
+
+    def total(self):
+        """number of values of every index"""
+        return self.counts.sum(axis=1)
+
+    def add(self, values):
+        """
+        add the series of one file, values[i] is the value at packet index i
+        :param values array: at most packet_sum values, NaN are ignored
+        """
+        values = np.asarray(values, dtype=np.float64)[:self.packet_sum]
+        index = np.flatnonzero(~np.isnan(values))
+        values = values[index]
+        if not len(values):
+            return
+
+        bins = np.searchsorted(self.edges, values, side='right')
+        np.add.at(self.counts, (index, bins), 1)
+        self.low[index] = np.minimum(self.low[index], values)
+        self.high[index] = np.maximum(self.high[index], values)
+
+    def merge(self, other):
+        """add the counts of a sketch with the same bins"""
+        if self.counts.shape != other.counts.shape or not np.array_equal(self.edges, other.edges):
+            raise ValueError('cannot merge histograms with different bins')
+        self.counts += other.counts
+        np.minimum(self.low, other.low, out=self.low)
+        np.maximum(self.high, other.high, out=self.high)
+
+    def percentile(self, q, index=None):
+        """
+        approximate percentile, interpolated inside the bin that holds it and clipped to the exact range,
+        the left edge of a bin one wide, so integer data gives integer percentiles
+        :param q float: the percentile, 0 to 100
+        :param index int: a packet index, None for the values of all indices together
+        :return float: NaN when there are no values
+        """
+        if index is None:
+            counts = self.counts.sum(axis=0)
+            low, high = self.low.min(), self.high.max()
+        else:
+            counts = self.counts[index]
+            low, high = self.low[index], self.high[index]
+        n = counts.sum()
+        if n == 0:
+            return float('nan')
+
+        cumulative = np.cumsum(counts)
+        rank = q / 100.0 * n
+        b = min(int(np.searchsorted(cumulative, rank, side='left')), len(counts) - 1)
+        before = cumulative[b - 1] if b else 0
+        left = self.edges[b - 1] if b else low
+        right = self.edges[b] if b < len(self.edges) else high
+        left, right = max(left, low), min(right, high)
+        # a one-wide bin holds a single integer value (the size bins), nothing to interpolate
+        if right <= left or (0 < b < len(self.edges) and self.edges[b] - self.edges[b - 1] == 1):
+            return float(left)
+        fraction = (rank - before) / counts[b] if counts[b] else 0.0
+
+        return float(left + (right - left) * fraction)
+
+    def distribution(self, index=None):
+        """the bin frequencies of a packet index, or of all indices together"""
+        counts = self.counts.sum(axis=0) if index is None else self.counts[index]
+        n = counts.sum()
+        return counts / n if n else counts.astype(np.float64)
+
+
+def ks_distance(p, q):
+    """Kolmogorov-Smirnov distance of two binned distributions, the largest gap between the CDFs at the bin edges"""
+    return float(np.abs(np.cumsum(p) - np.cumsum(q)).max())
+
+
+def js_distance(p, q):
+    """Jensen-Shannon distance of two binned distributions, base 2 so it is between 0 and 1"""
+    m = (p + q) / 2
+
+    def kl(a):
+        mask = a > 0
+        return float(np.sum(a[mask] * np.log2(a[mask] / m[mask])))
+
+    return float(np.sqrt(max(0.0, (kl(p) + kl(q)) / 2)))
+
+
+class CorpusStats(object):
+    """
+    bounded-memory summary of the size, inter-arrival gap and speed series of a corpus of pcap files
+    :files number of files added
+    :series name -> IndexedHistogram, for size, gap and speed
+    """
+    __slots__ = ('files', 'series')
+
+    def __init__(self, packet_sum=PACKET_SUM):
+        super(CorpusStats, self).__init__()
+        self.files = 0
+        self.series = {name: IndexedHistogram(EDGES[name], packet_sum) for name in SERIES}
+
+    @property
+    def packet_sum(self):
+        return self.series['size'].packet_sum
+
+    def add(self, series):
+        """
+        add one file
+        :param series Series: the output of analysis.analyze
+        """
+        self.files += 1
+        if not len(series):
+            return
+        self.series['size'].add(series.size)
+        self.series['gap'].add(np.diff(series.time, prepend=series.time[0]))
+        self.series['speed'].add(series.speed)
+
+    def merge(self, other):
+        """add another summary, e.g. the partial result of a worker, the result does not depend on the order"""
+        self.files += other.files
+        for name in SERIES:
+            self.series[name].merge(other.series[name])
+        return self
+
+    def save(self, path):
+        arrays = {'files': np.array(self.files)}
+        for name, hist in self.series.items():
+            arrays[name + '_edges'] = hist.edges
+            arrays[name + '_counts'] = hist.counts
+            arrays[name + '_low'] = hist.low
+            arrays[name + '_high'] = hist.high
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        stats = cls(len(data['size_counts']))
+        stats.files = int(data['files'])
+        for name, hist in stats.series.items():
+            hist.edges = data[name + '_edges']
+            hist.counts = data[name + '_counts']
+            hist.low = data[name + '_low']
+            hist.high = data[name + '_high']
+        return stats
+
+
+def _corpus_chunk(pcap_paths, packet_sum, backend):
+    """worker side of corpus_stats, one partial summary per chunk of files"""
+    stats = CorpusStats(packet_sum)
+    for pcap_path in pcap_paths:
+        stats.add(analyze(pcap_path, packet_sum, backend))
+    return stats
+
+
+def pcap_files(paths):
+    """
+    the pcap files of files and directories, directories are walked recursively
+    :return generator: file paths, in sorted order inside every directory
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+
+
+def corpus_stats(pcap_paths, packet_sum=PACKET_SUM, workers=None, chunk_size=64, backend=DEFAULT_BACKEND):
+    """
+    summarize a corpus, each worker summarizes chunks of files and the partial summaries are merged
+    :param pcap_paths iterable: the pcap files, read lazily
+    :param workers int: number of worker processes, None for all cores, 1 to run in this process
+    :param chunk_size int: number of files summarized by a worker at a time
+    :return CorpusStats: the summary
+    """
+    pcap_paths = iter(pcap_paths)
+    chunks = iter(lambda: list(itertools.islice(pcap_paths, chunk_size)), [])
+    summarize = functools.partial(_corpus_chunk, packet_sum=packet_sum, backend=backend)
+
+    stats = CorpusStats(packet_sum)
+    if workers == 1:
+        for part in map(summarize, chunks):
+            stats.merge(part)
+        return stats
+
+    with multiprocessing.Pool(workers) as pool:
+        for part in pool.imap_unordered(summarize, chunks):
+            stats.merge(part)
+
+    return stats
+
+
+def compare(a, b, quantiles=(50, 90)):
+    """
+    per-index percentiles of two summaries and the distances between their distributions
+    :param a, b CorpusStats: e.g. the snowflake and the normal corpus
+    :return dict: series name -> list of rows (index, percentiles of a, percentiles of b, KS, JS),
+                  index 'all' is every packet index together
+    """
+    res = {}
+    for name in SERIES:
+        ha, hb = a.series[name], b.series[name]
+        rows = []
+        for index in list(range(min(a.packet_sum, b.packet_sum))) + [None]:
+            pa, pb = ha.distribution(index), hb.distribution(index)
+            if not pa.any() or not pb.any():
+                continue
+            rows.append(('all' if index is None else index,
+                         [ha.percentile(q, index) for q in quantiles],
+                         [hb.percentile(q, index) for q in quantiles],
+                         ks_distance(pa, pb), js_distance(pa, pb)))
+        res[name] = rows
+
+    return res
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='bounded-memory size, gap and speed statistics of pcap corpora')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    build_parser = sub.add_parser('build', help='summarize pcap files and directories into an npz file')
+    build_parser.add_argument('output')
+    build_parser.add_argument('pcaps', nargs='+')
+    build_parser.add_argument('--packets', type=int, default=PACKET_SUM)
+    build_parser.add_argument('--workers', type=int, default=None)
+    build_parser.add_argument('--chunk-size', type=int, default=64)
+    build_parser.add_argument('--backend', default=DEFAULT_BACKEND)
+
+    merge_parser = sub.add_parser('merge', help='merge summaries, e.g. built on several machines')
+    merge_parser.add_argument('output')
+    merge_parser.add_argument('inputs', nargs='+')
+
+    compare_parser = sub.add_parser('compare', help='percentiles and distances of two summaries')
+    compare_parser.add_argument('a', help='e.g. snowflake.npz')
+    compare_parser.add_argument('b', help='e.g. normal.npz')
+    args = parser.parse_args()
+
+    if args.mode == 'build':
+        stats = corpus_stats(pcap_files(args.pcaps), args.packets, args.workers, args.chunk_size, args.backend)
+        stats.save(args.output)
+        print(args.output, stats.files, 'files')
+    elif args.mode == 'merge':
+        stats = CorpusStats.load(args.inputs[0])
+        for path in args.inputs[1:]:
+            stats.merge(CorpusStats.load(path))
+        stats.save(args.output)
+        print(args.output, stats.files, 'files')
+    else:
+        a, b = CorpusStats.load(args.a), CorpusStats.load(args.b)
+        print(args.a, a.files, 'files,', args.b, b.files, 'files')
+        for name, rows in compare(a, b).items():
+            print(name)
+            print('%5s %12s %12s %12s %12s %8s %8s' % ('index', 'a p50', 'a p90', 'b p50', 'b p90', 'KS', 'JS'))
+            for index, qa, qb, ks, js in rows:
+                print('%5s %12.4g %12.4g %12.4g %12.4g %8.4f %8.4f' % (index, qa[0], qa[1], qb[0], qb[1], ks, js))
+        sys.exit(0)
+
+    print('OK.')